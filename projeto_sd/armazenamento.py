@@ -0,0 +1,556 @@
+import os
+import json
+import time
+import zlib
+import struct
+import bisect
+import fcntl
+import threading
+from contextlib import contextmanager
+import msgpack
+from configuracao import obter
+from registro import Registro
+
+registrador = Registro("[S]")
+
+# Cada registro no log: tamanho (4 bytes) + crc32 (4 bytes) + payload msgpack
+CABECALHO = struct.Struct(">II")
+
+# Cada entrada do índice do segmento: seq do registro + offset no arquivo .log
+ENTRADA_INDICE = struct.Struct(">QQ")
+
+# Configuração padrão (pode ser sobrescrita por variáveis de ambiente)
+SEGMENTO_BYTES = int(obter("ARMAZENAMENTO_SEGMENTO_BYTES", 64 * 1024 * 1024))
+FSYNC_LOTE = int(obter("ARMAZENAMENTO_FSYNC_LOTE", 100))
+FSYNC_INTERVALO = float(obter("ARMAZENAMENTO_FSYNC_INTERVALO", 0.2))
+INDICE_INTERVALO = int(obter("ARMAZENAMENTO_INDICE_INTERVALO", 64))
+
+# Commit em grupo: o fsync começa assim que há escrita pendente e as que
+# chegam durante ele formam o próximo lote; COMMIT_INTERVALO > 0 espera até
+# esse prazo (ou COMMIT_LOTE escritas) para juntar lotes maiores
+COMMIT_LOTE = int(obter("ARMAZENAMENTO_COMMIT_LOTE", 64))
+COMMIT_INTERVALO = float(obter("ARMAZENAMENTO_COMMIT_INTERVALO", 0))
+
+# Depois de uma falha no fsync o commit em grupo espera COMMIT_ESPERA_ERRO
+# segundos para tentar de novo, o dobro a cada falha seguida, até
+# COMMIT_ESPERA_ERRO_MAX (independe de COMMIT_INTERVALO, que pode ser 0)
+COMMIT_ESPERA_ERRO = float(obter("ARMAZENAMENTO_COMMIT_ESPERA_ERRO", 0.1))
+COMMIT_ESPERA_ERRO_MAX = float(obter("ARMAZENAMENTO_COMMIT_ESPERA_ERRO_MAX", 5))
+
+
+def ler_registros(arquivo, offset):
+    """Percorre os registros válidos a partir de offset, retornando (offset, payload)"""
+    arquivo.seek(offset)
+    while True:
+        cabecalho = arquivo.read(CABECALHO.size)
+        if len(cabecalho) < CABECALHO.size:
+            return
+        tamanho, crc = CABECALHO.unpack(cabecalho)
+        dados = arquivo.read(tamanho)
+        if len(dados) < tamanho or zlib.crc32(dados) != crc:
+            return
+        yield offset, dados
+        offset += CABECALHO.size + tamanho
+
+
+class Segmento:
+    """Um arquivo .log de registros e seu índice esparso .idx"""
+
+    def __init__(self, diretorio, base):
+        self.base = base  # seq do primeiro registro do segmento
+        self.caminho_log = os.path.join(diretorio, f"{base:020d}.log")
+        self.caminho_indice = os.path.join(diretorio, f"{base:020d}.idx")
+        self.indice = []  # [(seq, offset)] ordenado por seq
+        self.proximo_seq = base
+        self.tamanho = 0
+
+    def carregar_indice(self):
+        """Lê o índice do disco descartando entradas inválidas ou incompletas"""
+        self.indice = []
+        if not os.path.exists(self.caminho_indice):
+            return
+        tamanho_log = os.path.getsize(self.caminho_log)
+        with open(self.caminho_indice, "rb") as f:
+            conteudo = f.read()
+        for i in range(len(conteudo) // ENTRADA_INDICE.size):
+            seq, offset = ENTRADA_INDICE.unpack_from(conteudo, i * ENTRADA_INDICE.size)
+            if offset >= tamanho_log or (self.indice and seq <= self.indice[-1][0]):
+                break
+            self.indice.append((seq, offset))
+
+    def recuperar(self, indice_intervalo):
+        """Reconstrói o estado do segmento e corta um final de escrita incompleto"""
+        self.carregar_indice()
+        if not self.indice or self.indice[0] != (self.base, 0):
+            self.indice = []
+        seq, offset = self.indice[-1] if self.indice else (self.base, 0)
+        fim = offset
+        with open(self.caminho_log, "rb") as f:
+            for offset, dados in ler_registros(f, offset):
+                if not self.indice or (seq > self.indice[-1][0] and (seq - self.base) % indice_intervalo == 0):
+                    self.indice.append((seq, offset))
+                seq += 1
+                fim = offset + CABECALHO.size + len(dados)
+        if fim < os.path.getsize(self.caminho_log):
+            with open(self.caminho_log, "r+b") as f:
+                f.truncate(fim)
+        self.proximo_seq = seq
+        self.tamanho = fim
+        # Regrava o índice para refletir exatamente o que foi recuperado
+        with open(self.caminho_indice, "wb") as f:
+            for entrada in self.indice:
+                f.write(ENTRADA_INDICE.pack(*entrada))
+
+    def localizar(self, seq):
+        """Retorna a entrada do índice mais próxima antes (ou em) seq"""
+        pos = bisect.bisect_right(self.indice, (seq, float("inf"))) - 1
+        return self.indice[max(pos, 0)]
+
+
+class LogSegmentado:
+    """Log append-only de registros msgpack com rotação de segmentos.
+
+    Cada registro recebe uma seq crescente. A escrita custa O(1) independente
+    do histórico, o fsync é feito em lotes (por quantidade ou por intervalo) e
+    um final de arquivo corrompido por queda é descartado. Com
+    compartilhado=True vários processos podem anexar ao mesmo diretório: cada
+    escrita é feita com flock e antes dela o processo incorpora o que os
+    outros gravaram. Sem compartilhar, o processo trava o diretório enquanto
+    estiver aberto e as escritas não pagam flock nem verificação do disco.
+    """
+
+    def __init__(self, diretorio, segmento_bytes=SEGMENTO_BYTES, fsync_lote=FSYNC_LOTE,
+                 fsync_intervalo=FSYNC_INTERVALO, indice_intervalo=INDICE_INTERVALO,
+                 compartilhado=True):
+        os.makedirs(diretorio, exist_ok=True)
+        self.diretorio = diretorio
+        self.segmento_bytes = segmento_bytes
+        self.fsync_lote = fsync_lote
+        self.fsync_intervalo = fsync_intervalo
+        self.indice_intervalo = max(indice_intervalo, 1)
+        self.compartilhado = compartilhado
+        self.lock = threading.Lock()
+        self._trava = open(os.path.join(diretorio, "LOCK"), "a")
+        self._leitores = {}
+        self._pendentes = 0
+        self._fechado = False
+
+        with self.lock:
+            if compartilhado:
+                fcntl.flock(self._trava, fcntl.LOCK_EX)
+                try:
+                    self._abrir_segmentos()
+                finally:
+                    fcntl.flock(self._trava, fcntl.LOCK_UN)
+            else:
+                # Diretório privado: a trava fica com este processo até fechar
+                try:
+                    fcntl.flock(self._trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    self._trava.close()
+                    raise RuntimeError(f"{diretorio} já está aberto por outro processo")
+                self._abrir_segmentos()
+
+        if self.fsync_intervalo > 0:
+            threading.Thread(target=self._sincronizar_periodicamente, daemon=True).start()
+
+    def _abrir_segmentos(self):
+        bases = sorted(int(nome[:-4]) for nome in os.listdir(self.diretorio) if nome.endswith(".log"))
+        self.segmentos = []
+        for i, base in enumerate(bases):
+            segmento = Segmento(self.diretorio, base)
+            if i == len(bases) - 1:
+                segmento.recuperar(self.indice_intervalo)
+            else:
+                segmento.carregar_indice()
+                segmento.proximo_seq = bases[i + 1]
+                segmento.tamanho = os.path.getsize(segmento.caminho_log)
+            self.segmentos.append(segmento)
+        if not self.segmentos:
+            self.segmentos.append(Segmento(self.diretorio, 0))
+        self._abrir_ativo()
+
+    def _abrir_ativo(self):
+        ativo = self.segmentos[-1]
+        self._fd = os.open(ativo.caminho_log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._fd_indice = os.open(ativo.caminho_indice, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _fechar_ativo(self):
+        os.close(self._fd)
+        os.close(self._fd_indice)
+
+    def _acompanhar(self):
+        """Incorpora registros e segmentos gravados por outros processos"""
+        while True:
+            ativo = self.segmentos[-1]
+            tamanho = os.fstat(self._fd).st_size
+            if tamanho > ativo.tamanho:
+                seq = ativo.proximo_seq
+                fim = ativo.tamanho
+                with open(ativo.caminho_log, "rb") as f:
+                    for offset, dados in ler_registros(f, ativo.tamanho):
+                        if (seq - ativo.base) % self.indice_intervalo == 0:
+                            ativo.indice.append((seq, offset))
+                        seq += 1
+                        fim = offset + CABECALHO.size + len(dados)
+                if fim < tamanho:
+                    # Escrita incompleta de um processo que caiu
+                    os.ftruncate(self._fd, fim)
+                ativo.proximo_seq = seq
+                ativo.tamanho = fim
+
+            if ativo.tamanho < self.segmento_bytes:
+                return
+            proximo = Segmento(self.diretorio, ativo.proximo_seq)
+            if not os.path.exists(proximo.caminho_log):
+                return
+            # Outro processo já rotacionou o segmento
+            self._sincronizar()
+            self._fechar_ativo()
+            self.segmentos.append(proximo)
+            self._abrir_ativo()
+
+    def _rotacionar(self):
+        self._sincronizar()
+        self._fechar_ativo()
+        self.segmentos.append(Segmento(self.diretorio, self.segmentos[-1].proximo_seq))
+        self._abrir_ativo()
+
+    def _sincronizar(self):
+        if self._pendentes:
+            os.fsync(self._fd)
+            os.fsync(self._fd_indice)
+            self._pendentes = 0
+
+    def _sincronizar_periodicamente(self):
+        while not self._fechado:
+            time.sleep(self.fsync_intervalo)
+            try:
+                with self.lock:
+                    if not self._fechado:
+                        self._sincronizar()
+            except:
+                pass
+
+    @contextmanager
+    def exclusivo(self):
+        """Bloqueia o log (entre threads e processos) já atualizado com o disco"""
+        with self.lock:
+            if not self.compartilhado:
+                yield self
+                return
+            fcntl.flock(self._trava, fcntl.LOCK_EX)
+            try:
+                self._acompanhar()
+                yield self
+            finally:
+                fcntl.flock(self._trava, fcntl.LOCK_UN)
+
+    def mudou(self):
+        """Verifica, apenas com fstat, se outro processo gravou no log"""
+        if not self.compartilhado:
+            return False
+        with self.lock:
+            ativo = self.segmentos[-1]
+            if os.fstat(self._fd).st_size != ativo.tamanho:
+                return True
+            return (ativo.tamanho >= self.segmento_bytes
+                    and os.path.exists(Segmento(self.diretorio, ativo.proximo_seq).caminho_log))
+
+    def acompanhar(self):
+        """Incorpora o que outros processos gravaram e retorna a próxima seq"""
+        with self.exclusivo():
+            return self.proximo_seq
+
+    @property
+    def proximo_seq(self):
+        return self.segmentos[-1].proximo_seq
+
+    def __len__(self):
+        return self.proximo_seq - self.segmentos[0].base
+
+    def _anexar(self, dados):
+        ativo = self.segmentos[-1]
+        if ativo.tamanho >= self.segmento_bytes and ativo.proximo_seq > ativo.base:
+            self._rotacionar()
+            ativo = self.segmentos[-1]
+
+        seq = ativo.proximo_seq
+        offset = ativo.tamanho
+        # Cabeçalho e payload em uma única escrita
+        os.write(self._fd, CABECALHO.pack(len(dados), zlib.crc32(dados)) + dados)
+        ativo.tamanho += CABECALHO.size + len(dados)
+        ativo.proximo_seq += 1
+
+        if (seq - ativo.base) % self.indice_intervalo == 0:
+            ativo.indice.append((seq, offset))
+            os.write(self._fd_indice, ENTRADA_INDICE.pack(seq, offset))
+
+        self._pendentes += 1
+        if self.fsync_lote and self._pendentes >= self.fsync_lote:
+            self._sincronizar()
+        return seq, (ativo.base, offset)
+
+    def anexar(self, registro):
+        """Grava um registro no final do log e retorna sua seq"""
+        dados = msgpack.packb(registro)
+        with self.exclusivo():
+            return self._anexar(dados)[0]
+
+    def anexar_posicionado(self, registro):
+        """Como anexar, retornando (seq, posição) para ler_posicao()"""
+        dados = msgpack.packb(registro)
+        with self.exclusivo():
+            return self._anexar(dados)
+
+    def sincronizar(self):
+        """Força o fsync dos registros pendentes"""
+        with self.lock:
+            self._sincronizar()
+
+    def bytes_desde(self, seq):
+        """Tamanho dos registros a partir de seq (o que um replay leria)"""
+        total = 0
+        with self.lock:
+            for segmento in self.segmentos:
+                if segmento.proximo_seq <= seq:
+                    continue
+                if seq <= segmento.base:
+                    total += segmento.tamanho
+                    continue
+                atual, offset = segmento.localizar(seq)
+                fd = self._leitor(segmento)
+                while atual < seq:
+                    tamanho, _ = CABECALHO.unpack(os.pread(fd, CABECALHO.size, offset))
+                    offset += CABECALHO.size + tamanho
+                    atual += 1
+                total += segmento.tamanho - offset
+        return total
+
+    def _segmento_de(self, seq):
+        pos = bisect.bisect_right([s.base for s in self.segmentos], seq) - 1
+        if pos < 0 or seq >= self.segmentos[pos].proximo_seq:
+            return None
+        return self.segmentos[pos]
+
+    def _leitor(self, segmento):
+        fd = self._leitores.get(segmento.base)
+        if fd is None:
+            fd = os.open(segmento.caminho_log, os.O_RDONLY)
+            self._leitores[segmento.base] = fd
+        return fd
+
+    def ler(self, seq):
+        """Lê o registro com a seq informada (None se não existir)"""
+        with self.lock:
+            segmento = self._segmento_de(seq)
+            if segmento is None:
+                return None
+            atual, offset = segmento.localizar(seq)
+            fd = self._leitor(segmento)
+        while True:
+            tamanho, _ = CABECALHO.unpack(os.pread(fd, CABECALHO.size, offset))
+            if atual == seq:
+                return msgpack.unpackb(os.pread(fd, tamanho, offset + CABECALHO.size), raw=False)
+            offset += CABECALHO.size + tamanho
+            atual += 1
+
+    def ler_posicao(self, posicao):
+        """Lê o registro na posição (base do segmento, offset) sem procurar pela seq"""
+        base, offset = posicao
+        with self.lock:
+            pos = bisect.bisect_right([s.base for s in self.segmentos], base) - 1
+            if pos < 0 or self.segmentos[pos].base != base:
+                return None
+            fd = self._leitor(self.segmentos[pos])
+        tamanho, _ = CABECALHO.unpack(os.pread(fd, CABECALHO.size, offset))
+        return msgpack.unpackb(os.pread(fd, tamanho, offset + CABECALHO.size), raw=False)
+
+    def iterar(self, desde=0, posicoes=False):
+        """Percorre (seq, registro) a partir de desde até o final atual do log.
+
+        Com posicoes=True retorna (seq, registro, posição) para ler_posicao().
+        """
+        with self.lock:
+            segmentos = [(s, s.proximo_seq) for s in self.segmentos if s.proximo_seq > desde]
+        for segmento, fim in segmentos:
+            seq, offset = segmento.localizar(max(desde, segmento.base))
+            with open(segmento.caminho_log, "rb") as f:
+                for offset, dados in ler_registros(f, offset):
+                    if seq >= fim:
+                        break
+                    if seq >= desde:
+                        registro = msgpack.unpackb(dados, raw=False)
+                        if posicoes:
+                            yield seq, registro, (segmento.base, offset)
+                        else:
+                            yield seq, registro
+                    seq += 1
+
+    def fechar(self):
+        with self.lock:
+            self._sincronizar()
+            self._fechado = True
+            self._fechar_ativo()
+            for fd in self._leitores.values():
+                os.close(fd)
+            self._leitores = {}
+            self._trava.close()
+
+
+def salvar_instantaneo(caminho, estado):
+    """Grava o snapshot de forma atômica (temporário + fsync + rename); retorna o tamanho"""
+    dados = msgpack.packb(estado)
+    temporario = caminho + ".tmp"
+    with open(temporario, "wb") as f:
+        f.write(CABECALHO.pack(len(dados), zlib.crc32(dados)) + dados)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporario, caminho)
+    fd = os.open(os.path.dirname(caminho) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return len(dados)
+
+
+def carregar_instantaneo(caminho):
+    """Lê o snapshot gravado por salvar_instantaneo (None se não existir ou estiver corrompido)"""
+    try:
+        with open(caminho, "rb") as f:
+            for _, dados in ler_registros(f, 0):
+                return msgpack.unpackb(dados, raw=False, strict_map_key=False)
+    except Exception:
+        pass
+    return None
+
+
+class CommitEmGrupo:
+    """fsync em grupo de um conjunto de logs (abertos sem fsync próprio).
+
+    Depois de anexar, quem escreveu chama registrar() e recebe um ticket: a
+    soma das próximas seqs dos logs. Uma thread faz um único fsync por log
+    para todas as escritas pendentes e avisa os interessados com o maior
+    ticket já em disco; as escritas que chegam durante um fsync esperam o
+    seguinte.
+    """
+
+    def __init__(self, logs, ao_confirmar=None, lote=COMMIT_LOTE, intervalo=COMMIT_INTERVALO):
+        self.logs = logs
+        self.ao_confirmar = ao_confirmar  # chamado com o ticket durável após cada fsync
+        self.lote = max(lote, 1)
+        self.intervalo = intervalo
+        self.condicao = threading.Condition()
+        self.duravel = self.ticket()  # maior ticket já em disco
+        self.pendentes = 0
+        self.commits = 0
+        threading.Thread(target=self._gravar, daemon=True).start()
+
+    def ticket(self):
+        return sum(log.proximo_seq for log in self.logs)
+
+    def registrar(self):
+        """Marca as escritas já anexadas para o próximo fsync; retorna o ticket"""
+        ticket = self.ticket()
+        if ticket <= self.duravel:
+            return ticket
+        with self.condicao:
+            self.pendentes += 1
+            if self.pendentes == 1 or self.pendentes >= self.lote:
+                self.condicao.notify()
+        return ticket
+
+    def _gravar(self):
+        espera = COMMIT_ESPERA_ERRO
+        falhas = 0
+        while True:
+            with self.condicao:
+                while self.pendentes == 0:
+                    self.condicao.wait()
+                if self.intervalo > 0 and self.pendentes < self.lote:
+                    # Junta mais escritas até o lote encher ou o prazo vencer
+                    self.condicao.wait(self.intervalo)
+                self.pendentes = 0
+            alvo = self.ticket()
+            try:
+                for log in self.logs:
+                    log.sincronizar()
+            except Exception as e:
+                falhas += 1
+                registrador.erro("Erro no commit em grupo (falha %d, nova tentativa em %.1fs): %s",
+                                 falhas, espera, e)
+                with self.condicao:
+                    self.pendentes += 1  # tenta de novo no próximo ciclo
+                time.sleep(espera)
+                espera = min(espera * 2, max(COMMIT_ESPERA_ERRO_MAX, COMMIT_ESPERA_ERRO))
+                continue
+            if falhas:
+                registrador.info("Commit em grupo normalizado depois de %d falhas", falhas)
+                espera = COMMIT_ESPERA_ERRO
+                falhas = 0
+            self.duravel = alvo
+            self.commits += 1
+            if self.ao_confirmar is not None:
+                self.ao_confirmar(alvo)
+
+
+class TravaEscritor:
+    """Designa um único processo escritor em um diretório compartilhado.
+
+    A trava é um flock no arquivo ESCRITOR, liberado pelo sistema quando o
+    processo termina; os outros tentam de novo periodicamente e um deles
+    assume o papel.
+    """
+
+    def __init__(self, diretorio, nome):
+        self.nome = nome
+        self._arquivo = open(os.path.join(diretorio, "ESCRITOR"), "a+")
+        self.escritor = False
+
+    def tentar(self):
+        """Tenta obter a trava sem bloquear; retorna se este processo é o escritor"""
+        if not self.escritor:
+            try:
+                fcntl.flock(self._arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            self.escritor = True
+            self._arquivo.truncate(0)
+            self._arquivo.write(f"{self.nome}\n")
+            self._arquivo.flush()
+        return True
+
+
+def migrar_json(caminho_json, log):
+    """Importa uma única vez o histórico de um arquivo JSON legado para o log.
+
+    Um marcador no diretório do log registra que a migração terminou; se o
+    processo cair no meio, a próxima execução continua de onde parou.
+    """
+    marcador = os.path.join(log.diretorio, "MIGRADO")
+    if os.path.exists(marcador):
+        return 0
+
+    with log.exclusivo():
+        # Outra réplica pode ter migrado enquanto esperávamos o lock
+        if os.path.exists(marcador):
+            return 0
+
+        registros = []
+        if os.path.exists(caminho_json):
+            try:
+                with open(caminho_json, "r", encoding="utf-8") as f:
+                    registros = json.load(f)
+            except:
+                registros = []
+
+        migrados = 0
+        for registro in registros[len(log):]:
+            log._anexar(msgpack.packb(registro))
+            migrados += 1
+        log._sincronizar()
+
+        with open(marcador, "w", encoding="utf-8") as f:
+            f.write(f"{caminho_json}\n")
+    return migrados
@@ -0,0 +1,473 @@
+"""Vazão e latência do caminho cliente → broker → servidores, com entrega
+pub/sub e atraso de replicação.
+
+Uso: python benchmarks/carga_bench.py [--servidores 3] [--clientes 64] [--duracao 20]
+         [--mix publish=40,message=20,users=15,channels=15,login=5,channel=5]
+         [--saida resultado.json] [--comparar anterior.json]
+
+Sobe servidor de referência, proxy, broker e N servidores como processos
+locais, sem Docker: todos em 127.0.0.1, o servidor k com portas próprias
+(anunciadas ao servidor de referência), um diretório de dados temporário e,
+com --cpus, um núcleo fixo. Variáveis de ambiente
+do shell (SERVIDOR_DURABILIDADE, BROKER_MODO...) valem para todos os
+processos. Clientes assíncronos (REQ, um por cliente) sorteiam serviços
+conforme o mix até o fim da duração; as latências do aquecimento ficam de
+fora. Um assinante mede a latência de entrega das publicações e mensagens
+(do envio pelo cliente até a chegada no SUB) e os servidores são
+consultados pelo serviço "stats" (porta de sincronização) para o atraso de replicação,
+em operações ainda não confirmadas, e o tempo para convergir depois da
+carga. O resultado é salvo em JSON para comparar entre versões.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+import zmq
+import zmq.asyncio
+import msgpack
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, RAIZ)
+from topicos import ler_cabecalho, ler_corpo
+from plano_controle import ClienteControle
+
+SERVICOS = ("login", "channel", "publish", "message", "users", "channels")
+MIX_PADRAO = "publish=40,message=20,users=15,channels=15,login=5,channel=5"
+CANAIS = [f"bench-canal-{i}" for i in range(8)]
+DESTINOS = [f"bench-destino-{i}" for i in range(8)]
+TIMEOUT = 5.0  # por requisição; sem resposta o cliente recria o socket
+
+
+def portas_shard(indice):
+    """(xsub, xpub) do shard, na sequência do docker-compose"""
+    if indice == 0:
+        return 5557, 5558
+    return 5580 + 2 * (indice - 1), 5581 + 2 * (indice - 1)
+
+
+def portas_servidor(indice):
+    """(sincronização, replicação, publicação, métricas) do servidor indice (1..N)"""
+    base = 6000 + 10 * indice
+    return base + 1, base + 2, base + 9, base + 8
+
+
+def ler_mix(texto):
+    mix = {}
+    for item in texto.split(","):
+        servico, peso = item.split("=")
+        if servico not in SERVICOS:
+            raise SystemExit(f"servico desconhecido no mix: {servico}")
+        mix[servico] = float(peso)
+    return mix
+
+
+def percentis(valores):
+    """p50/p99/p999 e média em ms de uma lista de segundos"""
+    if not valores:
+        return {}
+    valores = sorted(valores)
+    def p(fracao):
+        return round(valores[min(len(valores) - 1, int(len(valores) * fracao))] * 1000, 3)
+    return {"p50": p(0.5), "p99": p(0.99), "p999": p(0.999),
+            "media": round(sum(valores) / len(valores) * 1000, 3), "amostras": len(valores)}
+
+
+class Cluster:
+    """Processos locais do sistema, com logs e dados em um diretório temporário"""
+
+    def __init__(self, servidores, shards, diretorio, cpus=None):
+        self.diretorio = diretorio
+        self.shards = shards
+        self.cpus = cpus or []
+        self.nomes = [f"servidor-{k}" for k in range(1, servidores + 1)]
+        self.processos = []
+        self.ambiente = dict(os.environ, PYTHONUNBUFFERED="1", BROKER_HOST="127.0.0.1",
+                             REFERENCIA_HOST="127.0.0.1", PROXY_SHARDS=",".join(
+                                 "127.0.0.1:%d:%d" % portas_shard(i) for i in range(shards)))
+
+    def _iniciar(self, nome, script, **extra):
+        log = open(os.path.join(self.diretorio, f"{nome}.log"), "w")
+        processo = subprocess.Popen([sys.executable, os.path.join(RAIZ, script)],
+                                    env=dict(self.ambiente, **extra), cwd=self.diretorio,
+                                    stdout=log, stderr=subprocess.STDOUT)
+        self.processos.append((nome, processo))
+
+    def iniciar(self):
+        self._iniciar("referencia", "servidor_referencia.py")
+        self._iniciar("proxy", "proxy.py")
+        self._iniciar("broker", "broker.py")
+        for indice, nome in enumerate(self.nomes, 1):
+            sincronizacao, replicacao, publicacao, metricas = portas_servidor(indice)
+            extra = {}
+            if self.cpus:
+                extra["SERVIDOR_CPU"] = str(self.cpus[(indice - 1) % len(self.cpus)])
+            self._iniciar(nome, "servidor.py", SERVIDOR_NOME=nome, SERVIDOR_ESCUTA="127.0.0.1",
+                          SERVIDOR_ANUNCIADO="127.0.0.1", SERVIDOR_PORTA_SINCRONIZACAO=str(sincronizacao),
+                          SERVIDOR_PORTA_REPLICACAO=str(replicacao), SERVIDOR_PORTA_PUBLICACAO=str(publicacao),
+                          SERVIDOR_METRICAS_PORTA=str(metricas),
+                          SERVIDOR_DADOS=os.path.join(self.diretorio, f"dados-{nome}"), **extra)
+
+    def aguardar(self, prazo=30):
+        """Espera todos os servidores no servidor de referência e no broker"""
+        referencia = ClienteControle("tcp://127.0.0.1:5560")
+        limite = time.time() + prazo
+        while time.time() < limite:
+            for nome, processo in self.processos:
+                if processo.poll() is not None:
+                    raise SystemExit(f"{nome} terminou ao iniciar (ver {self.diretorio}/{nome}.log)")
+            try:
+                lista = referencia.chamar("list", {}, 1).get("data", {}).get("list", [])
+                broker = controle_broker("stats")
+            except zmq.Again:
+                continue
+            if len(lista) == len(self.nomes) and len(broker.get("servidores", [])) == len(self.nomes):
+                return
+            time.sleep(0.2)
+        raise SystemExit(f"cluster nao ficou pronto em {prazo}s (logs em {self.diretorio})")
+
+    def encerrar(self):
+        for _, processo in reversed(self.processos):
+            if processo.poll() is None:
+                processo.terminate()
+        for _, processo in self.processos:
+            try:
+                processo.wait(15)
+            except subprocess.TimeoutExpired:
+                processo.kill()
+
+
+def controle_broker(service):
+    """Requisição ao endpoint de controle do broker (porta 5591)"""
+    contexto = zmq.Context.instance()
+    socket = contexto.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.setsockopt(zmq.RCVTIMEO, 1000)
+    socket.connect("tcp://127.0.0.1:5591")
+    try:
+        socket.send(msgpack.packb({"service": service, "data": {}}))
+        return msgpack.unpackb(socket.recv(), raw=False).get("data", {})
+    finally:
+        socket.close()
+
+
+class Assinante:
+    """SUB em todos os shards: latência de entrega dos tópicos do benchmark"""
+
+    def __init__(self, shards):
+        self.socket = zmq.Context.instance().socket(zmq.SUB)
+        for i in range(shards):
+            self.socket.connect("tcp://127.0.0.1:%d" % portas_shard(i)[1])
+        self.topicos = set(CANAIS + DESTINOS)
+        for topico in self.topicos:
+            self.socket.setsockopt_string(zmq.SUBSCRIBE, topico)
+        self.latencias = []
+        self.recebidas = 0
+        self.inicio_medicao = None
+        self.ativo = True
+
+    def executar(self):
+        while self.ativo:
+            if not self.socket.poll(100):
+                continue
+            frames = self.socket.recv_multipart()
+            chegada = time.time()
+            try:
+                topico = ler_cabecalho(frames)[0]
+                corpo = ler_corpo(frames)
+            except ValueError:
+                continue
+            if topico not in self.topicos:
+                continue  # outro tópico com o mesmo prefixo
+            self.recebidas += 1
+            enviado = corpo.get("timestamp") or 0
+            if self.inicio_medicao is not None and enviado >= self.inicio_medicao:
+                self.latencias.append(chegada - enviado)
+        self.socket.close()
+
+
+class Replicacao:
+    """Amostras do que os servidores ainda não viram confirmado pelos outros"""
+
+    def __init__(self, nomes, intervalo=0.5):
+        self.clientes = {nome: ClienteControle("tcp://127.0.0.1:%d" % portas_servidor(indice)[0])
+                         for indice, nome in enumerate(nomes, 1)}
+        self.intervalo = intervalo
+        self.amostras = []  # operações pendentes somadas em todos os servidores
+        self.ativo = True
+
+    def pendentes(self):
+        """(total pendente, estatísticas por servidor)"""
+        total = 0
+        estatisticas = {}
+        for nome, cliente in self.clientes.items():
+            data = cliente.chamar("stats", {"clock": 0}, 2).get("data", {})
+            replicacao = data.get("replicacao", {})
+            total += sum(replicacao.get("fila", {}).values()) + replicacao.get("entrada", 0)
+            estatisticas[nome] = data
+        return total, estatisticas
+
+    def executar(self):
+        while self.ativo:
+            try:
+                self.amostras.append(self.pendentes()[0])
+            except zmq.Again:
+                pass
+            time.sleep(self.intervalo)
+
+    def convergir(self, prazo=30):
+        """Segundos até não restar replicação pendente, e as estatísticas finais"""
+        inicio = time.time()
+        estatisticas = {}
+        while time.time() - inicio < prazo:
+            try:
+                total, estatisticas = self.pendentes()
+            except zmq.Again:
+                continue
+            if total == 0:
+                return time.time() - inicio, estatisticas
+            time.sleep(0.05)
+        return None, estatisticas
+
+
+def dados_requisicao(service, cliente, n, tamanho):
+    mensagem = "x" * tamanho
+    if service == "login":
+        data = {"user": f"bench-{cliente}-{n}"}
+    elif service == "channel":
+        data = {"channel": f"bench-{cliente}-{n}"}
+    elif service == "publish":
+        data = {"user": f"bench-cliente-{cliente}", "channel": random.choice(CANAIS), "message": mensagem}
+    elif service == "message":
+        data = {"src": f"bench-cliente-{cliente}", "dst": random.choice(DESTINOS), "message": mensagem}
+    else:
+        data = {}
+    data["timestamp"] = time.time()
+    data["clock"] = 0
+    return {"service": service, "data": data}
+
+
+async def cliente(contexto, indice, mix, args, prazo, inicio_medicao, resultados):
+    servicos, pesos = list(mix), list(mix.values())
+
+    def conectar():
+        socket = contexto.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect("tcp://127.0.0.1:5555")
+        return socket
+
+    socket = conectar()
+    n = 0
+    while time.time() < prazo:
+        n += 1
+        service = random.choices(servicos, pesos)[0]
+        inicio = time.perf_counter()
+        await socket.send(msgpack.packb(dados_requisicao(service, indice, n, args.tamanho)))
+        try:
+            resposta = msgpack.unpackb(await asyncio.wait_for(socket.recv(), TIMEOUT), raw=False)
+        except asyncio.TimeoutError:
+            resultados["timeouts"][service] += 1
+            socket.close()
+            socket = conectar()
+            continue
+        decorrido = time.perf_counter() - inicio
+        if resposta.get("data", {}).get("status") == "erro":
+            resultados["erros"][service] += 1
+        elif service in ("publish", "message"):
+            resultados["entregas_esperadas"] += 1
+        if time.time() >= inicio_medicao:
+            resultados["latencias"][service].append(decorrido)
+    socket.close()
+
+
+async def preparar(contexto, clientes):
+    """Usuários e canais usados pela carga"""
+    socket = contexto.socket(zmq.REQ)
+    socket.connect("tcp://127.0.0.1:5555")
+    requisicoes = ([("login", {"user": u}) for u in DESTINOS] +
+                   [("login", {"user": f"bench-cliente-{i}"}) for i in range(clientes)] +
+                   [("channel", {"channel": c}) for c in CANAIS])
+    for service, data in requisicoes:
+        data.update(timestamp=time.time(), clock=0)
+        await socket.send(msgpack.packb({"service": service, "data": data}))
+        await asyncio.wait_for(socket.recv(), TIMEOUT)
+    socket.close()
+
+
+async def gerar_carga(args, mix, inicio_medicao, prazo):
+    contexto = zmq.asyncio.Context()
+    await preparar(contexto, args.clientes)
+    resultados = {"latencias": defaultdict(list), "erros": defaultdict(int),
+                  "timeouts": defaultdict(int), "entregas_esperadas": 0}
+    await asyncio.gather(*(cliente(contexto, i, mix, args, prazo, inicio_medicao, resultados)
+                           for i in range(args.clientes)))
+    contexto.term()
+    return resultados
+
+
+def versao():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=RAIZ,
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return None
+
+
+def executar(args):
+    mix = ler_mix(args.mix)
+    random.seed(args.semente)
+    diretorio = tempfile.mkdtemp(prefix="carga-bench-")
+    cpus = [int(cpu) for cpu in args.cpus.split(",")] if args.cpus else None
+    cluster = Cluster(args.servidores, args.shards, diretorio, cpus)
+    cluster.iniciar()
+    try:
+        cluster.aguardar()
+        assinante = Assinante(args.shards)
+        replicacao = Replicacao(cluster.nomes)
+        threading.Thread(target=assinante.executar, daemon=True).start()
+        threading.Thread(target=replicacao.executar, daemon=True).start()
+        time.sleep(0.5)  # inscrições chegando ao proxy
+
+        inicio = time.time()
+        inicio_medicao = assinante.inicio_medicao = inicio + args.aquecimento
+        prazo = inicio_medicao + args.duracao
+        carga = asyncio.run(gerar_carga(args, mix, inicio_medicao, prazo))
+        fim = time.time()
+
+        replicacao.ativo = False
+        convergencia, estatisticas_servidores = replicacao.convergir()
+        time.sleep(1)  # últimas entregas pub/sub
+        assinante.ativo = False
+        broker = controle_broker("stats")
+    finally:
+        cluster.encerrar()
+        if args.manter:
+            print(f"logs e dados em {diretorio}")
+        else:
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+    medidas = [v for valores in carga["latencias"].values() for v in valores]
+    total_erros = sum(carga["erros"].values())
+    total_timeouts = sum(carga["timeouts"].values())
+    return {
+        "versao": versao(),
+        "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parametros": {
+            "servidores": args.servidores, "clientes": args.clientes, "shards": args.shards,
+            "duracao": args.duracao, "aquecimento": args.aquecimento, "mix": mix,
+            "tamanho": args.tamanho, "semente": args.semente, "cpus": args.cpus,
+            "ambiente": {k: v for k, v in os.environ.items()
+                         if k.startswith(("SERVIDOR_", "BROKER_", "PROXY_", "REPLICACAO_"))},
+        },
+        "requisicoes": len(medidas),
+        "vazao": round(len(medidas) / args.duracao, 1),
+        "erros": total_erros,
+        "timeouts": total_timeouts,
+        "latencia_ms": percentis(medidas),
+        "por_servico": {
+            service: dict(percentis(carga["latencias"][service]),
+                          erros=carga["erros"][service], timeouts=carga["timeouts"][service])
+            for service in mix
+        },
+        "pubsub": {
+            "esperadas": carga["entregas_esperadas"],
+            "recebidas": assinante.recebidas,
+            "latencia_ms": percentis(assinante.latencias),
+        },
+        "replicacao": {
+            "pendentes_max": max(replicacao.amostras, default=0),
+            "pendentes_media": round(sum(replicacao.amostras) / max(len(replicacao.amostras), 1), 1),
+            "convergencia_s": None if convergencia is None else round(convergencia, 3),
+            "servidores": {nome: data.get("replicacao") for nome, data in estatisticas_servidores.items()},
+        },
+        "broker": broker,
+        "duracao_total_s": round(fim - inicio, 1),
+    }
+
+
+# (título, caminho no JSON, maior é melhor)
+METRICAS = [
+    ("vazao (req/s)", ("vazao",), True),
+    ("latencia p50 (ms)", ("latencia_ms", "p50"), False),
+    ("latencia p99 (ms)", ("latencia_ms", "p99"), False),
+    ("latencia p999 (ms)", ("latencia_ms", "p999"), False),
+    ("pub/sub p50 (ms)", ("pubsub", "latencia_ms", "p50"), False),
+    ("pub/sub p99 (ms)", ("pubsub", "latencia_ms", "p99"), False),
+    ("replicacao pendente max", ("replicacao", "pendentes_max"), False),
+    ("convergencia (s)", ("replicacao", "convergencia_s"), False),
+    ("erros", ("erros",), False),
+    ("timeouts", ("timeouts",), False),
+]
+
+
+def valor(resultado, caminho):
+    for chave in caminho:
+        resultado = (resultado or {}).get(chave)
+    return resultado
+
+
+def imprimir(resultado, anterior=None):
+    print(f"\n{resultado['requisicoes']} requisicoes em {resultado['parametros']['duracao']}s "
+          f"({resultado['parametros']['servidores']} servidores, {resultado['parametros']['clientes']} clientes)")
+    cabecalho = f"{'':26}{'agora':>12}"
+    if anterior:
+        cabecalho += f"{'antes':>12}{'variacao':>10}"
+    print(cabecalho)
+    for titulo, caminho, maior_melhor in METRICAS:
+        atual = valor(resultado, caminho)
+        linha = f"{titulo:26}{str(atual):>12}"
+        if anterior:
+            antes = valor(anterior, caminho)
+            linha += f"{str(antes):>12}"
+            if isinstance(atual, (int, float)) and isinstance(antes, (int, float)) and antes:
+                variacao = (atual - antes) / antes * 100
+                linha += f"{variacao:>+9.1f}%"
+                if variacao:
+                    linha += " melhor" if (variacao > 0) == maior_melhor else " pior"
+        print(linha)
+    print(f"\n{'servico':12}{'p50':>10}{'p99':>10}{'p999':>10}{'amostras':>10}{'erros':>8}")
+    for service, medidas in resultado["por_servico"].items():
+        print(f"{service:12}{str(medidas.get('p50')):>10}{str(medidas.get('p99')):>10}"
+              f"{str(medidas.get('p999')):>10}{str(medidas.get('amostras', 0)):>10}"
+              f"{medidas['erros'] + medidas['timeouts']:>8}")
+    pubsub = resultado["pubsub"]
+    print(f"\npub/sub: {pubsub['recebidas']} entregas de {pubsub['esperadas']} publicacoes/mensagens aceitas")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servidores", type=int, default=3)
+    parser.add_argument("--clientes", type=int, default=64)
+    parser.add_argument("--shards", type=int, default=1, help="shards do proxy")
+    parser.add_argument("--duracao", type=float, default=20, help="segundos medidos")
+    parser.add_argument("--aquecimento", type=float, default=2, help="segundos iniciais não medidos")
+    parser.add_argument("--mix", default=MIX_PADRAO, help="serviço=peso separados por vírgula")
+    parser.add_argument("--tamanho", type=int, default=64, help="bytes do texto de publish/message")
+    parser.add_argument("--semente", type=int, default=1)
+    parser.add_argument("--cpus", help="CPUs para os servidores, uma por servidor em rodízio (ex.: 2,3,4)")
+    parser.add_argument("--saida", help="arquivo JSON do resultado (padrão: carga-<data>.json)")
+    parser.add_argument("--comparar", help="resultado JSON anterior para comparar")
+    parser.add_argument("--manter", action="store_true", help="mantém logs e dados dos processos")
+    args = parser.parse_args()
+
+    resultado = executar(args)
+    anterior = None
+    if args.comparar:
+        with open(args.comparar) as arquivo:
+            anterior = json.load(arquivo)
+    imprimir(resultado, anterior)
+    saida = args.saida or time.strftime("carga-%Y%m%d-%H%M%S.json")
+    with open(saida, "w") as arquivo:
+        json.dump(resultado, arquivo, indent=2, default=str)
+    print(f"\nresultado salvo em {saida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Custo por requisição de decodificar o pedido e codificar a resposta.
+
+Uso: python benchmarks/codec_bench.py [requisicoes]
+
+Compara o caminho antigo do servidor (tenta MessagePack, cai para JSON por
+exceção, imprime o formato e monta a resposta como dicionário novo) com o
+de codec.py (formato pelo primeiro byte, Packer por thread e modelo de
+resposta), para pedidos em MessagePack e em JSON como os do cliente C. As
+impressões do caminho antigo vão para os.devnull, então o número não inclui
+o custo do terminal. Antes de medir, confere que as duas respostas
+decodificam para o mesmo conteúdo.
+"""
+import os
+import sys
+import json
+import time
+import msgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from codec import decodificar, codificar, resposta_modelo
+
+PEDIDO = {"service": "publish",
+          "data": {"user": "ana", "channel": "geral", "message": "x" * 64,
+                   "timestamp": 1700000000.123, "clock": 1234}}
+
+NULO = open(os.devnull, "w")
+
+
+def antigo(request_data, timestamp, clock):
+    """Caminho de servidor.py antes de codec.py"""
+    print(f"[S] Recebido {len(request_data)} bytes", file=NULO, flush=True)
+    formato_json = False
+    try:
+        request = msgpack.unpackb(request_data, raw=False)
+        print(f"[S] Formato: MessagePack", file=NULO, flush=True)
+    except:
+        try:
+            request = json.loads(request_data.decode('utf-8'))
+            formato_json = True
+            print(f"[S] Formato: JSON", file=NULO, flush=True)
+            print(f"[S] Request: {request}", file=NULO, flush=True)
+        except Exception as e:
+            request = {}
+    service = request.get("service", request.get("opcao"))
+    reply = {
+        "service": service,
+        "data": {
+            "status": "OK",
+            "timestamp": timestamp,
+            "clock": clock
+        }
+    }
+    if formato_json:
+        return json.dumps(reply).encode('utf-8')
+    return msgpack.packb(reply)
+
+
+def novo(request_data, timestamp, clock):
+    """Caminho com codec.py"""
+    request, formato_json = decodificar(request_data)
+    return codificar(resposta_modelo(request.get("service"), timestamp, clock, formato_json,
+                                    status="OK"), formato_json)
+
+
+def medir(funcao, dados, requisicoes):
+    """ns por requisição"""
+    inicio = time.perf_counter_ns()
+    for i in range(requisicoes):
+        funcao(dados, 1700000000.5, i)
+    return (time.perf_counter_ns() - inicio) / requisicoes
+
+
+def ler(dados):
+    return json.loads(dados) if dados[:1] == b"{" else msgpack.unpackb(dados, raw=False)
+
+
+def main():
+    requisicoes = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    formatos = [("MessagePack", msgpack.packb(PEDIDO)),
+                ("JSON", json.dumps(PEDIDO).encode("utf-8"))]
+    for nome, dados in formatos:
+        esperado = ler(antigo(dados, 1700000000.5, 1 << 40))
+        obtido = ler(novo(dados, 1700000000.5, 1 << 40))
+        assert obtido == esperado, (nome, obtido, esperado)
+
+    print(f"ns por requisicao (decodificar + responder), {requisicoes} requisicoes")
+    print(f"{'':14}{'antigo':>10}{'codec':>10}{'ganho':>8}")
+    for nome, dados in formatos:
+        medir(novo, dados, 1000)  # aquecimento
+        ns_antigo = medir(antigo, dados, requisicoes)
+        ns_novo = medir(novo, dados, requisicoes)
+        print(f"{nome:14}{ns_antigo:>10.0f}{ns_novo:>10.0f}{ns_antigo / ns_novo:>7.1f}x", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Custo das métricas de metricas.py por requisição.
+
+Uso: python benchmarks/metricas_bench.py [requisicoes] [threads]
+
+Mede isoladamente o que o trabalhador do servidor faz a mais por
+requisição (dois perf_counter e a anotação em Amostras), com uma thread e
+com várias, ao lado do custo de contar direto com Contador.inc e
+Histograma.observar e do custo de drenar cada evento fora da requisição.
+Depois compara uma ida e volta REQ/REP por TCP local que decodifica o
+pedido e monta a resposta com codec.py, com e sem as métricas (com a thread
+de drenagem rodando). As rodadas com e sem métricas alternam e vale a
+mediana, para o ruído da máquina não pesar mais que a diferença.
+"""
+import os
+import sys
+import time
+import statistics
+import threading
+from collections import Counter
+import msgpack
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from codec import decodificar, codificar, resposta_modelo
+from metricas import Contador, Histograma, Amostras
+
+PEDIDO = msgpack.packb({"service": "publish",
+                        "data": {"user": "ana", "channel": "geral", "message": "x" * 64,
+                                 "timestamp": 1700000000.123, "clock": 1234}})
+
+requisicoes_total = Contador("bench_requisicoes_total", "Requisicoes", ("servico", "formato"))
+requisicao_segundos = Histograma("bench_requisicao_segundos", "Tempo de processamento",
+                                 ("servico",))
+
+
+def contar(eventos):
+    """Como contar_requisicoes() do servidor"""
+    for (servico, formato), quantidade in Counter(evento[:2] for evento in eventos).items():
+        requisicoes_total.inc(servico, formato, valor=quantidade)
+    duracoes = {}
+    for servico, _, duracao in eventos:
+        duracoes.setdefault(servico, []).append(duracao)
+    for servico, valores in duracoes.items():
+        requisicao_segundos.observar_varios(valores, servico)
+
+
+amostras = Amostras(contar)
+
+
+def instrumentar(anotar, servico="publish", formato="msgpack"):
+    """O que processar_requisicao() faz a mais com as métricas"""
+    inicio = time.perf_counter()
+    anotar((servico, formato, time.perf_counter() - inicio))
+
+
+def instrumentar_direto(anotar, servico="publish", formato="msgpack"):
+    """Contagem na própria requisição, sem Amostras"""
+    inicio = time.perf_counter()
+    requisicoes_total.inc(servico, formato)
+    requisicao_segundos.observar(time.perf_counter() - inicio, servico)
+
+
+def custo_isolado(requisicoes, threads, funcao=instrumentar):
+    """ns por chamada de funcao(), com `threads` threads chamando juntas"""
+    def laco():
+        anotar = amostras.anotador()
+        for _ in range(requisicoes):
+            funcao(anotar)
+
+    trabalhadores = [threading.Thread(target=laco) for _ in range(threads)]
+    inicio = time.perf_counter_ns()
+    for trabalhador in trabalhadores:
+        trabalhador.start()
+    for trabalhador in trabalhadores:
+        trabalhador.join()
+    return (time.perf_counter_ns() - inicio) / (requisicoes * threads)
+
+
+def custo_drenagem(requisicoes):
+    """ns por evento para passar as anotações aos contadores, fora da requisição"""
+    anotar = amostras.anotador()
+    amostras.drenar()
+    for _ in range(requisicoes):
+        anotar(("publish", "msgpack", 0.0003))
+    inicio = time.perf_counter_ns()
+    amostras.drenar()
+    return (time.perf_counter_ns() - inicio) / requisicoes
+
+
+def responder(socket, com_metricas):
+    anotar = amostras.anotador()
+    while True:
+        dados = socket.recv()
+        if dados == b"fim":
+            socket.send(b"fim")
+            return
+        inicio = time.perf_counter()
+        request, formato_json = decodificar(dados)
+        servico = request.get("service")
+        reply = codificar(resposta_modelo(servico, 1700000000.5, 1, formato_json, status="OK"),
+                          formato_json)
+        if com_metricas:
+            anotar((servico, "json" if formato_json else "msgpack", time.perf_counter() - inicio))
+        socket.send(reply)
+
+
+def ida_e_volta(contexto, requisicoes, com_metricas):
+    """ns por requisição REQ/REP com o servidor em outra thread"""
+    servidor = contexto.socket(zmq.REP)
+    porta = servidor.bind_to_random_port("tcp://127.0.0.1")
+    thread = threading.Thread(target=responder, args=(servidor, com_metricas))
+    thread.start()
+    cliente = contexto.socket(zmq.REQ)
+    cliente.connect(f"tcp://127.0.0.1:{porta}")
+    for _ in range(200):  # aquecimento
+        cliente.send(PEDIDO)
+        cliente.recv()
+    inicio = time.perf_counter_ns()
+    for _ in range(requisicoes):
+        cliente.send(PEDIDO)
+        cliente.recv()
+    ns = (time.perf_counter_ns() - inicio) / requisicoes
+    cliente.send(b"fim")
+    cliente.recv()
+    thread.join()
+    cliente.close(linger=0)
+    servidor.close(linger=0)
+    return ns
+
+
+def main():
+    requisicoes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    custo_isolado(1000, 1)  # aquecimento
+    isolado = custo_isolado(requisicoes * 10, 1)
+    concorrente = custo_isolado(requisicoes * 10 // threads, threads)
+    direto = custo_isolado(requisicoes * 10, 1, instrumentar_direto)
+    drenagem = custo_drenagem(requisicoes * 10)
+    print(f"instrumentacao por requisicao: {isolado:.0f} ns (1 thread), "
+          f"{concorrente:.0f} ns ({threads} threads)")
+    print(f"contando direto na requisicao: {direto:.0f} ns; "
+          f"drenagem fora da requisicao: {drenagem:.0f} ns por evento")
+
+    contexto = zmq.Context()
+    sem, com = [], []
+    for _ in range(5):
+        sem.append(ida_e_volta(contexto, requisicoes, False))
+        com.append(ida_e_volta(contexto, requisicoes, True))
+    contexto.term()
+    ns_sem, ns_com = statistics.median(sem), statistics.median(com)
+    print(f"ida e volta REQ/REP, {requisicoes} requisicoes, mediana de 5 rodadas")
+    print(f"{'sem metricas':16}{ns_sem:>10.0f} ns")
+    print(f"{'com metricas':16}{ns_com:>10.0f} ns")
+    print(f"{'diferenca':16}{(ns_com - ns_sem) / ns_sem * 100:>9.2f} %")
+    print(f"{'custo isolado':16}{isolado / ns_sem * 100:>9.2f} % da ida e volta")
+
+
+if __name__ == "__main__":
+    main()
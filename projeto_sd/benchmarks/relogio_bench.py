@@ -0,0 +1,106 @@
+"""Custo de tick/update dos relógios com N threads disputando o mesmo relógio.
+
+Uso: python benchmarks/relogio_bench.py [operacoes_por_thread] [threads,...]
+
+Para cada implementação mede ns por operação (média de todas as threads) e
+confere a saída: valores repetidos entre threads e valores que voltaram
+dentro de uma mesma thread. Com updates, repetições entre eventos
+concorrentes são admitidas pelo relógio de Lamport; regressões nunca. O
+relógio antigo, sem trava, entra como referência.
+"""
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from relogio import RelogioLogico, RelogioHibrido
+
+
+class RelogioSemTrava:
+    """Implementação anterior (servidor.py), só para comparação"""
+
+    def __init__(self):
+        self.clock = 0
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def update(self, clock_recebido):
+        self.clock = max(self.clock, clock_recebido)
+        return self.clock
+
+
+class RelogioComTrava(RelogioSemTrava):
+    """Mesma lógica com um Lock em cada operação"""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def tick(self):
+        with self.lock:
+            return super().tick()
+
+    def update(self, clock_recebido):
+        with self.lock:
+            return super().update(clock_recebido)
+
+
+def medir(fabrica, threads, operacoes, updates):
+    """(ns por operação, repetidos, regressões) com updates a cada 1/updates operações"""
+    relogio = fabrica()
+    saidas = [None] * threads
+    barreira = threading.Barrier(threads + 1)
+
+    def trabalhar(indice):
+        tick, update = relogio.tick, relogio.update
+        valores = []
+        anexar = valores.append
+        barreira.wait()
+        for i in range(operacoes):
+            if updates and i % updates == 0:
+                # Recebido um pouco à frente, como de outra réplica mais adiantada
+                anexar(update(valores[-1] + 5 if valores else 5))
+            else:
+                anexar(tick())
+        saidas[indice] = valores
+
+    trabalhadores = [threading.Thread(target=trabalhar, args=(i,)) for i in range(threads)]
+    for t in trabalhadores:
+        t.start()
+    barreira.wait()
+    inicio = time.perf_counter()
+    for t in trabalhadores:
+        t.join()
+    decorrido = time.perf_counter() - inicio
+
+    regressoes = sum(1 for valores in saidas for a, b in zip(valores, valores[1:]) if b <= a)
+    ticks = [v for valores in saidas for v in valores]
+    repetidos = len(ticks) - len(set(ticks))
+    return decorrido / (threads * operacoes) * 1e9, repetidos, regressoes
+
+
+def main():
+    operacoes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    contagens = [int(n) for n in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 2, 4, 8, 16]
+    implementacoes = [
+        ("sem trava (antigo)", RelogioSemTrava),
+        ("Lock", RelogioComTrava),
+        ("RelogioLogico", RelogioLogico),
+        ("RelogioHibrido", RelogioHibrido),
+    ]
+    for titulo, updates in (("so tick", 0), ("tick + 10% update", 10)):
+        print(f"\n{titulo}: ns/op (repetidos/regressoes), {operacoes} operacoes por thread")
+        print(f"{'':20}" + "".join(f"{f'{n} threads':>22}" for n in contagens))
+        for nome, fabrica in implementacoes:
+            linha = f"{nome:20}"
+            for n in contagens:
+                ns, repetidos, regressoes = medir(fabrica, n, operacoes, updates)
+                linha += f"{f'{ns:.0f} ({repetidos}/{regressoes})':>22}"
+            print(linha, flush=True)
+
+
+if __name__ == "__main__":
+    main()
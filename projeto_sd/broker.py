@@ -1,20 +1,460 @@
+import sys
+from configuracao import configurar
+if __name__ == "__main__":
+    # Antes dos outros imports do projeto, que leem as opções ao carregar
+    configurar(sys.argv[1:])
+import time
+import zlib
+import signal
+import threading
+from collections import deque
 import zmq
+from codec import decodificar
+from metricas import Contador, Medidor, Histograma, Amostras, servir as servir_metricas
+from monitoramento import Contadores, Captura, ProxyControlado, responder_controle
+from configuracao import obter, fixar_cpu, BROKER_PORTA_CLIENTES, BROKER_PORTA_SERVIDORES
+
+# "balanceado": só entrega requisições a servidores livres (padrão)
+# "proxy": zmq.proxy ROUTER/DEALER com round-robin cego
+BROKER_MODO = obter("BROKER_MODO", "balanceado")
+
+# Sinais trocados com os servidores no modo balanceado (mesmos valores em servidor.py)
+SINAL_PRONTO = b"\x01"
+SINAL_HEARTBEAT = b"\x02"
+SINAL_REANUNCIAR = b"\x03"
+SINAL_ADIADA = b"\x04"  # resposta de um trabalhador que já devolveu o crédito
+
+# Destino das escritas no modo balanceado:
+# "chave": hash consistente do canal/usuário entre os servidores (padrão)
+# "dono": todas as escritas vão para um único servidor
+# "qualquer": escritas tratadas como leituras (servidor menos carregado)
+BROKER_ESCRITAS = obter("BROKER_ESCRITAS", "chave")
+
+# Limite de requisições paradas à espera do servidor dono da chave
+FILA_MAX = int(obter("BROKER_FILA_MAX", 1000))
+
+# Serviços de escrita: (tipo da chave, campo com o valor). Cadastro e
+# publicações de um canal têm o mesmo dono, assim como login e mensagens
+# privadas para um usuário.
+CHAVES_ESCRITA = {
+    "login": ("user", "user"),
+    "channel": ("channel", "channel"),
+    "publish": ("channel", "channel"),
+    "message": ("user", "dst"),
+}
+
+# Servidor sem sinal de vida por INTERVALO * VIVACIDADE segundos sai do rodízio
+HEARTBEAT_INTERVALO = float(obter("BROKER_HEARTBEAT_INTERVALO", 1.0))
+HEARTBEAT_VIVACIDADE = int(obter("BROKER_HEARTBEAT_VIVACIDADE", 3))
+
+# Endpoint REQ/REP de estatísticas e controle (stats, pause, resume, terminate)
+CONTROLE_PORTA = int(obter("BROKER_CONTROLE_PORTA", 5591))
+
+# Intervalo para imprimir os contadores
+ESTATISTICAS_INTERVALO = float(obter("BROKER_ESTATISTICAS_INTERVALO", 30))
+
+# Encerramento gracioso (terminate ou SIGTERM): para de aceitar requisições
+# e espera as que estão nos servidores por até DRENAR_TIMEOUT segundos
+DRENAR_TIMEOUT = float(obter("BROKER_DRENAR_TIMEOUT", 10))
+
+# Modo proxy: cópia do tráfego para contar por serviço (0 desliga)
+CAPTURA = obter("BROKER_CAPTURA", "1") == "1"
+
+# CPUs deste processo ("2" ou "0,1"); vazio usa todas
+CPU = fixar_cpu("BROKER_CPU")
+
+# Métricas no formato do Prometheus em GET /metrics nessa porta (0 desliga)
+METRICAS_PORTA = int(obter("BROKER_METRICAS_PORTA", 9102))
+
+# Serviços fora da lista contam como "outro" nas métricas
+SERVICOS = set(CHAVES_ESCRITA) | {"users", "listar", "channels", "history", "inbox"}
+
+# Uma requisição sem resposta nesse tempo deixa de ser acompanhada na latência
+LATENCIA_PRAZO = 60
+
+requisicoes_metrica = Contador("broker_requisicoes_total", "Requisicoes recebidas dos clientes", ("servico",))
+respostas_metrica = Contador("broker_respostas_total", "Respostas entregues aos clientes")
+latencia_metrica = Histograma("broker_requisicao_segundos",
+                              "Da chegada da requisicao no broker a saida da resposta", ("servico",))
+removidos_metrica = Contador("broker_servidores_removidos_total", "Servidores removidos sem heartbeat")
+servidores_metrica = Medidor("broker_servidores", "Servidores no rodizio")
+em_andamento_metrica = Medidor("broker_em_andamento", "Requisicoes entregues e ainda sem resposta")
+fila_metrica = Medidor("broker_fila", "Escritas a espera do servidor dono da chave")
+
+
+def contar_eventos(eventos):
+    """[(serviço, None)] na chegada ou [(serviço, segundos)] na resposta; o
+    serviço da resposta é None se a chegada já saiu de inicios"""
+    duracoes = {}
+    for servico, duracao in eventos:
+        if duracao is None:
+            requisicoes_metrica.inc(servico)
+        else:
+            duracoes.setdefault(servico, []).append(duracao)
+    for servico, valores in duracoes.items():
+        respostas_metrica.inc(valor=len(valores))
+        if servico is not None:
+            latencia_metrica.observar_varios(valores, servico)
+
+
+# O laço do broker só anota; a contagem sai do caminho da requisição
+eventos_amostras = Amostras(contar_eventos)
+
+encerrar = threading.Event()
+
+
+class Servidor:
+    """Um servidor conectado ao broker e sua carga atual"""
+
+    def __init__(self, identidade):
+        self.identidade = identidade
+        self.creditos = 0       # trabalhadores livres anunciados pelo servidor
+        self.em_andamento = 0   # requisições entregues e ainda sem resposta
+        self.ultimo_uso = 0.0
+        self.fila = deque()     # escritas à espera de crédito deste servidor
+        self.renovar()
+
+    def renovar(self):
+        self.expira = time.time() + HEARTBEAT_INTERVALO * HEARTBEAT_VIVACIDADE
+
+
+def escolher_servidor(servidores):
+    """Servidor livre com menos requisições em andamento (o menos usado recentemente no empate)"""
+    livres = [s for s in servidores.values() if s.creditos > 0]
+    if not livres:
+        return None
+    return min(livres, key=lambda s: (s.em_andamento, s.ultimo_uso))
+
+
+def classificar(requisicao):
+    """(serviço, chave de roteamento) de uma requisição (msgpack ou JSON).
+
+    A chave é None para leituras e requisições que não dá para interpretar,
+    que podem ser atendidas por qualquer servidor.
+    """
+    try:
+        request, _ = decodificar(requisicao)
+        service = request.get("service", request.get("opcao"))
+        if service not in CHAVES_ESCRITA:
+            return service, None
+        data = request.get("data", request.get("dados")) or {}
+        tipo, campo = CHAVES_ESCRITA[service]
+        return service, f"{tipo}:{data.get(campo)}"
+    except:
+        return None, None
+
+
+def chave_escrita(requisicao):
+    return classificar(requisicao)[1]
+
+
+def dono_da_escrita(chave, servidores):
+    """Servidor responsável pela chave (rendezvous hashing sobre os nomes)
+
+    Se um servidor sai, só as chaves dele mudam de dono.
+    """
+    if not servidores:
+        return None
+    if BROKER_ESCRITAS == "dono":
+        return servidores[min(servidores)]
+    chave = chave.encode("utf-8")
+    return max(servidores.values(), key=lambda s: zlib.crc32(s.identidade + b"|" + chave))
+
+
+def entregar(server_socket, servidor, frames):
+    servidor.creditos -= 1
+    servidor.em_andamento += 1
+    servidor.ultimo_uso = time.time()
+    server_socket.send_multipart([servidor.identidade] + frames)
+
+
+def balanceador(client_socket, server_socket, controle_socket):
+    """Entrega cada requisição a um servidor que anunciou um trabalhador livre.
+
+    Cada SINAL_PRONTO (ou resposta) de um servidor vale um crédito; sem
+    créditos o broker para de ler dos clientes e as requisições esperam na
+    fila do ROUTER. Heartbeats nos dois sentidos tiram do rodízio os
+    servidores que pararam de responder, e um servidor desconhecido (que
+    conectou antes de o broker reiniciar) é chamado a reanunciar os livres.
+
+    Leituras vão para o servidor livre menos carregado; escritas vão para o
+    dono da chave (canal ou usuário) e esperam na fila dele se estiver ocupado.
+
+    Pausado, o broker não lê dos clientes; encerrando, também não lê e sai
+    quando as requisições em andamento e as filas terminam.
+    """
+    servidores = {}  # {identidade: Servidor}
+    aguardando = 0   # total de escritas nas filas dos servidores
+    requisicoes = Contadores()  # por serviço
+    respostas = Contadores()
+    pausado = False
+    prazo_drenar = None
+    inicios = {}  # {cliente: (perf_counter da chegada, serviço)} para a latência
+    anotar = eventos_amostras.anotador()
+
+    def respondido(cliente):
+        inicio = inicios.pop(cliente, None)
+        if inicio is None:
+            anotar((None, 0.0))
+        else:
+            anotar((inicio[1], time.perf_counter() - inicio[0]))
+
+    def tratar_controle(service, data):
+        nonlocal pausado
+        if service == "stats":
+            return {
+                "modo": BROKER_MODO,
+                "pausado": pausado,
+                "encerrando": encerrar.is_set(),
+                "requisicoes": requisicoes.estatisticas(),
+                "respostas": respostas.estatisticas(),
+                "aguardando": aguardando,
+                "servidores": [{
+                    "nome": s.identidade.decode("utf-8", "replace"),
+                    "creditos": s.creditos,
+                    "em_andamento": s.em_andamento,
+                    "fila": len(s.fila),
+                } for s in servidores.values()],
+            }
+        if service == "pause":
+            pausado = True
+            return {}
+        if service == "resume":
+            pausado = False
+            return {}
+        if service == "terminate":
+            encerrar.set()
+            return {}
+        raise KeyError(service)
+
+    poller_servidores = zmq.Poller()
+    poller_servidores.register(server_socket, zmq.POLLIN)
+    poller_servidores.register(controle_socket, zmq.POLLIN)
+    poller_todos = zmq.Poller()
+    poller_todos.register(server_socket, zmq.POLLIN)
+    poller_todos.register(client_socket, zmq.POLLIN)
+    poller_todos.register(controle_socket, zmq.POLLIN)
+
+    proximo_heartbeat = time.time() + HEARTBEAT_INTERVALO
+    proxima_amostra = time.time() + ESTATISTICAS_INTERVALO
+    anterior = None
+
+    while True:
+        if encerrar.is_set():
+            if prazo_drenar is None:
+                prazo_drenar = time.time() + DRENAR_TIMEOUT
+                print("[BROKER] Encerrando: aguardando as requisicoes em andamento", flush=True)
+            em_andamento = sum(s.em_andamento for s in servidores.values())
+            if (em_andamento == 0 and aguardando == 0) or time.time() > prazo_drenar:
+                print(f"[BROKER] Encerrado ({em_andamento} em andamento, {aguardando} na fila)", flush=True)
+                return
+        disponivel = (not pausado and not encerrar.is_set() and aguardando < FILA_MAX
+                      and any(s.creditos > 0 for s in servidores.values()))
+        espera = max(0, min(proximo_heartbeat, proxima_amostra) - time.time()) * 1000
+        if encerrar.is_set():
+            espera = min(espera, 100)
+        socks = dict((poller_todos if disponivel else poller_servidores).poll(espera))
+
+        if controle_socket in socks:
+            responder_controle(controle_socket, tratar_controle)
+
+        if server_socket in socks:
+            # [servidor, b"", sinal] ou [servidor, cliente, b"", resposta]
+            frames = server_socket.recv_multipart()
+            identidade = frames[0]
+            servidor = servidores.get(identidade)
+            if servidor is None:
+                servidor = servidores[identidade] = Servidor(identidade)
+                print(f"[BROKER] Servidor conectado ({len(servidores)} no rodizio)", flush=True)
+                if frames[1:] != [b"", SINAL_REANUNCIAR]:
+                    # Servidor que já existia (ex.: broker reiniciado): pede que anuncie os livres
+                    server_socket.send_multipart([identidade, b"", SINAL_REANUNCIAR])
+            servidor.renovar()
+
+            if frames[1] == b"":
+                if frames[2:] == [SINAL_PRONTO]:
+                    servidor.creditos += 1
+                elif frames[2:] == [SINAL_REANUNCIAR]:
+                    # O servidor vai anunciar de novo todos os trabalhadores livres
+                    servidor.creditos = 0
+                elif frames[2] == SINAL_ADIADA:
+                    # [servidor, b"", ADIADA, cliente, b"", resposta]: escrita já em disco
+                    servidor.em_andamento = max(0, servidor.em_andamento - 1)
+                    client_socket.send_multipart(frames[3:])
+                    respostas.contar(None, len(frames[-1]))
+                    respondido(frames[3])
+            else:
+                servidor.creditos += 1
+                servidor.em_andamento = max(0, servidor.em_andamento - 1)
+                client_socket.send_multipart(frames[1:])
+                respostas.contar(None, len(frames[-1]))
+                respondido(frames[1])
+
+        if client_socket in socks:
+            # [cliente, b"", requisição]
+            frames = client_socket.recv_multipart()
+            service, chave = classificar(frames[-1])
+            requisicoes.contar(service, len(frames[-1]))
+            servico = service if service in SERVICOS else "outro"
+            anotar((servico, None))
+            inicios[frames[0]] = (time.perf_counter(), servico)
+            if BROKER_ESCRITAS == "qualquer":
+                chave = None
+            if chave is None:
+                entregar(server_socket, escolher_servidor(servidores), frames)
+            else:
+                servidor = dono_da_escrita(chave, servidores)
+                if servidor.creditos > 0 and not servidor.fila:
+                    entregar(server_socket, servidor, frames)
+                else:
+                    servidor.fila.append(frames)
+                    aguardando += 1
+
+        agora = time.time()
+        if agora >= proximo_heartbeat:
+            for identidade, servidor in list(servidores.items()):
+                if agora > servidor.expira:
+                    del servidores[identidade]
+                    removidos_metrica.inc()
+                    print(f"[BROKER] Servidor sem heartbeat removido "
+                          f"({servidor.em_andamento} requisicoes perdidas, {len(servidores)} no rodizio)", flush=True)
+                    # As escritas que esperavam por ele passam para o novo dono da chave
+                    aguardando -= len(servidor.fila)
+                    for frames in servidor.fila:
+                        novo = dono_da_escrita(chave_escrita(frames[-1]), servidores)
+                        if novo is not None:
+                            novo.fila.append(frames)
+                            aguardando += 1
+                else:
+                    server_socket.send_multipart([identidade, b"", SINAL_HEARTBEAT])
+            proximo_heartbeat = agora + HEARTBEAT_INTERVALO
+            servidores_metrica.definir(len(servidores))
+            em_andamento_metrica.definir(sum(s.em_andamento for s in servidores.values()))
+            fila_metrica.definir(aguardando)
+            # Requisições perdidas (servidor removido, cliente que desistiu)
+            limite = time.perf_counter() - LATENCIA_PRAZO
+            for cliente in [c for c, (inicio, _) in inicios.items() if inicio < limite]:
+                del inicios[cliente]
+
+        if agora >= proxima_amostra:
+            requisicoes.amostrar()
+            atual = (requisicoes.mensagens, respostas.mensagens)
+            if atual != anterior:
+                print(f"[BROKER] {requisicoes.mensagens} requisicoes ({requisicoes.bytes} bytes), "
+                      f"{respostas.mensagens} respostas ({respostas.bytes} bytes), {aguardando} na fila, "
+                      f"mais ativos {requisicoes.taxas[:3]}", flush=True)
+                anterior = atual
+            proxima_amostra = agora + ESTATISTICAS_INTERVALO
+
+        # Crédito novo atende primeiro as escritas que esperavam o servidor
+        for servidor in servidores.values():
+            while servidor.fila and servidor.creditos > 0:
+                entregar(server_socket, servidor, servidor.fila.popleft())
+                aguardando -= 1
+
+
+def servico_da_mensagem(frames):
+    # Requisições e respostas passam pela captura; as duas têm "service"
+    return classificar(frames[-1])[0]
+
+
+def proxy_instrumentado(context, client_socket, server_socket, controle_socket):
+    """zmq.proxy_steerable com captura; o socket de controle TCP é atendido aqui.
+
+    Pausado, o proxy para de repassar nos dois sentidos. Neste modo não há
+    como parar de ler só os clientes, então terminate encerra na hora, sem
+    esperar as requisições em andamento.
+    """
+    captura = None
+    if CAPTURA:
+        captura = Captura(context, "broker", servico_da_mensagem)
+        captura.iniciar()
+        # Só a captura é lida na coleta: o socket de controle do proxy é desta thread
+        Contador("broker_proxy_mensagens_total", "Requisicoes e respostas copiadas pela captura",
+                 funcao=lambda: captura.estatisticas()["mensagens"])
+        Contador("broker_proxy_bytes_total", "Bytes de requisicoes e respostas copiados pela captura",
+                 funcao=lambda: captura.estatisticas()["bytes"])
+    proxy = ProxyControlado(context, "broker", client_socket, server_socket,
+                            captura.socket if captura else None)
+    proxy.iniciar()
+
+    def tratar_controle(service, data):
+        if service == "stats":
+            contadores = proxy.estatisticas()
+            estatisticas = {
+                "modo": BROKER_MODO,
+                "pausado": proxy.pausado,
+                "proxy": contadores,
+                # frames [cliente, b"", mensagem] no ROUTER dos clientes
+                "requisicoes": contadores["frontend_recebidos"] // 3,
+                "respostas": contadores["frontend_enviados"] // 3,
+            }
+            if captura is not None:
+                estatisticas["captura"] = captura.estatisticas()
+            return estatisticas
+        if service == "pause":
+            proxy.parar()
+            return {}
+        if service == "resume":
+            proxy.iniciar()
+            return {}
+        if service == "terminate":
+            encerrar.set()
+            return {}
+        raise KeyError(service)
+
+    proxima_amostra = time.time() + ESTATISTICAS_INTERVALO
+    while not encerrar.is_set():
+        if controle_socket.poll(500):
+            responder_controle(controle_socket, tratar_controle)
+        if captura is not None and time.time() >= proxima_amostra:
+            captura.amostrar()
+            proxima_amostra = time.time() + ESTATISTICAS_INTERVALO
+    proxy.parar()
+    if captura is not None:
+        captura.socket.close()
+
+
+def sinal_encerrar(*_):
+    encerrar.set()
+
 
 context = zmq.Context()
 
 client_socket = context.socket(zmq.ROUTER)
-client_socket.bind("tcp://*:5555")
-print("[BROKER] ROUTER porta 5555", flush=True)
+client_socket.bind(f"tcp://*:{BROKER_PORTA_CLIENTES}")
+print(f"[BROKER] ROUTER porta {BROKER_PORTA_CLIENTES}", flush=True)
+
+if BROKER_MODO == "proxy":
+    server_socket = context.socket(zmq.DEALER)
+    server_socket.bind(f"tcp://*:{BROKER_PORTA_SERVIDORES}")
+    print(f"[BROKER] DEALER porta {BROKER_PORTA_SERVIDORES}", flush=True)
+else:
+    server_socket = context.socket(zmq.ROUTER)
+    # Os servidores se identificam pelo nome; uma reconexão assume a identidade
+    server_socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+    server_socket.bind(f"tcp://*:{BROKER_PORTA_SERVIDORES}")
+    print(f"[BROKER] ROUTER porta {BROKER_PORTA_SERVIDORES} (balanceado)", flush=True)
+
+controle_socket = context.socket(zmq.REP)
+controle_socket.bind(f"tcp://*:{CONTROLE_PORTA}")
+print(f"[BROKER] Controle porta {CONTROLE_PORTA}", flush=True)
+
+if servir_metricas(METRICAS_PORTA):
+    print(f"[BROKER] Metricas porta {METRICAS_PORTA}", flush=True)
 
-server_socket = context.socket(zmq.DEALER)
-server_socket.bind("tcp://*:5556")
-print("[BROKER] DEALER porta 5556", flush=True)
+signal.signal(signal.SIGTERM, sinal_encerrar)
 
 try:
-    zmq.proxy(client_socket, server_socket)
+    if BROKER_MODO == "proxy":
+        proxy_instrumentado(context, client_socket, server_socket, controle_socket)
+    else:
+        balanceador(client_socket, server_socket, controle_socket)
 except KeyboardInterrupt:
     pass
 finally:
-    client_socket.close()
-    server_socket.close()
+    # Respostas já enviadas ainda têm até 1s para sair
+    client_socket.close(1000)
+    server_socket.close(1000)
+    controle_socket.close()
     context.term()
@@ -38,7 +38,13 @@ int main() {
     zmq_setsockopt(socket, ZMQ_RCVTIMEO, &timeout, sizeof(timeout));
     zmq_setsockopt(socket, ZMQ_SNDTIMEO, &timeout, sizeof(timeout));
     
-    if (zmq_connect(socket, "tcp://broker:5555") != 0) {
+    // Mesmas variáveis do configuracao.py (padrão: broker:5555)
+    const char *host = getenv("BROKER_HOST") ? getenv("BROKER_HOST") : "broker";
+    const char *porta = getenv("BROKER_PORTA_CLIENTES") ? getenv("BROKER_PORTA_CLIENTES") : "5555";
+    char endereco[256];
+    snprintf(endereco, sizeof(endereco), "tcp://%s:%s", host, porta);
+    
+    if (zmq_connect(socket, endereco) != 0) {
         printf("Erro ao conectar\n");
         return 1;
     }
@@ -24,7 +24,8 @@ class RelogioLogico {
 
 async function main() {
     const sock = new zmq.Request();
-    sock.connect("tcp://broker:5555");
+    // Mesmas variáveis do configuracao.py (padrão: broker:5555)
+    sock.connect(`tcp://${process.env.BROKER_HOST || "broker"}:${process.env.BROKER_PORTA_CLIENTES || 5555}`);
     sock.sendTimeout = 10000;
     sock.receiveTimeout = 10000;
     
@@ -77,6 +78,55 @@ async function main() {
         "Mensagem direta."
     ];
     
+    // Listas conhecidas de usuarios e canais, atualizadas de forma incremental:
+    // pede so o que foi cadastrado depois da ultima versao recebida. A versao
+    // so vale na replica que a deu; outra replica responde a lista completa
+    const listas = {
+        users: { versao: 0, replica: null, nomes: [], conhecidos: new Set() },
+        channels: { versao: 0, replica: null, nomes: [], conhecidos: new Set() }
+    };
+    
+    async function listar(servico) {
+        const lista = listas[servico];
+        
+        request = {
+            service: servico,
+            data: {
+                since_version: lista.versao,
+                replica: lista.replica,
+                timestamp: Date.now() / 1000,
+                clock: relogio.tick()
+            }
+        };
+        
+        await sock.send(msgpack.encode(request));
+        reply = msgpack.decode(await sock.receive());
+        
+        if (reply.data && reply.data.clock) {
+            relogio.update(reply.data.clock);
+        }
+        
+        if (!reply.data || reply.data.version === undefined) {
+            return lista.nomes;
+        }
+        const replica = reply.data.replica ?? null;
+        if (replica !== lista.replica) {
+            // Lista completa de outra replica
+            lista.nomes = [];
+            lista.conhecidos = new Set();
+        }
+        
+        for (const nome of reply.data?.[servico] || []) {
+            if (!lista.conhecidos.has(nome)) {
+                lista.conhecidos.add(nome);
+                lista.nomes.push(nome);
+            }
+        }
+        lista.versao = reply.data.version;
+        lista.replica = replica;
+        return lista.nomes;
+    }
+    
     let ciclo = 0;
     
     // Loop infinito
@@ -90,22 +140,7 @@ async function main() {
             switch (operacao) {
                 case 0:
                     // Listar usuários
-                    request = {
-                        service: "users",
-                        data: {
-                            timestamp: Date.now() / 1000,
-                            clock: relogio.tick()
-                        }
-                    };
-                    
-                    await sock.send(msgpack.encode(request));
-                    reply = msgpack.decode(await sock.receive());
-                    
-                    if (reply.data && reply.data.clock) {
-                        relogio.update(reply.data.clock);
-                    }
-                    
-                    const usuarios = reply.data?.users || [];
+                    const usuarios = await listar("users");
                     console.log(`[BOT ${usuario}] Listou usuarios: ${usuarios.length} encontrados`);
                     break;
                 
@@ -138,43 +173,13 @@ async function main() {
                 
                 case 2:
                     // Listar canais
-                    request = {
-                        service: "channels",
-                        data: {
-                            timestamp: Date.now() / 1000,
-                            clock: relogio.tick()
-                        }
-                    };
-                    
-                    await sock.send(msgpack.encode(request));
-                    reply = msgpack.decode(await sock.receive());
-                    
-                    if (reply.data && reply.data.clock) {
-                        relogio.update(reply.data.clock);
-                    }
-                    
-                    const canais = reply.data?.channels || [];
+                    const canais = await listar("channels");
                     console.log(`[BOT ${usuario}] Listou canais: ${canais.length} encontrados`);
                     break;
                 
                 case 3:
                     // Publicar em canal
-                    request = {
-                        service: "channels",
-                        data: {
-                            timestamp: Date.now() / 1000,
-                            clock: relogio.tick()
-                        }
-                    };
-                    
-                    await sock.send(msgpack.encode(request));
-                    reply = msgpack.decode(await sock.receive());
-                    
-                    if (reply.data && reply.data.clock) {
-                        relogio.update(reply.data.clock);
-                    }
-                    
-                    let canaisDisponiveis = reply.data?.channels || [];
+                    let canaisDisponiveis = await listar("channels");
                     if (canaisDisponiveis.length === 0) {
                         canaisDisponiveis = ["geral"];
                     }
@@ -205,22 +210,7 @@ async function main() {
                 
                 case 4:
                     // Enviar mensagem privada
-                    request = {
-                        service: "users",
-                        data: {
-                            timestamp: Date.now() / 1000,
-                            clock: relogio.tick()
-                        }
-                    };
-                    
-                    await sock.send(msgpack.encode(request));
-                    reply = msgpack.decode(await sock.receive());
-                    
-                    if (reply.data && reply.data.clock) {
-                        relogio.update(reply.data.clock);
-                    }
-                    
-                    const usuariosDisponiveis = reply.data?.users || [];
+                    const usuariosDisponiveis = await listar("users");
                     const outrosUsuarios = usuariosDisponiveis.filter(u => u !== usuario);
                     
                     if (outrosUsuarios.length > 0) {
@@ -0,0 +1,88 @@
+import json
+import threading
+import msgpack
+
+# Formato de uma requisição de cliente pelo primeiro byte. Uma requisição
+# é sempre um mapa: em MessagePack começa com 0x80-0x8f, 0xde ou 0xdf, e em
+# JSON com "{" (o cliente C), talvez depois de espaços. Nenhum desses bytes
+# coincide, então não é preciso tentar um formato e cair no outro.
+INICIO_JSON = frozenset(b"{ \t\r\n")
+
+# Limite de modelos de resposta guardados (ver resposta_modelo())
+MODELOS_MAX = 256
+
+_local = threading.local()
+
+
+def detectar_json(dados):
+    """Se a requisição está em JSON (senão é MessagePack), pelo primeiro byte"""
+    return dados[:1] != b"" and dados[0] in INICIO_JSON
+
+
+def decodificar(dados):
+    """(requisição, formato_json); levanta ValueError se não der para ler"""
+    if detectar_json(dados):
+        try:
+            return json.loads(dados), True
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(str(e))
+    try:
+        request = msgpack.unpackb(dados, raw=False)
+    except Exception as e:
+        raise ValueError(str(e))
+    return request, False
+
+
+def empacotar(objeto):
+    """msgpack.packb com um Packer reaproveitado por thread"""
+    packer = getattr(_local, "packer", None)
+    if packer is None:
+        packer = _local.packer = msgpack.Packer()
+    return packer.pack(objeto)
+
+
+def codificar(reply, formato_json=False):
+    """Resposta no formato do cliente; bytes já codificados passam direto"""
+    if isinstance(reply, bytes):
+        return reply
+    if formato_json:
+        return json.dumps(reply).encode("utf-8")
+    return empacotar(reply)
+
+
+def para_formato(reply, formato_json):
+    """Resposta em MessagePack (ex.: montada por resposta_modelo()) no formato do cliente"""
+    if not formato_json:
+        return reply
+    return json.dumps(msgpack.unpackb(reply, raw=False)).encode("utf-8")
+
+
+_modelos = {}
+_CHAVE_TIMESTAMP = msgpack.packb("timestamp")
+_CHAVE_CLOCK = msgpack.packb("clock")
+
+
+def resposta_modelo(servico, timestamp, clock, formato_json=False, **campos):
+    """Resposta {"service": servico, "data": {**campos, "timestamp", "clock"}}
+    já codificada.
+
+    Em MessagePack, a parte constante (serviço e campos, como status e
+    descrição) é empacotada uma vez por combinação e só timestamp e clock
+    são empacotados a cada resposta. Campos com texto variável também
+    funcionam, mas só as primeiras MODELOS_MAX combinações ficam guardadas.
+    """
+    if formato_json:
+        return json.dumps({"service": servico,
+                           "data": {**campos, "timestamp": timestamp, "clock": clock}}).encode("utf-8")
+    chave = (servico, tuple(campos.items()))
+    prefixo = _modelos.get(chave)
+    if prefixo is None:
+        prefixo = b"".join([
+            b"\x82", msgpack.packb("service"), msgpack.packb(servico), msgpack.packb("data"),
+            bytes([0x80 | (len(campos) + 2)]),
+            *(msgpack.packb(k) + msgpack.packb(v) for k, v in campos.items()),
+            _CHAVE_TIMESTAMP,
+        ])
+        if len(_modelos) < MODELOS_MAX:
+            _modelos[chave] = prefixo
+    return prefixo + empacotar(timestamp) + _CHAVE_CLOCK + empacotar(clock)
@@ -0,0 +1,109 @@
+import os
+
+# Configuração de todos os componentes. Precedência: linha de comando,
+# variável de ambiente, arquivo e por fim o padrão do módulo. Na linha de
+# comando "--servidor-nome x" ou "--SERVIDOR_NOME=x" equivalem a
+# SERVIDOR_NOME=x. O arquivo (--config ou SD_CONFIG) tem uma linha
+# CHAVE=valor por opção, o mesmo formato do env_file do docker compose.
+# A linha de comando só vale depois de configurar(), que apenas os scripts
+# de entrada chamam; quem importa os módulos vê env, arquivo e padrões.
+
+
+def _chave(nome):
+    return nome.lstrip("-").replace("-", "_").upper()
+
+
+def ler_argumentos(argv):
+    """{CHAVE: valor} de --chave valor, --chave=valor ou --chave (valor "1")"""
+    valores = {}
+    i = 0
+    while i < len(argv):
+        item = argv[i]
+        i += 1
+        if not item.startswith("--"):
+            continue
+        if "=" in item:
+            nome, valor = item.split("=", 1)
+        elif i < len(argv) and not argv[i].startswith("--"):
+            nome, valor = item, argv[i]
+            i += 1
+        else:
+            nome, valor = item, "1"
+        valores[_chave(nome)] = valor
+    return valores
+
+
+def ler_arquivo(caminho):
+    """{CHAVE: valor} das linhas CHAVE=valor (linhas vazias e # são ignoradas)"""
+    valores = {}
+    with open(caminho) as arquivo:
+        for linha in arquivo:
+            linha = linha.strip()
+            if not linha or linha.startswith("#") or "=" not in linha:
+                continue
+            chave, valor = linha.split("=", 1)
+            valores[chave.strip()] = valor.strip().strip('"').strip("'")
+    return valores
+
+
+ARGUMENTOS = {}
+ARQUIVO = os.environ.get("SD_CONFIG")
+VALORES_ARQUIVO = ler_arquivo(ARQUIVO) if ARQUIVO else {}
+
+
+def obter(chave, padrao=None):
+    """Valor da opção (texto) ou o padrão, como os.environ.get"""
+    if chave in ARGUMENTOS:
+        return ARGUMENTOS[chave]
+    if chave in os.environ:
+        return os.environ[chave]
+    return VALORES_ARQUIVO.get(chave, padrao)
+
+
+def _enderecos():
+    # Endpoints compartilhados: quem faz bind e quem conecta leem as mesmas chaves
+    global BROKER_HOST, BROKER_PORTA_CLIENTES, BROKER_PORTA_SERVIDORES
+    global REFERENCIA_HOST, REFERENCIA_PORTA, REFERENCIA_PORTA_EVENTOS
+    BROKER_HOST = obter("BROKER_HOST", "broker")
+    BROKER_PORTA_CLIENTES = int(obter("BROKER_PORTA_CLIENTES", 5555))
+    BROKER_PORTA_SERVIDORES = int(obter("BROKER_PORTA_SERVIDORES", 5556))
+    REFERENCIA_HOST = obter("REFERENCIA_HOST", "referencia")
+    REFERENCIA_PORTA = int(obter("REFERENCIA_PORTA", 5560))
+    REFERENCIA_PORTA_EVENTOS = int(obter("REFERENCIA_PORTA_EVENTOS", 5563))
+
+
+_enderecos()
+
+
+def configurar(argv):
+    """Aplica a linha de comando do programa. Os módulos leem as opções ao
+    serem importados, então o script de entrada chama antes dos outros
+    imports do projeto."""
+    global ARQUIVO, VALORES_ARQUIVO
+    ARGUMENTOS.update(ler_argumentos(argv))
+    ARQUIVO = ARGUMENTOS.get("CONFIG") or os.environ.get("SD_CONFIG")
+    VALORES_ARQUIVO = ler_arquivo(ARQUIVO) if ARQUIVO else {}
+    _enderecos()
+
+
+def endereco_servidor(membro, servico, porta_padrao):
+    """Endpoint de um serviço ("sync", "replication", "publication") de um
+    servidor da lista de membros, pelo endereço que ele anunciou. Sem
+    endereço anunciado, usa o nome como host e a porta padrão."""
+    anunciado = membro.get("address") or {}
+    host = anunciado.get("host") or membro.get("name")
+    return f"tcp://{host}:{anunciado.get(servico) or porta_padrao}"
+
+
+def fixar_cpu(chave):
+    """Prende o processo às CPUs da opção ("2" ou "0,1"), se definida.
+
+    Retorna o conjunto de CPUs, ou None se a opção está vazia ou o sistema
+    não permite (sched_setaffinity só existe no Linux).
+    """
+    texto = obter(chave)
+    if not texto or not hasattr(os, "sched_setaffinity"):
+        return None
+    cpus = {int(cpu) for cpu in str(texto).split(",") if cpu.strip()}
+    os.sched_setaffinity(0, cpus)
+    return cpus
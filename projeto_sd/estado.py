@@ -0,0 +1,310 @@
+import json
+import bisect
+import hashlib
+import threading
+import msgpack
+
+
+class Colecao:
+    """Registros em ordem de inserção com índice por chave (busca O(1)).
+
+    A lista de nomes usada nas respostas de listagem é serializada uma única
+    vez por versão da coleção e reaproveitada até a próxima alteração. Como
+    os registros só são anexados, a versão é também a quantidade de registros
+    e serve de posição para listagens incrementais nesta réplica (cada réplica
+    anexa na sua ordem de chegada). A paginação usa os nomes em ordem
+    alfabética, com o último nome da página como cursor, que vale em
+    qualquer réplica.
+    """
+
+    def __init__(self, chave):
+        self.chave = chave  # campo que identifica o registro ("user", "channel")
+        self.registros = []
+        self.indice = {}
+        self.ordenados = []  # nomes em ordem alfabética, para a paginação
+        self.versao = 0
+        self.lock = threading.Lock()
+        self._serializada = {}
+
+    def _ordenar(self):
+        self.ordenados = sorted(v for v in self.indice if isinstance(v, str))
+
+    def __contains__(self, valor):
+        return valor in self.indice
+
+    def __len__(self):
+        return len(self.registros)
+
+    def adicionar(self, registro):
+        """Adiciona o registro se a chave ainda não existir; retorna se adicionou"""
+        valor = registro.get(self.chave)
+        with self.lock:
+            if valor in self.indice:
+                return False
+            self.indice[valor] = registro
+            self.registros.append(registro)
+            if isinstance(valor, str):
+                bisect.insort(self.ordenados, valor)
+            self.versao += 1
+            self._serializada = {}
+        return True
+
+    def nomes(self):
+        return [r.get(self.chave) for r in self.registros]
+
+    def nomes_serializados(self, formato_json=False):
+        """(versão, lista de nomes já codificada em MessagePack ou JSON)"""
+        serializada = self._serializada
+        cache = serializada.get(formato_json)
+        if cache is None:
+            with self.lock:
+                versao = self.versao
+                nomes = self.nomes()
+            cache = (versao, json.dumps(nomes) if formato_json else msgpack.packb(nomes))
+            serializada[formato_json] = cache
+        return cache
+
+    def fatia(self, inicio):
+        """(versão, nomes cadastrados nesta réplica a partir da posição inicio)"""
+        with self.lock:
+            return self.versao, [r.get(self.chave) for r in self.registros[inicio:]]
+
+    def pagina(self, depois=None, inicio=0, limite=None):
+        """(versão, nomes em ordem alfabética, último nome se há mais).
+
+        Começa no primeiro nome maior que depois (o cursor da página
+        anterior) ou na posição inicio.
+        """
+        with self.lock:
+            if depois is not None:
+                inicio = bisect.bisect_right(self.ordenados, depois)
+            fim = len(self.ordenados) if limite is None else min(len(self.ordenados), inicio + limite)
+            nomes = self.ordenados[inicio:fim]
+            mais = fim < len(self.ordenados)
+            return self.versao, nomes, nomes[-1] if mais and nomes else None
+
+
+class ColecaoPersistente(Colecao):
+    """Colecao gravada em um LogSegmentado, um registro por cadastro.
+
+    A versão da coleção acompanha a seq do log: acompanhar() aplica apenas os
+    registros novos gravados por outras réplicas e, se o log não mudou, custa
+    um fstat, sem leitura nem parse. Com gravar=False o cadastro fica só em
+    memória e chega ao log pelo processo escritor. Partindo de um snapshot,
+    só os registros gravados depois dele são reaplicados.
+    """
+
+    def __init__(self, chave, log, instantaneo=None):
+        super().__init__(chave)
+        self.log = log
+        self.gravar = True
+        self.aplicado = log.segmentos[0].base  # próxima seq do log a aplicar
+        if instantaneo and log.segmentos[0].base <= instantaneo["aplicado"] <= log.proximo_seq:
+            self.registros = instantaneo["registros"]
+            self.indice = {r.get(chave): r for r in self.registros}
+            self._ordenar()
+            self.versao = len(self.registros)
+            self.aplicado = instantaneo["aplicado"]
+        # Recuperação: só a cauda do log depois do snapshot
+        inicio = self.aplicado
+        self.bytes_reaplicados = log.bytes_desde(inicio)
+        self.acompanhar()
+        self.reaplicados = self.aplicado - inicio
+
+    def instantaneo(self):
+        """Estado para o snapshot: registros e a próxima seq do log a aplicar"""
+        with self.lock:
+            return {"aplicado": self.aplicado, "registros": list(self.registros)}
+
+    def adicionar(self, registro):
+        if not super().adicionar(registro):
+            return False
+        if not self.gravar:
+            return True
+        seq = self.log.anexar(registro)
+        with self.lock:
+            if seq == self.aplicado:
+                self.aplicado = seq + 1
+        return True
+
+    def acompanhar(self):
+        """Aplica os registros gravados desde a última chamada; retorna quantos eram novos"""
+        if self.aplicado >= self.log.proximo_seq and not self.log.mudou():
+            return 0
+        self.log.acompanhar()
+        novos = 0
+        for seq, registro in self.log.iterar(self.aplicado):
+            if Colecao.adicionar(self, registro):
+                novos += 1
+            with self.lock:
+                self.aplicado = max(self.aplicado, seq + 1)
+        return novos
+
+
+class IndiceMensagens:
+    """Índice por destino (canal ou usuário) das mensagens gravadas em um log.
+
+    Para cada chave guarda (timestamp, seq, posição, resumo) em ordem de
+    timestamp; o conteúdo fica só no log e é lido direto da posição. Uma
+    consulta acha o início por busca binária e lê apenas as mensagens da
+    página, sem varrer o histórico. A mesma mensagem gravada mais de uma vez
+    no log (réplicas usando o mesmo diretório, replicação repetida depois de
+    um reinício) entra no índice uma única vez: o resumo do conteúdo é
+    procurado num conjunto em memória, sem ler o log. Com
+    gravar=False a mensagem é indexada quando o processo escritor a gravar.
+    """
+
+    def __init__(self, campo, log, instantaneo=None):
+        self.campo = campo  # campo do registro usado como chave ("channel", "dst")
+        self.log = log
+        self.gravar = True
+        self.entradas = {}  # {chave: [(timestamp, seq, posição, resumo)]}
+        self.lock = threading.Lock()
+        self.aplicado = log.segmentos[0].base  # próxima seq do log a indexar
+        # Snapshot sem a coluna de resumos (versão anterior) é ignorado e o
+        # índice é refeito pelo log
+        if (instantaneo and log.segmentos[0].base <= instantaneo["aplicado"] <= log.proximo_seq
+                and all(len(colunas) == 5 for colunas in instantaneo["entradas"].values())):
+            # Snapshot em colunas: [timestamps, seqs, bases, offsets, resumos] por chave
+            self.entradas = {
+                chave: list(zip(timestamps, seqs, zip(bases, offsets), resumos))
+                for chave, (timestamps, seqs, bases, offsets, resumos) in instantaneo["entradas"].items()
+            }
+            self.aplicado = instantaneo["aplicado"]
+        self.resumos = {entrada[3] for lista in self.entradas.values() for entrada in lista}
+        # Recuperação: só a cauda do log depois do snapshot
+        inicio = self.aplicado
+        self.bytes_reaplicados = log.bytes_desde(inicio)
+        self.acompanhar()
+        self.reaplicados = self.aplicado - inicio
+
+    def instantaneo(self):
+        """Estado para o snapshot: o índice em colunas e a próxima seq a indexar"""
+        with self.lock:
+            aplicado = self.aplicado
+            entradas = {chave: list(lista) for chave, lista in self.entradas.items()}
+        colunas = {}
+        for chave, lista in entradas.items():
+            timestamps, seqs, posicoes, resumos = zip(*lista) if lista else ((), (), (), ())
+            bases, offsets = zip(*posicoes) if posicoes else ((), ())
+            colunas[chave] = [timestamps, seqs, bases, offsets, resumos]
+        return {"aplicado": aplicado, "entradas": colunas}
+
+    @staticmethod
+    def resumo(registro):
+        """Resumo de 64 bits do conteúdo, independente da ordem dos campos"""
+        dados = msgpack.packb(sorted(registro.items(), key=lambda item: str(item[0])))
+        return int.from_bytes(hashlib.blake2b(dados, digest_size=8).digest(), "big")
+
+    def _indexar(self, seq, registro, posicao):
+        resumo = self.resumo(registro)
+        if resumo in self.resumos:
+            return False
+        self.resumos.add(resumo)
+        timestamp = registro.get("timestamp")
+        # Registros antigos sem timestamp numérico (os novos são validados ao chegar)
+        timestamp = float(timestamp) if isinstance(timestamp, (int, float)) else 0.0
+        bisect.insort(self.entradas.setdefault(registro.get(self.campo), []),
+                      (timestamp, seq, posicao, resumo))
+        return True
+
+    def anexar(self, registro):
+        """Grava o registro no log e indexa; retorna a seq (None sem gravar)"""
+        if not self.gravar:
+            return None
+        seq, posicao = self.log.anexar_posicionado(registro)
+        with self.lock:
+            self._indexar(seq, registro, posicao)
+            if seq == self.aplicado:
+                self.aplicado = seq + 1
+        return seq
+
+    def acompanhar(self):
+        """Indexa os registros gravados desde a última chamada; retorna quantos eram novos"""
+        if self.aplicado >= self.log.proximo_seq and not self.log.mudou():
+            return 0
+        self.log.acompanhar()
+        novos = 0
+        for seq, registro, posicao in self.log.iterar(self.aplicado, posicoes=True):
+            with self.lock:
+                if self._indexar(seq, registro, posicao):
+                    novos += 1
+                self.aplicado = max(self.aplicado, seq + 1)
+        return novos
+
+    def consultar(self, chave, desde=None, cursor=None, limite=100):
+        """(mensagens, próximo cursor) de uma chave, em ordem de timestamp.
+
+        Com cursor (timestamp, seq) continua depois dele; com desde, começa
+        após esse timestamp; sem nenhum dos dois retorna as últimas mensagens.
+        O cursor é None quando não há mais mensagens.
+        """
+        with self.lock:
+            lista = self.entradas.get(chave, [])
+            if cursor is not None:
+                inicio = bisect.bisect_right(lista, (cursor[0], cursor[1], (float("inf"),)))
+            elif desde is not None:
+                inicio = bisect.bisect_right(lista, (desde, float("inf")))
+            else:
+                inicio = max(0, len(lista) - limite)
+            pagina = lista[inicio:inicio + limite]
+            mais = inicio + limite < len(lista)
+        mensagens = [self.log.ler_posicao(posicao) for _, _, posicao, _ in pagina]
+        proximo = (pagina[-1][0], pagina[-1][1]) if mais else None
+        return mensagens, proximo
+
+
+# Partes constantes das respostas de listagem, empacotadas uma única vez
+_prefixos_listagem = {}
+
+def resposta_listagem(servico, campo, colecao, timestamp, clock, formato_json=False,
+                      replica=None, desde_versao=None, depois=None, inicio=0, limite=None):
+    """Monta a resposta de listagem já codificada, no mesmo formato de
+    {"service": servico, "data": {"timestamp": ..., campo: [...], "clock": ...,
+    "version": ..., "replica": ...}}, mais "next_cursor" quando há limite.
+
+    desde_versao pede os cadastros desta réplica depois dessa versão; depois,
+    inicio e limite pedem uma página em ordem alfabética. Sem nenhum deles
+    usa a lista inteira em cache; caso contrário serializa só o pedido.
+    """
+    proximo = None
+    if desde_versao:
+        versao, nomes = colecao.fatia(desde_versao)
+        nomes = json.dumps(nomes) if formato_json else msgpack.packb(nomes)
+    elif depois is None and inicio == 0 and limite is None:
+        versao, nomes = colecao.nomes_serializados(formato_json)
+    else:
+        versao, nomes, proximo = colecao.pagina(depois, inicio, limite)
+        nomes = json.dumps(nomes) if formato_json else msgpack.packb(nomes)
+    paginada = limite is not None
+
+    if formato_json:
+        cursor = f', "next_cursor": {json.dumps(proximo)}' if paginada else ""
+        return (
+            f'{{"service": {json.dumps(servico)}, "data": {{"timestamp": {json.dumps(timestamp)}, '
+            f'{json.dumps(campo)}: {nomes}, "clock": {clock}, "version": {versao}, '
+            f'"replica": {json.dumps(replica)}{cursor}}}}}'
+        ).encode("utf-8")
+
+    prefixo = _prefixos_listagem.get(servico)
+    if prefixo is None:
+        prefixo = (b"\x82" + msgpack.packb("service") + msgpack.packb(servico)
+                   + msgpack.packb("data"))
+        _prefixos_listagem[servico] = prefixo
+    partes = [
+        prefixo,
+        b"\x86" if paginada else b"\x85",
+        msgpack.packb("timestamp"),
+        msgpack.packb(timestamp),
+        msgpack.packb(campo),
+        nomes,
+        msgpack.packb("clock"),
+        msgpack.packb(clock),
+        msgpack.packb("version"),
+        msgpack.packb(versao),
+        msgpack.packb("replica"),
+        msgpack.packb(replica),
+    ]
+    if paginada:
+        partes += [msgpack.packb("next_cursor"), msgpack.packb(proximo)]
+    return b"".join(partes)
@@ -0,0 +1,120 @@
+import threading
+import zmq
+from topicos import ler_cabecalho, ler_corpo
+from configuracao import obter
+from registro import Registro
+
+registrador = Registro("[S]")
+
+# Eventos de membros publicados pelo servidor de referência (PUB na porta
+# REFERENCIA_PORTA_EVENTOS, no formato de topicos.py): tipo "join" ou "leave"
+# e corpo {name, rank, address, epoch}. Um "join" de um servidor já listado
+# atualiza o rank ou o endereço anunciado
+TOPICO = "membros"
+
+# Mesmo sem lacuna nos eventos, relê a lista completa nesse intervalo
+RESSINCRONIZAR_INTERVALO = float(obter("MEMBROS_RESSINCRONIZAR_INTERVALO", 30))
+
+
+class VisaoMembros:
+    """Cópia local dos servidores registrados, atualizada pelos eventos do
+    servidor de referência.
+
+    A época de membros cresce uma unidade a cada mudança. Um evento só é
+    aplicado se for o da época seguinte à da cópia; se a época pula (evento
+    perdido, assinatura ainda não ativa ou servidor de referência reiniciado)
+    a lista completa é relida com consultar(), que devolve (lista, época).
+    listar() não usa a rede. Cada mudança aplicada é repassada às funções
+    registradas em ao_mudar(tipo, nome, rank).
+    """
+
+    def __init__(self, endereco_eventos, consultar, contexto=None):
+        self.endereco_eventos = endereco_eventos
+        self.consultar = consultar
+        self.contexto = contexto or zmq.Context.instance()
+        self.membros = {}  # {nome: {"name", "rank", "address"}}
+        self.epoca = None
+        self.ressincronizacoes = 0
+        self.ouvintes = []
+        self.lock = threading.Lock()
+
+    def ao_mudar(self, funcao):
+        self.ouvintes.append(funcao)
+
+    def iniciar(self):
+        threading.Thread(target=self._ouvir, daemon=True).start()
+
+    def listar(self):
+        """[{name, rank, address}] da cópia local"""
+        with self.lock:
+            return [dict(membro) for membro in self.membros.values()]
+
+    def verificar(self, epoca):
+        """Época vista em outra resposta (ex.: heartbeat); relê se estiver à frente"""
+        if epoca is not None and (self.epoca is None or epoca > self.epoca):
+            self.ressincronizar()
+
+    def ressincronizar(self):
+        """Relê a lista completa; retorna False se o servidor de referência não respondeu"""
+        try:
+            lista, epoca = self.consultar()
+        except zmq.Again:
+            return False
+        novos = {s["name"]: s for s in lista}
+        with self.lock:
+            if self.epoca is not None and epoca is not None and epoca < self.epoca:
+                return True  # resposta mais antiga que um evento já aplicado
+            anteriores = self.membros
+            self.membros = novos
+            self.epoca = epoca
+            self.ressincronizacoes += 1
+        mudancas = [("leave", nome, membro.get("rank")) for nome, membro in anteriores.items()
+                    if nome not in novos]
+        mudancas += [("join", nome, membro.get("rank")) for nome, membro in novos.items()
+                     if anteriores.get(nome) != membro]
+        self._notificar(mudancas)
+        return True
+
+    def _ouvir(self):
+        socket = self.contexto.socket(zmq.SUB)
+        socket.connect(self.endereco_eventos)
+        socket.setsockopt_string(zmq.SUBSCRIBE, TOPICO)
+        self.ressincronizar()
+        while True:
+            if not socket.poll(RESSINCRONIZAR_INTERVALO * 1000):
+                self.ressincronizar()
+                continue
+            try:
+                frames = socket.recv_multipart()
+                _, tipo, _, _, _ = ler_cabecalho(frames)
+                evento = ler_corpo(frames)
+            except ValueError:
+                continue
+            if not self._aplicar(tipo, evento):
+                self.ressincronizar()
+
+    def _aplicar(self, tipo, evento):
+        """Aplica o evento da próxima época; False se houve lacuna"""
+        epoca = evento.get("epoch")
+        nome = evento.get("name")
+        with self.lock:
+            if self.epoca is not None and epoca <= self.epoca:
+                return True  # já incluído na cópia
+            if self.epoca is None or epoca != self.epoca + 1:
+                return False
+            self.epoca = epoca
+            if tipo == "join":
+                self.membros[nome] = {"name": nome, "rank": evento.get("rank"),
+                                      "address": evento.get("address")}
+            else:
+                self.membros.pop(nome, None)
+        self._notificar([(tipo, nome, evento.get("rank"))])
+        return True
+
+    def _notificar(self, mudancas):
+        for tipo, nome, rank in mudancas:
+            for funcao in self.ouvintes:
+                try:
+                    funcao(tipo, nome, rank)
+                except Exception as e:
+                    registrador.erro("Erro ao tratar evento de membros %s %s: %s", tipo, nome, e)
@@ -0,0 +1,271 @@
+import time
+import bisect
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Limites (em segundos) dos histogramas de latência
+LIMITES_LATENCIA = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5)
+
+# Eventos anotados com Amostras viram métricas a cada INTERVALO_AMOSTRAS
+# segundos (e a cada coleta)
+INTERVALO_AMOSTRAS = 1.0
+
+# Métricas do processo, na ordem de criação
+_metricas = []
+
+# Amostras do processo e a thread que as esvazia (iniciada no primeiro uso)
+_amostras = []
+_dreno = None
+_dreno_lock = threading.Lock()
+
+
+def _texto_rotulos(nomes, valores, extra=""):
+    pares = [f'{nome}="{_escapar(valor)}"' for nome, valor in zip(nomes, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(valor) if isinstance(valor, float) else str(int(valor))
+
+
+class _Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nome, ajuda, rotulos=(), funcao=None):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = tuple(rotulos)
+        self.funcao = funcao  # lida a cada coleta: número ou {valores dos rótulos: número}
+        self.valores = {}  # {valores dos rótulos: valor}
+        self.lock = threading.Lock()
+        _metricas.append(self)
+
+    def _atuais(self):
+        if self.funcao is None:
+            with self.lock:
+                return list(self.valores.items())
+        valor = self.funcao()
+        if isinstance(valor, dict):
+            return [(r if isinstance(r, tuple) else (r,), v) for r, v in valor.items()]
+        return [((), valor)]
+
+    def linhas(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+        for rotulos, valor in sorted(self._atuais(), key=lambda item: tuple(map(str, item[0]))):
+            linhas.append(f"{self.nome}{_texto_rotulos(self.rotulos, rotulos)} {_numero(valor)}")
+        return linhas
+
+
+class _PorThread(_Metrica):
+    """Cada thread soma no seu próprio dicionário, sem lock; a coleta junta
+    as parciais. Só a thread dona escreve em cada parcial, então nenhum
+    incremento se perde, e o caminho da requisição não disputa lock.
+    """
+
+    def __init__(self, nome, ajuda, rotulos=(), funcao=None):
+        super().__init__(nome, ajuda, rotulos, funcao)
+        self._local = threading.local()
+        self._parciais = []
+
+    def _parcial(self):
+        try:
+            return self._local.valores
+        except AttributeError:
+            valores = self._local.valores = {}
+            with self.lock:
+                self._parciais.append(valores)
+            return valores
+
+    def _copias(self):
+        with self.lock:
+            parciais = list(self._parciais)
+        return [list(parcial.items()) for parcial in parciais]
+
+
+class Contador(_PorThread):
+    """Total que só cresce (requisições, erros...), por combinação de rótulos.
+
+    Com funcao, o total é mantido em outro lugar e só lido na coleta.
+    """
+    tipo = "counter"
+
+    def inc(self, *rotulos, valor=1):
+        valores = self._parcial()
+        valores[rotulos] = valores.get(rotulos, 0) + valor
+
+    def _atuais(self):
+        if self.funcao is not None:
+            return super()._atuais()
+        totais = {}
+        for itens in self._copias():
+            for rotulos, valor in itens:
+                totais[rotulos] = totais.get(rotulos, 0) + valor
+        return list(totais.items())
+
+
+class Medidor(_Metrica):
+    """Valor atual (tamanho de fila, ajuste do relógio...)"""
+    tipo = "gauge"
+
+    def definir(self, valor, *rotulos):
+        with self.lock:
+            self.valores[rotulos] = valor
+
+
+class Histograma(_PorThread):
+    """Distribuição de valores (latências) em faixas fixas.
+
+    observar() só incrementa a faixa do valor; as contagens acumuladas que o
+    formato do Prometheus pede são calculadas na coleta.
+    """
+    tipo = "histogram"
+
+    def __init__(self, nome, ajuda, rotulos=(), limites=LIMITES_LATENCIA):
+        super().__init__(nome, ajuda, rotulos)
+        self.limites = tuple(limites)
+
+    def observar(self, valor, *rotulos):
+        valores = self._parcial()
+        estado = valores.get(rotulos)
+        if estado is None:
+            estado = valores[rotulos] = [[0] * (len(self.limites) + 1), 0.0]
+        estado[0][bisect.bisect_left(self.limites, valor)] += 1
+        estado[1] += valor
+
+    def observar_varios(self, valores, *rotulos):
+        parcial = self._parcial()
+        estado = parcial.get(rotulos)
+        if estado is None:
+            estado = parcial[rotulos] = [[0] * (len(self.limites) + 1), 0.0]
+        faixas, limites = estado[0], self.limites
+        for valor in valores:
+            faixas[bisect.bisect_left(limites, valor)] += 1
+        estado[1] += sum(valores)
+
+    def linhas(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+        totais = {}
+        for itens in self._copias():
+            for rotulos, (faixas, soma) in itens:
+                total = totais.setdefault(rotulos, [[0] * len(faixas), 0.0])
+                total[0] = [a + b for a, b in zip(total[0], faixas)]
+                total[1] += soma
+        atuais = [(rotulos, faixas, soma) for rotulos, (faixas, soma) in totais.items()]
+        for rotulos, faixas, soma in sorted(atuais, key=lambda item: tuple(map(str, item[0]))):
+            acumulado = 0
+            for limite, quantidade in zip(self.limites + (float("inf"),), faixas):
+                acumulado += quantidade
+                le = _texto_rotulos(self.rotulos, rotulos, f'le="{_numero(float(limite))}"')
+                linhas.append(f"{self.nome}_bucket{le} {acumulado}")
+            texto = _texto_rotulos(self.rotulos, rotulos)
+            linhas.append(f"{self.nome}_sum{texto} {_numero(soma)}")
+            linhas.append(f"{self.nome}_count{texto} {acumulado}")
+        return linhas
+
+
+class Amostras:
+    """Eventos do caminho da requisição anotados sem contar nada na hora.
+
+    Cada thread pega com anotador() o append de uma fila só sua e anota uma
+    tupla por evento. Uma thread em segundo plano, e cada coleta, esvazia as
+    filas e passa a lista de eventos a processar(), que atualiza os
+    contadores e histogramas de uma vez. deque.append e popleft são
+    atômicos, então nenhum evento se perde ou conta duas vezes, e a
+    requisição paga uma única chamada em C.
+    """
+
+    def __init__(self, processar):
+        self.processar = processar
+        self.filas = []
+        self.lock = threading.Lock()  # uma drenagem por vez
+        _amostras.append(self)
+
+    def anotador(self):
+        """Função que anota um evento; uma por thread"""
+        fila = deque()
+        with self.lock:
+            self.filas.append(fila)
+        _iniciar_dreno()
+        return fila.append
+
+    def drenar(self):
+        with self.lock:
+            eventos = []
+            for fila in self.filas:
+                for _ in range(len(fila)):
+                    eventos.append(fila.popleft())
+            if eventos:
+                self.processar(eventos)
+
+
+def _drenar_amostras():
+    for amostras in list(_amostras):
+        try:
+            amostras.drenar()
+        except Exception:
+            pass  # os eventos do lote com problema são descartados
+
+
+def _drenar_sempre():
+    while True:
+        time.sleep(INTERVALO_AMOSTRAS)
+        _drenar_amostras()
+
+
+def _iniciar_dreno():
+    global _dreno
+    with _dreno_lock:
+        if _dreno is None:
+            _dreno = threading.Thread(target=_drenar_sempre, daemon=True)
+            _dreno.start()
+
+
+def exposicao():
+    """Todas as métricas no formato de texto do Prometheus"""
+    _drenar_amostras()
+    linhas = []
+    for metrica in _metricas:
+        try:
+            linhas += metrica.linhas()
+        except Exception as e:
+            linhas.append(f"# {metrica.nome}: erro na coleta: {e}")
+    return "\n".join(linhas) + "\n"
+
+
+class _Pedido(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        corpo = exposicao().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, formato, *args):
+        pass  # uma linha por coleta só poluiria a saída
+
+
+def servir(porta, host=""):
+    """Atende GET /metrics em uma thread própria; porta 0 desliga.
+
+    Retorna o servidor HTTP, ou None se desligado.
+    """
+    if not porta:
+        return None
+    servidor = ThreadingHTTPServer((host, int(porta)), _Pedido)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
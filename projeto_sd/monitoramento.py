@@ -0,0 +1,242 @@
+import time
+import struct
+import threading
+from collections import Counter
+import zmq
+import msgpack
+from configuracao import obter
+
+# Fila da captura: cheia, o PUB da captura descarta em vez de atrasar o proxy
+CAPTURA_HWM = int(obter("MONITORAMENTO_CAPTURA_HWM", 10000))
+
+# Quantidade de tópicos (ou serviços) listados com a taxa atual
+TOPICOS_TOP = int(obter("MONITORAMENTO_TOPICOS_TOP", 10))
+
+# Ordem dos contadores devolvidos pelo comando STATISTICS do zmq.proxy_steerable
+# (contados em frames, não em mensagens multipart)
+CONTADORES_PROXY = (
+    "frontend_recebidos", "frontend_bytes_recebidos", "frontend_enviados", "frontend_bytes_enviados",
+    "backend_recebidos", "backend_bytes_recebidos", "backend_enviados", "backend_bytes_enviados",
+)
+
+
+def comandar_proxy(controle, comando):
+    """Comando sem resposta (TERMINATE) pelo socket de controle (PAIR).
+
+    Versões recentes do libzmq respondem com um frame vazio; a resposta é
+    consumida para não ser lida no lugar da do próximo STATISTICS.
+    """
+    controle.send(comando)
+    if controle.poll(100):
+        controle.recv_multipart()
+
+
+def estatisticas_proxy(controle):
+    """Contadores do zmq.proxy_steerable pelo socket de controle (PAIR).
+
+    O backend conta cada mensagem repassada uma vez, antes do fan-out do XPUB.
+    """
+    controle.send(b"STATISTICS")
+    quadros = controle.recv_multipart()
+    while len(quadros) != len(CONTADORES_PROXY):
+        quadros = controle.recv_multipart()  # resposta atrasada de outro comando
+    valores = [struct.unpack("=Q", quadro)[0] for quadro in quadros]
+    return dict(zip(CONTADORES_PROXY, valores))
+
+
+class ProxyControlado:
+    """zmq.proxy_steerable em uma thread, com contadores e pausa.
+
+    Pausar encerra o proxy (TERMINATE) e soma os contadores, que o libzmq zera
+    a cada execução; as mensagens esperam nas filas dos sockets, que continuam
+    abertos, até retomar. O PAUSE do libzmq não é usado porque na versão
+    4.3.5 ele confirma o comando e continua repassando.
+    """
+
+    def __init__(self, contexto, nome, frontend, backend, captura=None):
+        self.contexto = contexto
+        self.nome = nome
+        self.frontend = frontend
+        self.backend = backend
+        self.captura = captura  # socket de captura ou None
+        self.acumulado = dict.fromkeys(CONTADORES_PROXY, 0)
+        self.execucoes = 0
+        self.controle = None
+        self.thread = None
+
+    @property
+    def pausado(self):
+        return self.thread is None
+
+    def iniciar(self):
+        if self.thread is not None:
+            return
+        self.execucoes += 1
+        endereco = f"inproc://controle-{self.nome}-{self.execucoes}"
+        self.controle = self.contexto.socket(zmq.PAIR)
+        self.controle.bind(endereco)
+        self.thread = threading.Thread(target=self._executar, args=(endereco,), daemon=True)
+        self.thread.start()
+
+    def _executar(self, endereco):
+        controle = self.contexto.socket(zmq.PAIR)
+        controle.connect(endereco)
+        try:
+            zmq.proxy_steerable(self.frontend, self.backend, self.captura, controle)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            controle.close()
+
+    def parar(self):
+        """Encerra a execução atual guardando os contadores (pausa)"""
+        if self.thread is None:
+            return
+        for nome, valor in estatisticas_proxy(self.controle).items():
+            self.acumulado[nome] += valor
+        comandar_proxy(self.controle, b"TERMINATE")
+        self.thread.join()
+        self.controle.close()
+        self.thread = None
+        self.controle = None
+
+    def estatisticas(self):
+        if self.thread is None:
+            return dict(self.acumulado)
+        atuais = estatisticas_proxy(self.controle)
+        return {nome: self.acumulado[nome] + atuais[nome] for nome in CONTADORES_PROXY}
+
+
+class Contadores:
+    """Mensagens e bytes, no total e por tópico (ou serviço), com a taxa
+    por tópico calculada a cada amostrar()"""
+
+    def __init__(self):
+        self.mensagens = 0
+        self.bytes = 0
+        self.por_topico = Counter()
+        self.taxas = []  # [(tópico, mensagens/s)] da última amostra
+        self._amostra = (time.time(), Counter())
+        self.lock = threading.Lock()
+
+    def contar(self, topico, tamanho):
+        with self.lock:
+            self.mensagens += 1
+            self.bytes += tamanho
+            if topico is not None:
+                self.por_topico[topico] += 1
+
+    def amostrar(self):
+        """Atualiza as taxas por tópico desde a amostra anterior"""
+        with self.lock:
+            agora = time.time()
+            instante, anteriores = self._amostra
+            atuais = self.por_topico.copy()
+            self._amostra = (agora, atuais)
+        intervalo = max(agora - instante, 1e-9)
+        diferenca = atuais - anteriores
+        self.taxas = [(topico, round(total / intervalo, 1))
+                      for topico, total in diferenca.most_common(TOPICOS_TOP)]
+
+    def estatisticas(self):
+        with self.lock:
+            return {
+                "mensagens": self.mensagens,
+                "bytes": self.bytes,
+                "topicos": len(self.por_topico),
+                "taxas": [list(taxa) for taxa in self.taxas],
+            }
+
+
+class Captura(Contadores):
+    """Contadores a partir da cópia de todo o tráfego de um proxy.
+
+    O socket PUB em self.socket é passado como captura ao zmq.proxy_steerable;
+    uma thread lê as cópias e conta mensagens, bytes e mensagens por tópico
+    (dado por classificar(frames), None para não contar). Com inscricoes=True
+    (XPUB com XPUB_VERBOSER) também conta inscrições e cancelamentos e quantas
+    entregas (cópias do fan-out) as inscrições ativas preveem. Cópias além de
+    CAPTURA_HWM são descartadas e aparecem como diferença entre os contadores
+    do proxy e os da captura.
+    """
+
+    def __init__(self, contexto, nome, classificar, inscricoes=False):
+        super().__init__()
+        self.classificar = classificar
+        self.inscricoes = inscricoes
+        self.socket = contexto.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, CAPTURA_HWM)
+        self.socket.bind(f"inproc://captura-{nome}")
+        self._entrada = contexto.socket(zmq.SUB)
+        self._entrada.setsockopt(zmq.RCVHWM, CAPTURA_HWM)
+        self._entrada.connect(f"inproc://captura-{nome}")
+        self._entrada.setsockopt(zmq.SUBSCRIBE, b"")
+        self.inscritas = 0
+        self.canceladas = 0
+        self.assinantes = Counter()  # {prefixo: inscrições ativas}
+        self.esperadas = 0  # entregas previstas pelas inscrições ativas
+
+    def iniciar(self):
+        threading.Thread(target=self._consumir, daemon=True).start()
+
+    def _consumir(self):
+        while True:
+            try:
+                frames = self._entrada.recv_multipart()
+            except zmq.ContextTerminated:
+                self._entrada.close()
+                return
+            self._contar(frames)
+
+    def _contar(self, frames):
+        if self.inscricoes and len(frames) == 1 and frames[0][:1] in (b"\x00", b"\x01"):
+            # Inscrição (\x01) ou cancelamento (\x00) vindo de um assinante
+            prefixo = frames[0][1:]
+            with self.lock:
+                if frames[0][0] == 1:
+                    self.inscritas += 1
+                    self.assinantes[prefixo] += 1
+                else:
+                    self.canceladas += 1
+                    self.assinantes[prefixo] -= 1
+                    if self.assinantes[prefixo] <= 0:
+                        del self.assinantes[prefixo]
+            return
+        self.contar(self.classificar(frames), sum(len(f) for f in frames))
+        if self.inscricoes and self.assinantes:
+            quadro = frames[0]
+            esperadas = sum(self.assinantes.get(quadro[:i], 0) for i in range(len(quadro) + 1))
+            with self.lock:
+                self.esperadas += esperadas
+
+    def estatisticas(self):
+        estatisticas = super().estatisticas()
+        if self.inscricoes:
+            with self.lock:
+                estatisticas.update({
+                    "inscricoes": self.inscritas,
+                    "cancelamentos": self.canceladas,
+                    "inscricoes_ativas": sum(self.assinantes.values()),
+                    "entregas_esperadas": self.esperadas,
+                })
+        return estatisticas
+
+
+def responder_controle(socket, tratar):
+    """Atende uma requisição do endpoint de controle (REP, MessagePack).
+
+    tratar(service, data) devolve o dict de "data" da resposta; serviços
+    desconhecidos levantam KeyError e parâmetros inválidos, ValueError.
+    """
+    service = None
+    try:
+        request = msgpack.unpackb(socket.recv(), raw=False)
+        service = request.get("service")
+        data = tratar(service, request.get("data") or {})
+        data["status"] = "OK"
+    except KeyError:
+        data = {"status": "erro", "message": "Servico nao reconhecido"}
+    except Exception as e:
+        data = {"status": "erro", "message": str(e)}
+    data["timestamp"] = time.time()
+    socket.send(msgpack.packb({"service": service, "data": data}))
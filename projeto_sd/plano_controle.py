@@ -0,0 +1,103 @@
+import struct
+import itertools
+import threading
+import zmq
+import msgpack
+from configuracao import obter
+
+# Prazo padrão para a resposta de uma chamada, em segundos
+TIMEOUT = float(obter("PLANO_CONTROLE_TIMEOUT", 5))
+
+_instancias = itertools.count(1)
+
+
+class ClienteControle:
+    """Chamadas a um serviço REP ou ROUTER por um único DEALER persistente.
+
+    Uma thread é dona do DEALER; chamadas de qualquer thread chegam a ela por
+    um PUSH inproc e esperam a resposta pelo id. Cada requisição sai como
+    [id, b"", corpo]: REP e ROUTER devolvem o envelope, então várias chamadas
+    podem estar em andamento ao mesmo tempo e uma resposta que chega depois
+    do prazo é só descartada, sem deixar o socket no estado errado como um
+    REQ. A conexão é aberta uma vez e reconectada pelo próprio ZeroMQ.
+    """
+
+    def __init__(self, endereco, contexto=None):
+        self.endereco = endereco
+        self.contexto = contexto or zmq.Context.instance()
+        self.expiradas = 0  # chamadas sem resposta no prazo
+        self._ids = itertools.count(1)
+        self._pendentes = {}  # {id: [Event, resposta]}
+        self._lock = threading.Lock()
+        interno = f"inproc://plano-controle-{next(_instancias)}"
+        self._entrada = self.contexto.socket(zmq.PULL)
+        self._entrada.bind(interno)
+        self._saida = self.contexto.socket(zmq.PUSH)
+        self._saida.connect(interno)
+        self._dealer = self.contexto.socket(zmq.DEALER)
+        self._dealer.setsockopt(zmq.LINGER, 0)
+        self._dealer.connect(endereco)
+        threading.Thread(target=self._executar, daemon=True).start()
+
+    def chamar(self, service, data, timeout=TIMEOUT):
+        """Resposta (dict) da requisição; levanta zmq.Again se não vier a tempo"""
+        id_requisicao = struct.pack("!Q", next(self._ids))
+        pendente = [threading.Event(), None]
+        corpo = msgpack.packb({"service": service, "data": data})
+        with self._lock:
+            self._pendentes[id_requisicao] = pendente
+            self._saida.send_multipart([id_requisicao, corpo])
+        if not pendente[0].wait(timeout):
+            with self._lock:
+                self._pendentes.pop(id_requisicao, None)
+                self.expiradas += 1
+        if pendente[1] is None:
+            raise zmq.Again()
+        return pendente[1]
+
+    def _executar(self):
+        poller = zmq.Poller()
+        poller.register(self._entrada, zmq.POLLIN)
+        poller.register(self._dealer, zmq.POLLIN)
+        try:
+            while True:
+                socks = dict(poller.poll())
+                if self._entrada in socks:
+                    self._enviar_pendentes()
+                if self._dealer in socks:
+                    self._receber_respostas()
+        except zmq.ContextTerminated:
+            self._entrada.close()
+            self._dealer.close()
+
+    def _enviar_pendentes(self):
+        while True:
+            try:
+                id_requisicao, corpo = self._entrada.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            try:
+                self._dealer.send_multipart([id_requisicao, b"", corpo], zmq.NOBLOCK)
+            except zmq.Again:
+                # Fila do DEALER cheia (servidor fora do ar há muito tempo): falha já
+                self._concluir(id_requisicao, None)
+
+    def _receber_respostas(self):
+        while True:
+            try:
+                frames = self._dealer.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            try:
+                resposta = msgpack.unpackb(frames[-1], raw=False)
+            except Exception:
+                resposta = None
+            self._concluir(frames[0], resposta)
+
+    def _concluir(self, id_requisicao, resposta):
+        with self._lock:
+            pendente = self._pendentes.pop(id_requisicao, None)
+        if pendente is None:
+            return  # prazo já vencido
+        pendente[1] = resposta
+        pendente[0].set()
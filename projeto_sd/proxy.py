@@ -1,35 +1,223 @@
-import zmq
+import sys
+from configuracao import configurar
+if __name__ == "__main__":
+    # Antes dos outros imports do projeto, que leem as opções ao carregar
+    configurar(sys.argv[1:])
+import time
+import signal
 import threading
+import zmq
+from topicos import SHARDS, QUADROS
+from metricas import Contador, Medidor, servir as servir_metricas
+from monitoramento import Captura, ProxyControlado, responder_controle
+from configuracao import obter, fixar_cpu
 
-def proxy_channels():
-    context = zmq.Context()
+# Shards do mapa (PROXY_SHARDS) atendidos por este processo, um por thread:
+# índices separados por vírgula ou "todos". Vários containers de proxy usam
+# o mesmo mapa, cada um com os seus índices
+PROXY_SHARDS_LOCAIS = obter("PROXY_SHARDS_LOCAIS", "todos")
+
+# Intervalo para imprimir os contadores de cada shard
+ESTATISTICAS_INTERVALO = float(obter("PROXY_ESTATISTICAS_INTERVALO", 30))
+
+# Cópia do tráfego de cada shard para contar por tópico e acompanhar as
+# inscrições; com 0 ficam só os contadores do próprio proxy
+CAPTURA = obter("PROXY_CAPTURA", "1") == "1"
+
+# Endpoint REQ/REP de estatísticas e controle (stats, pause, resume, terminate)
+CONTROLE_PORTA = int(obter("PROXY_CONTROLE_PORTA", 5590))
+
+# Tempo para entregar o que já estava na fila dos assinantes ao encerrar
+DRENAR_MS = int(obter("PROXY_DRENAR_MS", 1000))
+
+# Portas XSUB:XPUB do canal de replicação legado
+REPLICACAO_PORTAS = obter("PROXY_REPLICACAO_PORTAS", "5570:5571")
+
+# CPUs deste processo ("2" ou "0,1"); vazio usa todas
+CPU = fixar_cpu("PROXY_CPU")
+
+# Métricas no formato do Prometheus em GET /metrics nessa porta (0 desliga).
+# Os contadores dos shards são lidos pela thread principal (o socket de
+# controle de cada shard é dela) a cada METRICAS_INTERVALO segundos
+METRICAS_PORTA = int(obter("PROXY_METRICAS_PORTA", 9103))
+METRICAS_INTERVALO = float(obter("PROXY_METRICAS_INTERVALO", 1))
+
+def criar_shard(context, indice):
+    """XSUB/XPUB de um shard, repassando em uma thread própria"""
+    _, porta_xsub, porta_xpub = SHARDS[indice]
     xsub = context.socket(zmq.XSUB)
-    xsub.bind("tcp://*:5557")
+    xsub.bind(f"tcp://*:{porta_xsub}")
     xpub = context.socket(zmq.XPUB)
-    xpub.bind("tcp://*:5558")
-    print("[PROXY] Channels 5557/5558", flush=True)
-    zmq.proxy(xsub, xpub)
-    xsub.close()
-    xpub.close()
-    context.close()
+    if CAPTURA:
+        # Repassa toda inscrição e cancelamento, não só a primeira/última de cada tópico
+        xpub.setsockopt(zmq.XPUB_VERBOSER, 1)
+    xpub.setsockopt(zmq.LINGER, DRENAR_MS)
+    xpub.bind(f"tcp://*:{porta_xpub}")
+    captura = None
+    if CAPTURA:
+        captura = capturas[indice] = Captura(context, f"shard-{indice}", topico_da_mensagem, inscricoes=True)
+        captura.iniciar()
+    shard = ProxyControlado(context, f"shard-{indice}", xsub, xpub, captura.socket if captura else None)
+    shard.iniciar()
+    print(f"[PROXY] Shard {indice} {porta_xsub}/{porta_xpub}", flush=True)
+    return shard
+
+def topico_da_mensagem(frames):
+    return frames[0].decode("utf-8", "replace")
+
+def estatisticas_shard(indice):
+    """Contadores do proxy (frames convertidos em mensagens) e da captura.
+
+    "repassadas" conta cada mensagem uma vez; as cópias para cada assinante
+    são estimadas pela captura a partir das inscrições ativas. Descartes por
+    fila cheia de um assinante aparecem nele, como lacunas na seq.
+    """
+    contadores = shards[indice].estatisticas()
+    estatisticas = {
+        "shard": indice,
+        "pausado": shards[indice].pausado,
+        "recebidas": contadores["frontend_recebidos"] // QUADROS,
+        "bytes_recebidos": contadores["frontend_bytes_recebidos"],
+        "repassadas": contadores["backend_enviados"] // QUADROS,
+        "proxy": contadores,
+    }
+    captura = capturas.get(indice)
+    if captura is not None:
+        estatisticas["captura"] = captura.estatisticas()
+        # Cópias descartadas pela fila cheia da própria captura
+        estatisticas["captura_perdida"] = max(
+            0, estatisticas["recebidas"] - estatisticas["captura"]["mensagens"])
+    return estatisticas
+
+coletadas = {}  # {shard: estatisticas_shard()} da última leitura
+
+def coletado(campo, subcampo=None):
+    """{(shard,): valor} de um campo da última leitura, para as métricas"""
+    valores = {}
+    for indice, estatisticas in list(coletadas.items()):
+        valor = estatisticas.get(campo)
+        if subcampo is not None:
+            valor = (valor or {}).get(subcampo)
+        if valor is not None:
+            valores[(indice,)] = valor
+    return valores
+
+Contador("proxy_recebidas_total", "Mensagens recebidas dos publicadores", ("shard",),
+         funcao=lambda: coletado("recebidas"))
+Contador("proxy_bytes_recebidos_total", "Bytes recebidos dos publicadores", ("shard",),
+         funcao=lambda: coletado("bytes_recebidos"))
+Contador("proxy_repassadas_total", "Mensagens repassadas aos assinantes (uma vez por mensagem)", ("shard",),
+         funcao=lambda: coletado("repassadas"))
+Medidor("proxy_pausado", "1 se o shard esta pausado", ("shard",),
+        funcao=lambda: {k: int(v) for k, v in coletado("pausado").items()})
+Medidor("proxy_inscricoes_ativas", "Inscricoes ativas dos assinantes", ("shard",),
+        funcao=lambda: coletado("captura", "inscricoes_ativas"))
+Contador("proxy_entregas_esperadas_total", "Copias previstas pelas inscricoes ativas", ("shard",),
+         funcao=lambda: coletado("captura", "entregas_esperadas"))
+Contador("proxy_captura_perdida_total", "Copias descartadas pela fila cheia da captura", ("shard",),
+         funcao=lambda: coletado("captura_perdida"))
+
+def alvos_do_comando(data):
+    """Índices pedidos em data["shard"] (todos se ausente)"""
+    alvos = [data["shard"]] if data.get("shard") is not None else list(shards)
+    if any(indice not in shards for indice in alvos):
+        raise ValueError(f"Shard {data['shard']} nao atendido por este proxy")
+    return alvos
+
+def tratar_controle(service, data):
+    if service == "stats":
+        return {"shards": [estatisticas_shard(i) for i in shards]}
+    if service == "pause":
+        # As mensagens esperam nas filas dos sockets do shard
+        alvos = alvos_do_comando(data)
+        for indice in alvos:
+            shards[indice].parar()
+        return {"shards": alvos}
+    if service == "resume":
+        alvos = alvos_do_comando(data)
+        for indice in alvos:
+            shards[indice].iniciar()
+        return {"shards": alvos}
+    if service == "terminate":
+        encerrando.set()
+        return {"shards": list(shards)}
+    raise KeyError(service)
 
 def proxy_replication():
     context = zmq.Context()
     xsub = context.socket(zmq.XSUB)
-    xsub.bind("tcp://*:5570")
+    porta_xsub, porta_xpub = REPLICACAO_PORTAS.split(":")
+    xsub.bind(f"tcp://*:{porta_xsub}")
     xpub = context.socket(zmq.XPUB)
-    xpub.bind("tcp://*:5571")
-    print("[PROXY] Replication 5570/5571", flush=True)
+    xpub.bind(f"tcp://*:{porta_xpub}")
+    print(f"[PROXY] Replication {porta_xsub}/{porta_xpub}", flush=True)
     zmq.proxy(xsub, xpub)
     xsub.close()
     xpub.close()
     context.close()
 
-threading.Thread(target=proxy_channels, daemon=True).start()
+def sinal_encerrar(*_):
+    encerrando.set()
+
+if PROXY_SHARDS_LOCAIS == "todos":
+    locais = list(range(len(SHARDS)))
+else:
+    locais = [int(i) for i in PROXY_SHARDS_LOCAIS.split(",") if i.strip()]
+
+context = zmq.Context()
+capturas = {}
+encerrando = threading.Event()
+shards = {indice: criar_shard(context, indice) for indice in locais}
 threading.Thread(target=proxy_replication, daemon=True).start()
 
+controle_socket = context.socket(zmq.REP)
+controle_socket.bind(f"tcp://*:{CONTROLE_PORTA}")
+print(f"[PROXY] Controle porta {CONTROLE_PORTA}", flush=True)
+
+if servir_metricas(METRICAS_PORTA):
+    print(f"[PROXY] Metricas porta {METRICAS_PORTA}", flush=True)
+
+signal.signal(signal.SIGTERM, sinal_encerrar)
+
 try:
-    while True:
-        threading.Event().wait(1)
+    anteriores = {}
+    proxima_amostra = time.time() + ESTATISTICAS_INTERVALO
+    proxima_coleta = time.time()
+    while not encerrando.is_set():
+        espera = max(0, proxima_amostra - time.time())
+        if controle_socket.poll(min(espera, 0.5) * 1000):
+            responder_controle(controle_socket, tratar_controle)
+        if METRICAS_PORTA and time.time() >= proxima_coleta:
+            coletadas.update({indice: estatisticas_shard(indice) for indice in shards})
+            proxima_coleta = time.time() + METRICAS_INTERVALO
+        if time.time() < proxima_amostra:
+            continue
+        proxima_amostra = time.time() + ESTATISTICAS_INTERVALO
+        for indice in shards:
+            if indice in capturas:
+                capturas[indice].amostrar()
+            atual = estatisticas_shard(indice)
+            resumo = (atual["recebidas"], atual["repassadas"])
+            if resumo != anteriores.get(indice):
+                linha = (f"[PROXY] Shard {indice}: {atual['recebidas']} mensagens "
+                         f"({atual['bytes_recebidos']} bytes) recebidas, {atual['repassadas']} repassadas")
+                if indice in capturas:
+                    captura = atual["captura"]
+                    linha += (f", ~{captura['entregas_esperadas']} entregas, "
+                              f"{captura['inscricoes_ativas']} inscricoes ativas "
+                              f"(+{captura['inscricoes']}/-{captura['cancelamentos']}), "
+                              f"mais ativos {captura['taxas'][:3]}")
+                print(linha, flush=True)
+                anteriores[indice] = resumo
 except KeyboardInterrupt:
     pass
+finally:
+    # Encerramento gracioso: cada shard para de ler e o XPUB tem DRENAR_MS
+    # para entregar o que já estava na fila dos assinantes
+    print("[PROXY] Encerrando", flush=True)
+    for shard in shards.values():
+        shard.parar()
+        shard.frontend.close(0)
+        shard.backend.close()
+    controle_socket.close()
+    print("[PROXY] Encerrado", flush=True)
@@ -1,33 +1,51 @@
+import sys
+from configuracao import configurar
+if __name__ == "__main__":
+    # Antes dos outros imports do projeto, que leem as opções ao carregar
+    configurar(sys.argv[1:])
 import zmq
-from time import sleep
-import msgpack
+from topicos import SHARDS, conectar_publicacao, shard_do_topico
+from configuracao import obter
+
+# Relay opcional: os servidores publicam direto no proxy por padrão. Com
+# SERVIDOR_PUBLICACAO=publisher nos servidores, este processo assina a PUB de
+# cada réplica e repassa os frames [tópico, cabeçalho, corpo] como chegam,
+# sem decodificar nem copiar, ao shard do proxy responsável pelo tópico
+# Cada item é "host" (porta 5559) ou "host:porta" (SERVIDOR_PORTA_PUBLICACAO
+# do servidor, para vários servidores no mesmo host)
+SERVIDORES = [s.strip() for s in obter("PUBLISHER_SERVIDORES", "servidor").split(",") if s.strip()]
 
 context = zmq.Context()
 
-servidor_sub = context.socket(zmq.SUB)
-servidor_sub.connect("tcp://servidor:5559")
-servidor_sub.setsockopt_string(zmq.SUBSCRIBE, "")
+servidor_sub = context.socket(zmq.XSUB)
+for servidor in SERVIDORES:
+    servidor_sub.connect(f"tcp://{servidor}" if ":" in servidor else f"tcp://{servidor}:5559")
 
-proxy_pub = context.socket(zmq.PUB)
-proxy_pub.connect("tcp://proxy:5557")
+print(f"[PUB] Iniciado, repassando de {', '.join(SERVIDORES)} para {len(SHARDS)} shard(s)", flush=True)
 
-print("[PUB] Iniciado", flush=True)
+def repassar_entre_shards(servidor_sub, proxy_pubs):
+    """Assina tudo nos servidores e envia cada mensagem ao shard do tópico"""
+    servidor_sub.send(b"\x01")
+    while True:
+        frames = servidor_sub.recv_multipart(copy=False)
+        proxy_pubs[shard_do_topico(frames[0].bytes)].send_multipart(frames, copy=False)
 
-while True:
-    try:
-        mensagem_data = servidor_sub.recv()
-        mensagem = msgpack.unpackb(mensagem_data, raw=False)
-        topic = mensagem.get("topic", "")
-        
-        if topic:
-            proxy_pub.send_string(topic, zmq.SNDMORE)
-            proxy_pub.send(msgpack.packb(mensagem))
-        else:
-            proxy_pub.send(msgpack.packb(mensagem))
-    except:
-        pass
-    sleep(0.1)
+if len(SHARDS) == 1:
+    proxy_pubs = [context.socket(zmq.XPUB)]
+    proxy_pubs[0].connect(f"tcp://{SHARDS[0][0]}:{SHARDS[0][1]}")
+else:
+    proxy_pubs = conectar_publicacao(context)
 
-proxy_pub.close()
-servidor_sub.close()
-context.close()
+try:
+    if len(SHARDS) == 1:
+        # Um shard só: as inscrições sobem até os servidores
+        zmq.proxy(servidor_sub, proxy_pubs[0])
+    else:
+        repassar_entre_shards(servidor_sub, proxy_pubs)
+except KeyboardInterrupt:
+    pass
+finally:
+    for sock in proxy_pubs:
+        sock.close()
+    servidor_sub.close()
+    context.term()
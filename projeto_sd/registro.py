@@ -0,0 +1,137 @@
+import sys
+import time
+import queue
+import atexit
+import threading
+from configuracao import obter
+
+# Mensagens abaixo deste nível são descartadas sem formatar
+DEBUG, INFO, AVISO, ERRO = 10, 20, 30, 40
+NIVEIS = {"debug": DEBUG, "info": INFO, "aviso": AVISO, "erro": ERRO}
+NIVEL = NIVEIS.get(str(obter("LOG_NIVEL", "info")).lower(), INFO)
+
+# Linhas por requisição (login, listagem, log.txt...): "0" desliga todas.
+# Na saída padrão ficam limitadas a LOG_REQUISICOES_POR_SEGUNDO por
+# processo (0 = sem limite); as que passam do limite só são contadas
+REQUISICOES = obter("LOG_REQUISICOES", "1") != "0"
+REQUISICOES_POR_SEGUNDO = int(obter("LOG_REQUISICOES_POR_SEGUNDO", 20))
+
+# A thread de escrita grava tudo o que acumulou nesse intervalo de uma vez
+INTERVALO = float(obter("LOG_INTERVALO", 0.2))
+
+_fila = queue.SimpleQueue()  # (caminho ou None para a saída padrão, linha)
+_lock = threading.Lock()
+_arquivos = {}  # {caminho: arquivo aberto}
+
+
+def escrever(linha, caminho=None):
+    """Enfileira a linha para a saída padrão ou para o arquivo (sem bloquear)"""
+    _fila.put((caminho, linha))
+
+
+def _gravar(itens):
+    saida = []
+    por_arquivo = {}
+    for caminho, linha in itens:
+        if caminho is None:
+            saida.append(linha)
+        else:
+            por_arquivo.setdefault(caminho, []).append(linha)
+    for caminho, linhas in por_arquivo.items():
+        try:
+            arquivo = _arquivos.get(caminho)
+            if arquivo is None:
+                arquivo = _arquivos[caminho] = open(caminho, "a", encoding="utf-8")
+            arquivo.write("\n".join(linhas) + "\n")
+            arquivo.flush()
+        except OSError as e:
+            saida.append(f"Erro ao salvar em {caminho}: {e}")
+    if saida:
+        sys.stdout.write("\n".join(saida) + "\n")
+        sys.stdout.flush()
+
+
+def _pendentes(itens):
+    try:
+        while True:
+            itens.append(_fila.get_nowait())
+    except queue.Empty:
+        return itens
+
+
+def _escritor():
+    """Uma escrita (e um flush) por lote, com os arquivos sempre abertos"""
+    while True:
+        itens = [_fila.get()]
+        with _lock:
+            _gravar(_pendentes(itens))
+        time.sleep(INTERVALO)
+
+
+@atexit.register
+def descarregar():
+    """Grava o que ainda está na fila (chamado também ao encerrar)"""
+    with _lock:
+        _gravar(_pendentes([]))
+
+
+threading.Thread(target=_escritor, daemon=True).start()
+
+
+class Registro:
+    """Mensagens de um componente com prefixo ("[S]") e nível.
+
+    Como no módulo logging, a mensagem só é formatada (mensagem % args) se
+    for escrita. requisicao() é para as linhas de cada requisição: obedece
+    a LOG_REQUISICOES e ao limite por segundo, e ao virar o segundo informa
+    quantas linhas foram suprimidas.
+    """
+
+    def __init__(self, prefixo, nivel=None):
+        self.prefixo = prefixo
+        self.nivel = NIVEL if nivel is None else nivel
+        self.suprimidas = 0  # total de linhas de requisição cortadas pelo limite
+        self._janela = 0
+        self._na_janela = 0
+        self._suprimidas_janela = 0
+        self._lock = threading.Lock()
+
+    def registrar(self, nivel, mensagem, *args):
+        if nivel < self.nivel:
+            return
+        escrever(f"{self.prefixo} {mensagem % args if args else mensagem}")
+
+    def debug(self, mensagem, *args):
+        self.registrar(DEBUG, mensagem, *args)
+
+    def info(self, mensagem, *args):
+        self.registrar(INFO, mensagem, *args)
+
+    def aviso(self, mensagem, *args):
+        self.registrar(AVISO, mensagem, *args)
+
+    def erro(self, mensagem, *args):
+        self.registrar(ERRO, mensagem, *args)
+
+    def requisicao(self, mensagem, *args):
+        if not REQUISICOES or INFO < self.nivel or not self._permitir():
+            return
+        self.registrar(INFO, mensagem, *args)
+
+    def _permitir(self):
+        if not REQUISICOES_POR_SEGUNDO:
+            return True
+        segundo = int(time.monotonic())
+        with self._lock:
+            if segundo != self._janela:
+                suprimidas = self._suprimidas_janela
+                self._janela, self._na_janela, self._suprimidas_janela = segundo, 0, 0
+                if suprimidas:
+                    self.registrar(INFO, "%d linhas de requisicao suprimidas (limite %d/s)",
+                                   suprimidas, REQUISICOES_POR_SEGUNDO)
+            if self._na_janela < REQUISICOES_POR_SEGUNDO:
+                self._na_janela += 1
+                return True
+            self._suprimidas_janela += 1
+            self.suprimidas += 1
+            return False
@@ -0,0 +1,80 @@
+import time
+import itertools
+import threading
+
+# Bits da parte lógica no valor empacotado do relógio híbrido: o valor é
+# milissegundos << BITS_LOGICOS | contador, e a ordem dos inteiros é a
+# ordem (físico, lógico) do HLC
+BITS_LOGICOS = 16
+
+
+class RelogioLogico:
+    """Relógio de Lamport seguro entre threads.
+
+    tick() não trava: o next() de itertools.count é atômico no CPython, então
+    dois ticks nunca recebem o mesmo valor. update() só trava quando o valor
+    recebido está à frente, trocando o contador por um que começa depois
+    dele. Valores podem ser pulados e o relógio nunca volta: o que uma thread
+    obtém depois de um tick ou update é maior que o resultado dele. Um
+    update concorrente com um tick pode dar o mesmo valor, o que o relógio
+    de Lamport admite para eventos concorrentes (o desempate é pelo processo).
+    """
+
+    def __init__(self, inicial=0):
+        self._contador = itertools.count(int(inicial) + 1)
+        self._lock = threading.Lock()
+
+    def tick(self):
+        return next(self._contador)
+
+    def update(self, clock_recebido):
+        """Evento de recebimento: retorna um valor maior que os já emitidos e
+        pelo menos igual ao recebido"""
+        clock_recebido = int(clock_recebido)
+        atual = next(self._contador)
+        if clock_recebido < atual:
+            return atual
+        with self._lock:
+            atual = next(self._contador)
+            if clock_recebido < atual:
+                return atual
+            self._contador = itertools.count(clock_recebido + 1)
+            return clock_recebido
+
+    def get(self):
+        """Valor não menor que todos os já emitidos (consome um valor)"""
+        return next(self._contador) - 1
+
+
+class RelogioHibrido(RelogioLogico):
+    """Relógio lógico híbrido (HLC): tempo físico em ms mais um contador.
+
+    Fica sempre perto do relógio físico e, como o de Lamport, nunca volta e
+    respeita a causalidade mesmo com relógios físicos desalinhados. O valor é
+    um inteiro empacotado (ver partes()), então o HLC é um relógio de Lamport
+    que não fica atrás do físico: dentro do mesmo milissegundo tick() só
+    incrementa a parte lógica, sem trava, e a trava só é usada quando o
+    milissegundo avança ou chega um valor à frente.
+    """
+
+    def __init__(self, inicial=0):
+        super().__init__(inicial)
+        self.ajuste_ms = 0  # somado ao relógio físico (ex.: ajuste de Berkeley)
+
+    def _fisico(self):
+        return (time.time_ns() // 1000000 + self.ajuste_ms) << BITS_LOGICOS
+
+    def tick(self):
+        valor = next(self._contador)
+        fisico = self._fisico()
+        if valor >= fisico:
+            return valor
+        return super().update(fisico)
+
+    def update(self, clock_recebido):
+        return super().update(max(int(clock_recebido) + 1, self._fisico()))
+
+    @staticmethod
+    def partes(valor):
+        """(milissegundos, contador lógico) de um valor do relógio"""
+        return valor >> BITS_LOGICOS, valor & ((1 << BITS_LOGICOS) - 1)
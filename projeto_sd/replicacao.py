@@ -0,0 +1,309 @@
+import time
+import queue
+import threading
+from itertools import islice
+from collections import deque
+import zmq
+import msgpack
+from configuracao import obter, endereco_servidor
+from registro import Registro
+
+registrador = Registro("[S]")
+
+# Quantidade máxima de replicações retidas aguardando confirmação
+FILA_MAX = int(obter("REPLICACAO_FILA_MAX", 10000))
+
+# Intervalo para reler a lista de servidores em segundo plano (as mudanças
+# também chegam na hora por definir_membros)
+MEMBROS_INTERVALO = float(obter("REPLICACAO_MEMBROS_INTERVALO", 5))
+
+# Um lote é enviado ao atingir LOTE_MAX operações ou LOTE_INTERVALO segundos
+LOTE_MAX = int(obter("REPLICACAO_LOTE_MAX", 256))
+LOTE_INTERVALO = float(obter("REPLICACAO_LOTE_INTERVALO", 0.005))
+
+# Operações enviadas e ainda não confirmadas por destino (janela)
+JANELA_MAX = int(obter("REPLICACAO_JANELA_MAX", 4096))
+
+# Sem confirmação nesse tempo, reenvia a partir da última seq confirmada
+ACK_TIMEOUT = float(obter("REPLICACAO_ACK_TIMEOUT", 1.0))
+
+
+class Destino:
+    """Estado de envio para um servidor"""
+
+    def __init__(self, confirmado):
+        self.socket = None
+        self.endereco = None
+        self.confirmado = confirmado  # maior seq confirmada (ack cumulativo)
+        self.proximo = confirmado + 1  # próxima seq a enviar
+        self.ultimo_ack = time.time()
+
+
+class Replicador:
+    """Envio de replicações em lotes, numeradas e com confirmação cumulativa.
+
+    Cada escrita recebe uma seq crescente (dentro da época deste processo).
+    Uma única thread é dona dos sockets DEALER (um por servidor), envia lotes
+    por tamanho ou tempo sem esperar a resposta de cada um e retém as
+    operações até todos os destinos confirmarem. Se um destino não confirma
+    em ACK_TIMEOUT ou avisa de uma lacuna, o envio recomeça da última seq que
+    ele confirmou; um servidor que reconecta continua de onde parou.
+    """
+
+    def __init__(self, nome_servidor, porta, obter_lista_servidores, contexto=None):
+        self.nome_servidor = nome_servidor
+        self.porta = porta
+        self.obter_lista_servidores = obter_lista_servidores
+        self.contexto = contexto or zmq.Context.instance()
+        self.epoca = time.time_ns()  # identifica esta execução do servidor
+        self.entrada = queue.Queue(maxsize=FILA_MAX)
+        self.membros = {}  # {nome: endpoint de replicação anunciado}
+        self.destinos = {}  # {nome: Destino}
+        self.retidas = deque()  # [(seq, payload)] ainda não confirmadas por todos
+        self.seq = 0  # última seq atribuída
+        self.enviadas = 0
+        self.reenviadas = 0
+        self.descartadas = 0
+        self.lock = threading.Lock()
+
+    def iniciar(self):
+        threading.Thread(target=self._atualizar_membros, daemon=True).start()
+        threading.Thread(target=self._enviar, daemon=True).start()
+
+    def replicar(self, mensagem):
+        """Enfileira a mensagem para todos os outros servidores (não bloqueia)"""
+        mensagem_copy = mensagem.copy()
+        mensagem_copy["replicated"] = True
+        try:
+            self.entrada.put_nowait(msgpack.packb(mensagem_copy))
+        except queue.Full:
+            with self.lock:
+                self.descartadas += 1
+
+    def profundidade(self):
+        """Quantidade de replicações aguardando confirmação, por servidor"""
+        with self.lock:
+            return {nome: self.seq - d.confirmado for nome, d in self.destinos.items()
+                    if d.socket is not None}
+
+    def estatisticas(self):
+        with self.lock:
+            return {
+                "seq": self.seq,
+                "fila": {nome: self.seq - d.confirmado for nome, d in self.destinos.items()
+                         if d.socket is not None},
+                "entrada": self.entrada.qsize(),
+                "retidas": len(self.retidas),
+                "enviadas": self.enviadas,
+                "reenviadas": self.reenviadas,
+                "descartadas": self.descartadas,
+            }
+
+    def definir_membros(self, lista):
+        """Servidores de destino; a thread de envio ajusta as conexões a eles"""
+        self.membros = {s.get("name"): endereco_servidor(s, "replication", self.porta)
+                        for s in lista if s.get("name") != self.nome_servidor}
+
+    def _atualizar_membros(self):
+        while True:
+            try:
+                self.definir_membros(self.obter_lista_servidores())
+                fila = self.profundidade()
+                if any(fila.values()):
+                    registrador.aviso("Replicacao pendente: %s", fila)
+            except:
+                pass
+            time.sleep(MEMBROS_INTERVALO)
+
+    def _conectar(self, nome, endereco):
+        # destinos só muda com o lock: profundidade() e estatisticas() o
+        # percorrem em outras threads
+        sock = self.contexto.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.IMMEDIATE, 1)  # só enfileira em conexões prontas
+        sock.connect(endereco)
+        with self.lock:
+            destino = self.destinos.get(nome)
+            if destino is None:
+                # Servidor novo: recebe a partir das próximas escritas
+                destino = self.destinos[nome] = Destino(self.seq)
+            destino.socket = sock
+            destino.endereco = endereco
+            destino.ultimo_ack = time.time()
+
+    def _desconectar(self, nome):
+        # Mantém a última seq confirmada para continuar se ele voltar
+        with self.lock:
+            destino = self.destinos[nome]
+            sock, destino.socket = destino.socket, None
+        sock.close()
+
+    def _coletar(self, espera):
+        """Lê da fila de entrada até completar um lote ou vencer o prazo"""
+        novas = []
+        try:
+            novas.append(self.entrada.get(timeout=espera))
+            prazo = time.time() + LOTE_INTERVALO
+            while len(novas) < LOTE_MAX:
+                restante = prazo - time.time()
+                if restante <= 0:
+                    break
+                novas.append(self.entrada.get(timeout=restante))
+        except queue.Empty:
+            pass
+        return novas
+
+    def _reter(self, novas):
+        with self.lock:
+            for payload in novas:
+                self.seq += 1
+                self.retidas.append((self.seq, payload))
+            # Limite de memória: descarta as mais antigas
+            while len(self.retidas) > FILA_MAX:
+                self.retidas.popleft()
+                self.descartadas += 1
+
+    def _liberar(self):
+        """Remove as operações já confirmadas por todos os destinos conhecidos"""
+        limite = min((d.confirmado for d in self.destinos.values()), default=self.seq)
+        with self.lock:
+            while self.retidas and self.retidas[0][0] <= limite:
+                self.retidas.popleft()
+
+    def _enviar_lotes(self, destino):
+        if not self.retidas:
+            return
+        inicio = self.retidas[0][0]
+        if destino.proximo < inicio:
+            destino.proximo = inicio  # o que faltava já foi descartado
+        while destino.proximo <= self.seq and destino.proximo - max(destino.confirmado, inicio - 1) <= JANELA_MAX:
+            pos = destino.proximo - inicio
+            ops = [[seq, payload] for seq, payload in islice(self.retidas, pos, pos + LOTE_MAX)]
+            lote = {
+                "type": "batch",
+                "origin": self.nome_servidor,
+                "epoch": self.epoca,
+                "first": inicio,
+                "ops": ops,
+            }
+            try:
+                destino.socket.send_multipart([b"", msgpack.packb(lote)], zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if destino.proximo <= destino.confirmado + 1:
+                destino.ultimo_ack = time.time()
+            destino.proximo = ops[-1][0] + 1
+            with self.lock:
+                self.enviadas += len(ops)
+
+    def _receber_acks(self, destino):
+        while True:
+            try:
+                frames = destino.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            try:
+                ack = msgpack.unpackb(frames[-1], raw=False)
+            except:
+                continue
+            if ack.get("epoch") != self.epoca:
+                continue
+            seq = ack.get("seq", 0)
+            destino.ultimo_ack = time.time()
+            if seq > destino.confirmado:
+                destino.confirmado = seq
+            if ack.get("gap") and seq + 1 < destino.proximo:
+                # O destino perdeu algo: volta para a primeira seq que falta
+                destino.proximo = seq + 1
+                with self.lock:
+                    self.reenviadas += 1
+
+    def _enviar(self):
+        while True:
+            # Ajusta as conexões à lista de servidores em cache
+            membros = self.membros
+            conectados = {nome: d.endereco for nome, d in self.destinos.items() if d.socket is not None}
+            for nome, endereco in membros.items():
+                if nome in conectados and conectados[nome] != endereco:
+                    # Novo endereço anunciado: continua da última seq confirmada
+                    self._desconectar(nome)
+                if conectados.get(nome) != endereco:
+                    self._conectar(nome, endereco)
+            for nome in conectados.keys() - membros.keys():
+                self._desconectar(nome)
+
+            pendente = any(d.proximo <= self.seq or d.confirmado < self.seq
+                           for d in self.destinos.values() if d.socket is not None)
+            novas = self._coletar(LOTE_INTERVALO if pendente else 0.05)
+            if novas:
+                self._reter(novas)
+
+            agora = time.time()
+            for destino in self.destinos.values():
+                if destino.socket is None:
+                    continue
+                self._receber_acks(destino)
+                if destino.confirmado < destino.proximo - 1 and agora - destino.ultimo_ack > ACK_TIMEOUT:
+                    # Sem confirmação: reenvia tudo a partir da última seq confirmada
+                    destino.proximo = destino.confirmado + 1
+                    destino.ultimo_ack = agora
+                    with self.lock:
+                        self.reenviadas += 1
+                self._enviar_lotes(destino)
+            self._liberar()
+
+
+class ReceptorReplicacao:
+    """Aplica os lotes recebidos em ordem, uma única vez por seq.
+
+    Guarda, por servidor de origem, a época e a última seq aplicada; cada
+    resposta é um ack cumulativo dessa seq. Operações repetidas são ignoradas
+    e, diante de uma lacuna, o lote é interrompido e o ack pede o reenvio.
+    """
+
+    def __init__(self, ultimo=None):
+        self.ultimo = ultimo or {}  # {origem: [epoca, seq]}
+        self.aplicadas = 0
+        self.duplicadas = 0
+        self.perdidas = 0
+        self.falhas = 0  # operações recebidas que deram erro ao aplicar
+
+    def receber(self, lote, aplicar):
+        origem = lote.get("origin")
+        epoca = lote.get("epoch")
+        ops = lote.get("ops", [])
+        estado = self.ultimo.get(origem)
+        if estado is None or estado[0] != epoca:
+            # Primeira vez que vê esta execução da origem
+            estado = self.ultimo[origem] = [epoca, ops[0][0] - 1 if ops else 0]
+
+        inicio = lote.get("first", 0)
+        if estado[1] + 1 < inicio:
+            # A origem já descartou o que faltava
+            self.perdidas += inicio - estado[1] - 1
+            estado[1] = inicio - 1
+
+        lacuna = False
+        for seq, payload in ops:
+            if seq <= estado[1]:
+                self.duplicadas += 1
+                continue
+            if seq > estado[1] + 1:
+                lacuna = True
+                break
+            try:
+                aplicar(msgpack.unpackb(payload, raw=False))
+            except Exception as e:
+                registrador.erro("Erro ao aplicar replicacao %s#%s: %s", origem, seq, e)
+                self.falhas += 1
+            estado[1] = seq
+            self.aplicadas += 1
+
+        ack = {"type": "ack", "origin": origem, "epoch": epoca, "seq": estado[1]}
+        if lacuna:
+            ack["gap"] = True
+        return ack
+
+    def posicoes(self):
+        """Cópia de {origem: [epoca, seq]} para o snapshot"""
+        return {origem: list(estado) for origem, estado in list(self.ultimo.items())}
@@ -1,244 +1,254 @@
+import sys
+from configuracao import configurar
+if __name__ == "__main__":
+    # Antes dos outros imports do projeto, que leem as opções ao carregar
+    configurar(sys.argv[1:])
 import threading
 import zmq
 import msgpack
 import time
-import json
 import os
+from collections import deque, Counter
+from armazenamento import (LogSegmentado, CommitEmGrupo, TravaEscritor, migrar_json,
+                           salvar_instantaneo, carregar_instantaneo)
+from estado import ColecaoPersistente, IndiceMensagens, resposta_listagem
+from replicacao import Replicador, ReceptorReplicacao
+from relogio import RelogioLogico
+from plano_controle import ClienteControle, TIMEOUT as TIMEOUT_CONTROLE
+from membros import VisaoMembros
+from configuracao import (obter, fixar_cpu, endereco_servidor, BROKER_HOST, BROKER_PORTA_SERVIDORES,
+                          REFERENCIA_HOST, REFERENCIA_PORTA, REFERENCIA_PORTA_EVENTOS)
+from registro import Registro, REQUISICOES, escrever
+from metricas import Contador, Medidor, Histograma, Amostras, servir as servir_metricas
+from codec import decodificar, empacotar, codificar, para_formato, resposta_modelo
+from topicos import (Publicador, conectar_publicacao, enderecos_assinatura,
+                     ler_cabecalho, ler_corpo)
+
+registrador = Registro("[S]")
+
+# CPUs deste processo ("2" ou "0,1"), para vários servidores no mesmo host
+# com um núcleo cada; vazio usa todas
+cpus_fixadas = fixar_cpu("SERVIDOR_CPU")
+if cpus_fixadas:
+    registrador.info("Fixado nas CPUs %s", sorted(cpus_fixadas))
 
 # Diretório para persistência de dados
-DATA_DIR = "/app/dados"
+DATA_DIR = obter("SERVIDOR_DADOS", "/app/dados")
 os.makedirs(DATA_DIR, exist_ok=True)
 
-# Porta para receber replicações de outros servidores
-REPLICATION_PORT = 5562
+# Portas para receber replicações e requisições de sincronização/eleição de
+# outros servidores
+REPLICATION_PORT = int(obter("SERVIDOR_PORTA_REPLICACAO", 5562))
+SYNC_PORT = int(obter("SERVIDOR_PORTA_SINCRONIZACAO", 5561))
+PUB_PORT = int(obter("SERVIDOR_PORTA_PUBLICACAO", 5559))  # Porta para publisher
 
-# Função para salvar mensagens no arquivo de log
-def salvar_log(mensagem):
-    try:
-        with open("log.txt", "a", encoding="utf-8") as f:
-            f.write(f"{mensagem}\n")
-    except Exception as e:
-        print(f"Erro ao salvar no log: {e}", flush=True)
+# "privado": cada réplica tem o próprio diretório de dados e os estados
+# convergem só pela replicação (padrão)
+# "compartilhado": as réplicas usam o mesmo volume e só o processo com a
+# trava de escritor grava; os outros acompanham o que ele gravou
+ARMAZENAMENTO_MODO = obter("SERVIDOR_ARMAZENAMENTO", "privado")
+compartilhado = ARMAZENAMENTO_MODO == "compartilhado"
 
-# Função para carregar dados persistidos
-def carregar_dados():
-    usuarios = []
-    canais = []
-    
-    usuarios_path = os.path.join(DATA_DIR, "usuarios.json")
-    canais_path = os.path.join(DATA_DIR, "canais.json")
-    
-    # Carregar usuários
-    if os.path.exists(usuarios_path):
-        try:
-            with open(usuarios_path, "r", encoding="utf-8") as f:
-                usuarios = json.load(f)
-        except:
-            pass
-    
-    if os.path.exists(canais_path):
-        try:
-            with open(canais_path, "r", encoding="utf-8") as f:
-                canais = json.load(f)
-        except:
-            pass
-    
-    return usuarios, canais
+# "duravel": o cliente só recebe a resposta de uma escrita depois do fsync
+# do lote em que ela foi gravada (commit em grupo, padrão); o trabalhador
+# fica livre logo e a resposta espera no loop principal
+# "relaxada": responde logo após gravar; o fsync é feito depois, em lotes
+DURABILIDADE = obter("SERVIDOR_DURABILIDADE", "duravel")
+duravel = DURABILIDADE != "relaxada"
 
-def salvar_usuarios(usuarios):
-    try:
-        usuarios_path = os.path.join(DATA_DIR, "usuarios.json")
-        with open(usuarios_path, "w", encoding="utf-8") as f:
-            json.dump(usuarios, f, indent=2, ensure_ascii=False)
-    except:
-        pass
+# Intervalo para verificar cadastros gravados por outras réplicas
+OBSERVAR_INTERVALO = float(obter("SERVIDOR_OBSERVAR_INTERVALO", 0.2))
 
-def salvar_canais(canais):
-    try:
-        canais_path = os.path.join(DATA_DIR, "canais.json")
-        with open(canais_path, "w", encoding="utf-8") as f:
-            json.dump(canais, f, indent=2, ensure_ascii=False)
-    except:
-        pass
+# Log de requisições (uma linha por requisição), gravado em lote pela
+# thread de registro.py; LOG_REQUISICOES=0 desliga
+LOG_ARQUIVO = obter("SERVIDOR_LOG_ARQUIVO", "log.txt")
+
+# Snapshot do estado em memória: gravado a cada SNAPSHOT_INTERVALO segundos
+# ou SNAPSHOT_REGISTROS registros novos; ao iniciar, só a cauda do log
+# posterior a ele é reaplicada
+SNAPSHOT_CAMINHO = os.path.join(DATA_DIR, "instantaneo.msgpack")
+SNAPSHOT_INTERVALO = float(obter("SERVIDOR_SNAPSHOT_INTERVALO", 60))
+SNAPSHOT_REGISTROS = int(obter("SERVIDOR_SNAPSHOT_REGISTROS", 50000))
+
+inicio_recuperacao = time.time()
+instantaneo = carregar_instantaneo(SNAPSHOT_CAMINHO) or {}
+
+# Logs append-only para cadastros e histórico de publicações e mensagens
+# privadas (os arquivos JSON antigos são migrados uma única vez)
+# (no modo durável o fsync é feito só pelo commit em grupo)
+def abrir_log(nome):
+    if duravel:
+        return LogSegmentado(os.path.join(DATA_DIR, nome), fsync_lote=0, fsync_intervalo=0,
+                             compartilhado=compartilhado)
+    return LogSegmentado(os.path.join(DATA_DIR, nome), compartilhado=compartilhado)
+
+usuarios_log = abrir_log("usuarios")
+canais_log = abrir_log("canais")
+publicacoes_log = abrir_log("publicacoes")
+mensagens_log = abrir_log("mensagens")
+migrar_json(os.path.join(DATA_DIR, "usuarios.json"), usuarios_log)
+migrar_json(os.path.join(DATA_DIR, "canais.json"), canais_log)
+migrar_json(os.path.join(DATA_DIR, "publicacoes.json"), publicacoes_log)
+migrar_json(os.path.join(DATA_DIR, "mensagens.json"), mensagens_log)
+
+# Cada fsync do commit em grupo avisa o loop principal, que libera as
+# respostas adiadas, e a thread dona do estado, que libera os acks de
+# replicação (sockets próprios da thread do commit)
+aviso_commit = threading.local()
+
+def avisar_commit(ticket):
+    socks = getattr(aviso_commit, "sockets", None)
+    if socks is None:
+        socks = aviso_commit.sockets = []
+        for endereco in ("inproc://commits", "inproc://commits_replicacao"):
+            sock = context.socket(zmq.PUSH)
+            sock.connect(endereco)
+            socks.append(sock)
+    for sock in socks:
+        sock.send(str(ticket).encode())
+
+commit = None
+if duravel:
+    commit = CommitEmGrupo([usuarios_log, canais_log, publicacoes_log, mensagens_log], avisar_commit)
+
+# Usuários e canais em memória (lista ordenada + índice por nome)
+usuarios = ColecaoPersistente("user", usuarios_log, instantaneo.get("usuarios"))
+canais = ColecaoPersistente("channel", canais_log, instantaneo.get("canais"))
+
+# Histórico indexado por canal e mensagens privadas por destinatário
+publicacoes = IndiceMensagens("channel", publicacoes_log, instantaneo.get("publicacoes"))
+mensagens = IndiceMensagens("dst", mensagens_log, instantaneo.get("mensagens"))
+
+recuperados = (usuarios, canais, publicacoes, mensagens)
+registrador.info(f"Recuperacao em {time.time() - inicio_recuperacao:.3f}s: "
+                 f"{'snapshot de ' + time.ctime(instantaneo['criado']) if instantaneo else 'sem snapshot'}, "
+                 f"{sum(r.reaplicados for r in recuperados)} registros reaplicados do log "
+                 f"({sum(r.bytes_reaplicados for r in recuperados)} bytes)")
 
 def salvar_publicacao(publicacao):
     try:
-        publicacoes_path = os.path.join(DATA_DIR, "publicacoes.json")
-        publicacoes = []
-        if os.path.exists(publicacoes_path):
-            with open(publicacoes_path, "r", encoding="utf-8") as f:
-                publicacoes = json.load(f)
-        publicacoes.append(publicacao)
-        with open(publicacoes_path, "w", encoding="utf-8") as f:
-            json.dump(publicacoes, f, indent=2, ensure_ascii=False)
-    except:
-        pass
+        publicacoes.anexar(publicacao)
+    except Exception as e:
+        registrador.erro("Erro ao salvar publicacao: %s", e)
 
 def salvar_mensagem_privada(mensagem):
     try:
-        mensagens_path = os.path.join(DATA_DIR, "mensagens.json")
-        mensagens = []
-        if os.path.exists(mensagens_path):
-            with open(mensagens_path, "r", encoding="utf-8") as f:
-                mensagens = json.load(f)
-        mensagens.append(mensagem)
-        with open(mensagens_path, "w", encoding="utf-8") as f:
-            json.dump(mensagens, f, indent=2, ensure_ascii=False)
-    except:
-        pass
+        mensagens.anexar(mensagem)
+    except Exception as e:
+        registrador.erro("Erro ao salvar mensagem: %s", e)
 
-# Função para replicar mensagem para outros servidores
-def replicar_para_outros_servidores(mensagem):
-    def enviar_replicacao():
-        try:
-            mensagem_copy = mensagem.copy()
-            mensagem_copy["replicated"] = True
-            lista_servidores = obter_lista_servidores()
-            
-            for servidor in lista_servidores:
-                nome_servidor = servidor.get("name")
-                if nome_servidor == NOME_SERVIDOR:
-                    continue
-                
-                try:
-                    ctx = zmq.Context()
-                    sock = ctx.socket(zmq.REQ)
-                    sock.connect(f"tcp://{nome_servidor}:{REPLICATION_PORT}")
-                    sock.setsockopt(zmq.RCVTIMEO, 2000)
-                    sock.setsockopt(zmq.SNDTIMEO, 2000)
-                    sock.send(msgpack.packb(mensagem_copy))
-                    sock.recv()
-                    sock.close()
-                    ctx.term()
-                except:
-                    pass
-        except:
-            pass
-    
-    threading.Thread(target=enviar_replicacao, daemon=True).start()
-
-# Classe do relógio lógico
-class RelogioLogico:
-    def __init__(self):
-        self.clock = 0
-    def tick(self):
-        self.clock += 1
-        return self.clock
-    def update(self, clock_recebido):
-        self.clock = max(self.clock, clock_recebido)
-        return self.clock
-    def get(self):
-        return self.clock
-
-relogio = RelogioLogico()
+# Relógio lógico compartilhado por todas as threads (relogio.py)
+relogio = RelogioLogico(instantaneo.get("relogio", 0))
 
 # Variáveis para sincronização e eleição
 import socket as sock
-NOME_SERVIDOR = sock.gethostname()  # Nome único do servidor
+NOME_SERVIDOR = obter("SERVIDOR_NOME", sock.gethostname())  # Nome único do servidor
+
+# Interface das portas deste servidor e host anunciado aos outros servidores
+# pelo servidor de referência (padrão: o nome, que no Docker é o hostname).
+# Com portas diferentes, vários servidores dividem o mesmo host
+ESCUTA = obter("SERVIDOR_ESCUTA", "*")
+HOST_ANUNCIADO = obter("SERVIDOR_ANUNCIADO", NOME_SERVIDOR)
 rank_servidor = None
 coordenador_atual = None
 contador_mensagens = 0
 ajuste_relogio = 0.0  # Ajuste do relógio físico (Berkeley)
 
-# Socket para comunicação com servidor de referência
+# Conexão persistente com o servidor de referência (rank, heartbeat, lista)
 ref_context = zmq.Context()
-ref_socket = ref_context.socket(zmq.REQ)
-ref_socket.connect("tcp://referencia:5560")
+referencia = ClienteControle(f"tcp://{REFERENCIA_HOST}:{REFERENCIA_PORTA}", ref_context)
+
+# Intervalo dos heartbeats ao servidor de referência, que remove da lista um
+# servidor sem heartbeat por REFERENCIA_HEARTBEAT_TIMEOUT (padrão 6 s)
+HEARTBEAT_INTERVALO = float(obter("SERVIDOR_HEARTBEAT_INTERVALO", 2))
+
+# Conexões persistentes com os outros servidores (relógio e eleição), por endpoint
+pares = {}
+pares_lock = threading.Lock()
 
-# Socket PUB para eleições (tópico "servers")
-election_pub_socket = ref_context.socket(zmq.PUB)
-election_pub_socket.connect("tcp://proxy:5557")
+# Sockets PUB para eleições (tópico "servers", no shard do mapa do proxy)
+eleicoes = Publicador(conectar_publicacao(ref_context), NOME_SERVIDOR)
 
 # Socket SUB para eleições
 election_sub_socket = ref_context.socket(zmq.SUB)
-election_sub_socket.connect("tcp://proxy:5558")
+for endereco in enderecos_assinatura(["servers"]):
+    election_sub_socket.connect(endereco)
 election_sub_socket.setsockopt_string(zmq.SUBSCRIBE, "servers")
 
+def endereco_anunciado():
+    """Endereço registrado no servidor de referência para os outros servidores"""
+    return {"host": HOST_ANUNCIADO, "sync": SYNC_PORT, "replication": REPLICATION_PORT,
+            "publication": PUB_PORT}
+
+def cliente_par(nome):
+    """Conexão com o servidor pelo endereço que ele anunciou"""
+    membro = next((m for m in membros.listar() if m["name"] == nome), {"name": nome})
+    endereco = endereco_servidor(membro, "sync", SYNC_PORT)
+    with pares_lock:
+        if endereco not in pares:
+            pares[endereco] = ClienteControle(endereco, ref_context)
+        return pares[endereco]
+
+def chamar_controle(cliente, service, data, timeout=TIMEOUT_CONTROLE):
+    """Requisição com timestamp e relógio; atualiza o relógio com a resposta.
+
+    Levanta zmq.Again se a resposta não chega no prazo.
+    """
+    data = dict(data, timestamp=time.time(), clock=relogio.tick())
+    reply = cliente.chamar(service, data, timeout)
+    if "data" in reply and "clock" in reply["data"]:
+        relogio.update(reply["data"]["clock"])
+    return reply
+
 def registrar_no_servidor_referencia():
     """Registra o servidor e obtém seu rank"""
     global rank_servidor
     try:
-        ref_socket.setsockopt(zmq.RCVTIMEO, 5000)
-        ref_socket.setsockopt(zmq.SNDTIMEO, 5000)
-        
-        request = {
-            "service": "rank",
-            "data": {
-                "user": NOME_SERVIDOR,
-                "timestamp": time.time(),
-                "clock": relogio.tick()
-            }
-        }
-        ref_socket.send(msgpack.packb(request))
-        reply_data = ref_socket.recv()
-        reply = msgpack.unpackb(reply_data, raw=False)
-        
-        if "data" in reply and "clock" in reply["data"]:
-            relogio.update(reply["data"]["clock"])
-        
+        reply = chamar_controle(referencia, "rank", {"user": NOME_SERVIDOR, "address": endereco_anunciado()})
         rank_servidor = reply.get("data", {}).get("rank")
-        print(f"[S] Servidor {NOME_SERVIDOR} registrado com rank {rank_servidor}", flush=True)
-    except:
+        registrador.info("Servidor %s registrado com rank %s", NOME_SERVIDOR, rank_servidor)
+    except zmq.Again:
         rank_servidor = None
 
 def enviar_heartbeat():
     """Envia heartbeat periodicamente ao servidor de referência"""
+    global rank_servidor
     while True:
-        time.sleep(10)  # Enviar a cada 10 segundos
+        time.sleep(HEARTBEAT_INTERVALO)
         try:
-            ctx = zmq.Context()
-            sock = ctx.socket(zmq.REQ)
-            sock.connect("tcp://referencia:5560")
-            
-            request = {
-                "service": "heartbeat",
-                "data": {
-                    "user": NOME_SERVIDOR,
-                    "timestamp": time.time(),
-                    "clock": relogio.tick()
-                }
-            }
-            sock.send(msgpack.packb(request))
-            reply_data = sock.recv()
-            reply = msgpack.unpackb(reply_data, raw=False)
-            
-            if "data" in reply and "clock" in reply["data"]:
-                relogio.update(reply["data"]["clock"])
-            
-            sock.close()
-            ctx.term()
-        except:
-            pass
+            # O rank permite voltar à lista com o mesmo rank se este servidor
+            # foi removido (heartbeats atrasados ou referência reiniciada)
+            reply = chamar_controle(referencia, "heartbeat", {"user": NOME_SERVIDOR, "rank": rank_servidor,
+                                                              "address": endereco_anunciado()})
+        except zmq.Again:
+            registrador.aviso("Heartbeat sem resposta do servidor de referencia")
+            heartbeats_metrica.inc("sem_resposta")
+            continue
+        heartbeats_metrica.inc("ok")
+        data = reply.get("data", {})
+        if data.get("rank") is not None and data["rank"] != rank_servidor:
+            registrador.info("Rank alterado de %s para %s", rank_servidor, data["rank"])
+            rank_servidor = data["rank"]
+        # Evento de membros perdido: a época da resposta está à frente da cópia
+        membros.verificar(data.get("epoch"))
+
+def consultar_membros():
+    """(lista, época) do servidor de referência; levanta zmq.Again sem resposta"""
+    data = chamar_controle(referencia, "list", {}).get("data", {})
+    return data.get("list", []), data.get("epoch")
 
 def obter_lista_servidores():
-    """Obtém a lista de servidores do servidor de referência"""
-    try:
-        ctx = zmq.Context()
-        sock = ctx.socket(zmq.REQ)
-        sock.connect("tcp://referencia:5560")
-        
-        request = {
-            "service": "list",
-            "data": {
-                "timestamp": time.time(),
-                "clock": relogio.tick()
-            }
-        }
-        sock.send(msgpack.packb(request))
-        reply_data = sock.recv()
-        reply = msgpack.unpackb(reply_data, raw=False)
-        
-        if "data" in reply and "clock" in reply["data"]:
-            relogio.update(reply["data"]["clock"])
-        
-        lista = reply.get("data", {}).get("list", [])
-        
-        sock.close()
-        ctx.term()
-        
-        return lista
-    except:
-        return []
+    """Lista de servidores da cópia local (membros.py), sem consulta à rede"""
+    return membros.listar()
+
+def membros_alterados(tipo, nome, rank):
+    replicador.definir_membros(membros.listar())
+    if tipo == "leave" and nome == coordenador_atual and nome != NOME_SERVIDOR and rank_servidor is not None:
+        # Coordenador removido da lista: elege outro sem esperar a próxima sincronização
+        threading.Thread(target=iniciar_eleicao, daemon=True).start()
+
+# Cópia local da lista, atualizada pelos eventos do servidor de referência
+membros = VisaoMembros(f"tcp://{REFERENCIA_HOST}:{REFERENCIA_PORTA_EVENTOS}", consultar_membros, ref_context)
 
 def sincronizar_relogio():
     """Sincroniza o relógio com o coordenador usando algoritmo de Berkeley"""
@@ -249,43 +259,15 @@ def sincronizar_relogio():
         
         if coordenador_atual and coordenador_atual != NOME_SERVIDOR:
             try:
-                # Solicitar horário do coordenador
-                ctx = zmq.Context()
-                sock = ctx.socket(zmq.REQ)
-                
-                # Encontrar endereço do coordenador
-                lista_servidores = obter_lista_servidores()
-                endereco_coord = None
-                
-                for servidor in lista_servidores:
-                    if servidor.get("name") == coordenador_atual:
-                        # Usar nome do container
-                        endereco_coord = f"tcp://{coordenador_atual}:5561"
-                        break
-                
-                if not endereco_coord:
+                # Coordenador ainda registrado no servidor de referência?
+                lista_servidores = membros.listar()
+                if not any(s.get("name") == coordenador_atual for s in lista_servidores):
                     continue
                 
-                sock.connect(endereco_coord)
-                sock.setsockopt(zmq.RCVTIMEO, 5000)
-                
                 t1 = time.time()
-                request = {
-                    "service": "clock",
-                    "data": {
-                        "timestamp": t1,
-                        "clock": relogio.tick()
-                    }
-                }
-                sock.send(msgpack.packb(request))
-                reply_data = sock.recv()
+                reply = chamar_controle(cliente_par(coordenador_atual), "clock", {})
                 t2 = time.time()
                 
-                reply = msgpack.unpackb(reply_data, raw=False)
-                
-                if "data" in reply and "clock" in reply["data"]:
-                    relogio.update(reply["data"]["clock"])
-                
                 tempo_coord = reply.get("data", {}).get("time")
                 
                 if tempo_coord:
@@ -294,22 +276,19 @@ def sincronizar_relogio():
                     tempo_estimado_coord = tempo_coord + (rtt / 2)
                     ajuste_relogio = tempo_estimado_coord - time.time()
                 
-                sock.close()
-                ctx.term()
-                
             except zmq.Again:
                 # Iniciar eleição silenciosamente
                 iniciar_eleicao()
             except:
-                pass
+                erros_metrica.inc("relogio")
 
 def iniciar_eleicao():
     """Inicia o processo de eleição (Bully Algorithm)"""
     global coordenador_atual
     
-    print(f"[S] Iniciando eleição...", flush=True)
+    registrador.info("Iniciando eleição...")
     
-    lista_servidores = obter_lista_servidores()
+    lista_servidores = membros.listar()
     meu_rank = rank_servidor
     
     # Enviar election para servidores com rank maior
@@ -319,64 +298,50 @@ def iniciar_eleicao():
     
     for servidor in servidores_maiores:
         try:
-            ctx = zmq.Context()
-            sock = ctx.socket(zmq.REQ)
-            sock.connect(f"tcp://{servidor['name']}:5561")
-            sock.setsockopt(zmq.RCVTIMEO, 2000)
-            
-            request = {
-                "service": "election",
-                "data": {
-                    "timestamp": time.time(),
-                    "clock": relogio.tick()
-                }
-            }
-            sock.send(msgpack.packb(request))
-            reply_data = sock.recv()
-            reply = msgpack.unpackb(reply_data, raw=False)
-            
+            reply = chamar_controle(cliente_par(servidor["name"]), "election", {}, timeout=2)
             if reply.get("data", {}).get("election") == "OK":
                 recebeu_ok = True
-            
-            sock.close()
-            ctx.term()
-        except:
+        except zmq.Again:
             pass
     
+    eleicoes_metrica.inc("perdeu" if recebeu_ok else "venceu")
     if not recebeu_ok:
         coordenador_atual = NOME_SERVIDOR
-        pub_msg = {
-            "type": "election",
-            "topic": "servers",
-            "service": "election",
-            "data": {
-                "coordinator": NOME_SERVIDOR,
-                "timestamp": time.time(),
-                "clock": relogio.tick()
-            }
-        }
-        election_pub_socket.send_string("servers", zmq.SNDMORE)
-        election_pub_socket.send(msgpack.packb(pub_msg))
+        eleicoes.publicar("servers", "election", relogio.tick(), {
+            "coordinator": NOME_SERVIDOR,
+            "timestamp": time.time()
+        })
 
 def monitor_eleicoes():
     global coordenador_atual
     while True:
         try:
-            topic = election_sub_socket.recv_string()
-            msg_data = election_sub_socket.recv()
-            msg = msgpack.unpackb(msg_data, raw=False)
+            frames = election_sub_socket.recv_multipart()
+            topic, tipo, clock, origem, seq = ler_cabecalho(frames)
             
-            if msg.get("type") == "election":
-                novo_coord = msg.get("data", {}).get("coordinator")
+            if tipo == "election":
+                novo_coord = ler_corpo(frames).get("coordinator")
                 if novo_coord:
                     coordenador_atual = novo_coord
-                    if "clock" in msg.get("data", {}):
-                        relogio.update(msg["data"]["clock"])
+                    relogio.update(clock)
         except:
-            pass
+            erros_metrica.inc("eleicao")
+
+# Envio de replicações com conexões persistentes e lista de servidores em cache
+replicador = Replicador(NOME_SERVIDOR, REPLICATION_PORT, obter_lista_servidores)
+
+def replicar_para_outros_servidores(mensagem):
+    replicador.replicar(mensagem)
 
-time.sleep(3)
-registrar_no_servidor_referencia()
+# Sem espera fixa: o pedido sai assim que o servidor de referência aceitar a
+# conexão, com algumas tentativas se ele ainda estiver subindo
+for _ in range(3):
+    registrar_no_servidor_referencia()
+    if rank_servidor is not None:
+        break
+membros.ao_mudar(membros_alterados)
+membros.iniciar()
+replicador.iniciar()
 
 if rank_servidor is not None:
     threading.Thread(target=enviar_heartbeat, daemon=True).start()
@@ -385,372 +350,761 @@ if rank_servidor is not None:
     if rank_servidor == 1:
         coordenador_atual = NOME_SERVIDOR
 
-PUB_PORT = 5559  # Porta para publisher
+PUBLICACAO = obter("SERVIDOR_PUBLICACAO", "proxy")
+
+# Quantidade de threads que atendem as requisições vindas do broker
+TRABALHADORES = int(obter("SERVIDOR_TRABALHADORES", 4))
+
+# Maior página aceita em "limit" nas listagens de usuários e canais
+LISTAGEM_LIMITE_MAX = int(obter("SERVIDOR_LISTAGEM_LIMITE_MAX", 1000))
+
+# Página padrão de "history" e "inbox" quando o cliente não informa "limit"
+HISTORICO_LIMITE = int(obter("SERVIDOR_HISTORICO_LIMITE", 100))
+
+# Serviços que alteram o estado: executados somente pela thread dona do estado
+SERVICOS_ESCRITA = {"login", "channel", "publish", "message"}
+# Serviços somente de leitura: atendidos direto pelo trabalhador
+SERVICOS_LEITURA = {"users", "listar", "channels", "history", "inbox"}
+
+# Campos (texto não vazio) sem os quais uma escrita é recusada antes de
+# chegar à thread dona do estado
+CAMPOS_OBRIGATORIOS = {
+    "login": ("user",),
+    "channel": ("channel",),
+    "publish": ("user", "channel"),
+    "message": ("src", "dst"),
+}
+
+# Escritas indexadas pelo timestamp (histórico e caixa de entrada): sem ele
+# recebem a hora do servidor; um timestamp que não é número é recusado
+SERVICOS_COM_TIMESTAMP = {"publish", "message"}
+
+# Métricas no formato do Prometheus em GET /metrics nessa porta (0 desliga)
+METRICAS_PORTA = int(obter("SERVIDOR_METRICAS_PORTA", 9101))
+
+# Serviços fora da lista contam como "outro", para o número de séries não
+# crescer com o que os clientes mandam
+requisicoes_metrica = Contador("servidor_requisicoes_total", "Requisicoes de clientes atendidas",
+                               ("servico", "formato"))
+latencia_metrica = Histograma("servidor_requisicao_segundos",
+                              "Tempo de atendimento no trabalhador (sem a espera do fsync)", ("servico",))
+erros_metrica = Contador("servidor_erros_total", "Excecoes tratadas sem resposta de erro", ("origem",))
+heartbeats_metrica = Contador("servidor_heartbeats_total", "Heartbeats ao servidor de referencia",
+                              ("resultado",))
+eleicoes_metrica = Contador("servidor_eleicoes_total", "Eleicoes iniciadas por este servidor",
+                            ("resultado",))
+
+
+def contar_requisicoes(eventos):
+    """[(serviço, formato, segundos ou None)] anotados pelos trabalhadores"""
+    for (servico, formato), quantidade in Counter(evento[:2] for evento in eventos).items():
+        requisicoes_metrica.inc(servico, formato, valor=quantidade)
+    duracoes = {}
+    for servico, _, duracao in eventos:
+        if duracao is not None:
+            duracoes.setdefault(servico, []).append(duracao)
+    for servico, valores in duracoes.items():
+        latencia_metrica.observar_varios(valores, servico)
+
+
+# Os trabalhadores só anotam; a contagem sai do caminho da requisição
+requisicoes_amostras = Amostras(contar_requisicoes)
+
+Medidor("servidor_coordenador", "1 se este servidor e o coordenador",
+        funcao=lambda: int(coordenador_atual == NOME_SERVIDOR))
+Medidor("servidor_ajuste_relogio_segundos", "Ajuste do relogio fisico em relacao ao coordenador (Berkeley)",
+        funcao=lambda: ajuste_relogio)
+Medidor("servidor_membros", "Servidores na copia local da lista", funcao=lambda: len(membros.listar()))
+Contador("servidor_membros_ressincronizacoes_total", "Releituras da lista completa de servidores",
+         funcao=lambda: membros.ressincronizacoes)
+Contador("servidor_replicacao_enviadas_total", "Operacoes de replicacao enviadas",
+         funcao=lambda: replicador.estatisticas()["enviadas"])
+Contador("servidor_replicacao_reenviadas_total", "Operacoes reenviadas por falta de ack",
+         funcao=lambda: replicador.estatisticas()["reenviadas"])
+Contador("servidor_replicacao_descartadas_total", "Operacoes descartadas com a fila cheia",
+         funcao=lambda: replicador.estatisticas()["descartadas"])
+Medidor("servidor_replicacao_pendentes", "Operacoes ainda sem ack, por destino", ("destino",),
+        funcao=lambda: replicador.estatisticas()["fila"])
+Contador("servidor_replicacao_recebidas_total", "Operacoes de replicacao recebidas", ("resultado",),
+         funcao=lambda: {"aplicadas": receptor_replicacao.aplicadas,
+                         "duplicadas": receptor_replicacao.duplicadas,
+                         "perdidas": receptor_replicacao.perdidas,
+                         "falhas": receptor_replicacao.falhas})
+
+# Modo do broker: "balanceado" (anuncia trabalhadores livres e troca
+# heartbeats) ou "proxy" (DEALER com round-robin)
+BROKER_MODO = obter("BROKER_MODO", "balanceado")
+
+# Sinais trocados com o broker no modo balanceado (mesmos valores em broker.py)
+SINAL_PRONTO = b"\x01"
+SINAL_HEARTBEAT = b"\x02"
+SINAL_REANUNCIAR = b"\x03"
+SINAL_ADIADA = b"\x04"  # resposta liberada depois, não devolve crédito ao broker
+HEARTBEAT_BROKER_INTERVALO = float(obter("BROKER_HEARTBEAT_INTERVALO", 1.0))
+HEARTBEAT_BROKER_VIVACIDADE = int(obter("BROKER_HEARTBEAT_VIVACIDADE", 3))
 
 context = zmq.Context()
-socket = context.socket(zmq.REP)
-socket.connect("tcp://broker:5556")
 
-# Socket para responder requisições de sincronização e eleição
-sync_socket = context.socket(zmq.REP)
-sync_socket.bind("tcp://*:5561")
+# Socket para responder requisições de sincronização e eleição (ROUTER:
+# responde com o envelope de cada chamada, REQ ou DEALER)
+sync_socket = context.socket(zmq.ROUTER)
+sync_socket.bind(f"tcp://{ESCUTA}:{SYNC_PORT}")
 
-replication_socket = context.socket(zmq.REP)
-replication_socket.bind(f"tcp://*:{REPLICATION_PORT}")
+# ROUTER: recebe lotes de vários servidores e confirma sem bloquear o envio
+replication_socket = context.socket(zmq.ROUTER)
+replication_socket.bind(f"tcp://{ESCUTA}:{REPLICATION_PORT}")
+# Posições do snapshot: o que foi aplicado depois dele chega de novo e as
+# duplicatas são descartadas pelos índices
+receptor_replicacao = ReceptorReplicacao(instantaneo.get("replicacao"))
 
-pub_socket = context.socket(zmq.PUB)
-pub_socket.bind(f"tcp://*:{PUB_PORT}")
+def gravar_instantaneos():
+    """Grava um snapshot quando há registros novos e o prazo ou a quantidade vence"""
+    gravado_em = time.time()
+    gravados = sum(r.aplicado for r in recuperados)
+    while True:
+        time.sleep(1)
+        try:
+            aplicados = sum(r.aplicado for r in recuperados)
+            novos = aplicados - gravados
+            if not usuarios.gravar or novos <= 0:
+                continue  # no volume compartilhado só o escritor grava o snapshot
+            if novos < SNAPSHOT_REGISTROS and time.time() - gravado_em < SNAPSHOT_INTERVALO:
+                continue
+            inicio = time.time()
+            estado = {
+                "criado": inicio,
+                "usuarios": usuarios.instantaneo(),
+                "canais": canais.instantaneo(),
+                "publicacoes": publicacoes.instantaneo(),
+                "mensagens": mensagens.instantaneo(),
+                "replicacao": receptor_replicacao.posicoes(),
+                "relogio": relogio.get(),
+            }
+            # O snapshot nunca fica à frente do que está em disco no log
+            for r in recuperados:
+                r.log.sincronizar()
+            tamanho = salvar_instantaneo(SNAPSHOT_CAMINHO, estado)
+            gravado_em, gravados = time.time(), aplicados
+            registrador.info("Snapshot gravado: %d bytes em %.3fs", tamanho, gravado_em - inicio)
+        except Exception as e:
+            registrador.erro("Erro ao gravar snapshot: %s", e)
 
-# Carregar dados persistidos
-usuarios, canais = carregar_dados()
+threading.Thread(target=gravar_instantaneos, daemon=True).start()
 
-def recarregar_dados_periodicamente():
-    global usuarios, canais
+# Publicações e mensagens privadas saem como [tópico, cabeçalho, corpo]
+# (topicos.py) direto para o XSUB do shard do proxy responsável pelo tópico;
+# com SERVIDOR_PUBLICACAO=publisher o servidor faz bind na PUB_PORT e o relay
+# publisher.py distribui entre os shards
+if PUBLICACAO == "publisher":
+    pub_socket = context.socket(zmq.PUB)
+    pub_socket.setsockopt(zmq.LINGER, 0)
+    pub_socket.bind(f"tcp://{ESCUTA}:{PUB_PORT}")
+    publicador = Publicador([pub_socket], NOME_SERVIDOR)
+else:
+    publicador = Publicador(conectar_publicacao(context), NOME_SERVIDOR)
+
+def acompanhar_alteracoes(trava):
+    """Volume compartilhado: disputa a trava de escritor e aplica em memória
+    apenas os cadastros e mensagens novos gravados pelo escritor"""
+    armazenamentos = (usuarios, canais, publicacoes, mensagens)
     while True:
-        time.sleep(2)
         try:
-            usuarios_novos, canais_novos = carregar_dados()
-            usuarios = usuarios_novos
-            canais = canais_novos
+            if not usuarios.gravar and trava.tentar():
+                registrador.info("%s agora e o escritor de %s", NOME_SERVIDOR, DATA_DIR)
+                for armazenamento in armazenamentos:
+                    armazenamento.gravar = True
+            for armazenamento in armazenamentos:
+                armazenamento.acompanhar()
         except:
             pass
+        time.sleep(OBSERVAR_INTERVALO)
 
-threading.Thread(target=recarregar_dados_periodicamente, daemon=True).start()
+if compartilhado:
+    for armazenamento in (usuarios, canais, publicacoes, mensagens):
+        armazenamento.gravar = False
+    threading.Thread(target=acompanhar_alteracoes, args=(TravaEscritor(DATA_DIR, NOME_SERVIDOR),),
+                     daemon=True).start()
 
-poller = zmq.Poller()
-poller.register(socket, zmq.POLLIN)
-poller.register(sync_socket, zmq.POLLIN)
-poller.register(replication_socket, zmq.POLLIN)
+def aplicar_replicacao(request):
+    """Aplica localmente uma operação recebida de outro servidor"""
+    if not request.get("replicated"):
+        return
+    service = request.get("service")
+    data = request.get("data", {})
+    
+    if "clock" in data:
+        relogio.update(data["clock"])
+    
+    if service == "login":
+        user = data.get("user")
+        if usuarios.adicionar({"user": user, "timestamp": data.get("timestamp")}):
+            registrador.requisicao("Replicado usuario: %s", user)
+    
+    elif service == "channel":
+        channel = data.get("channel")
+        if canais.adicionar({
+            "channel": channel,
+            "timestamp": data.get("timestamp")
+        }):
+            registrador.requisicao("Replicado canal: %s", channel)
+    
+    elif service == "publish":
+        salvar_publicacao({
+            "user": data.get("user"),
+            "channel": data.get("channel"),
+            "message": data.get("message"),
+            "timestamp": data.get("timestamp")
+        })
+    
+    elif service == "message":
+        salvar_mensagem_privada({
+            "src": data.get("src"),
+            "dst": data.get("dst"),
+            "message": data.get("message"),
+            "timestamp": data.get("timestamp")
+        })
 
-print(f"[S] {NOME_SERVIDOR} pronto", flush=True)
+# Escritas enviadas pelos trabalhadores para a thread dona do estado
+escritas_socket = context.socket(zmq.ROUTER)
+escritas_socket.bind("inproc://escritas")
 
-while True:
-    try:
-        socks = dict(poller.poll())
-        
-        if socket in socks:
-            request_data = socket.recv()
-            print(f"[S] Recebido {len(request_data)} bytes", flush=True)
+def processar_escrita(service, data):
+    """Executa um serviço que altera o estado (apenas na thread dona do estado)"""
+    match service:
+        case "login":
+            user = data.get("user")
+            timestamp = data.get("timestamp")
             
-            # Detectar formato: MessagePack ou JSON
-            formato_json = False
-            try:
-                request = msgpack.unpackb(request_data, raw=False)
-                print(f"[S] Formato: MessagePack", flush=True)
-            except:
-                try:
-                    request = json.loads(request_data.decode('utf-8'))
-                    formato_json = True
-                    print(f"[S] Formato: JSON", flush=True)
-                    print(f"[S] Request: {request}", flush=True)
-                except Exception as e:
-                    print(f"[S] Erro ao parsear: {e}", flush=True)
-                    continue
-            
-            service = request.get("service", request.get("opcao"))
-            data = request.get("data", request.get("dados"))
+            # Verificar se o usuário já existe
+            if user in usuarios:
+                reply = resposta_modelo("login", time.time(), relogio.tick(),
+                                       status="erro", description="Usuário já cadastrado")
+                registrador.requisicao("- Tentativa de login com usuário existente: %s", user)
+            else:
+                # Adicionar novo usuário
+                usuarios.adicionar({
+                    "user": user,
+                    "timestamp": timestamp
+                })  # Persiste no log de usuários
+                
+                reply = resposta_modelo("login", time.time(), relogio.tick(), status="sucesso")
+                registrador.requisicao("Login: %s", user)
+                replicar_para_outros_servidores({"service": "login", "data": data})
+
+        case "channel":
+            channel = data.get("channel")
+            timestamp = data.get("timestamp")
             
-            salvar_log(f"[{time.time()}] {service}")
+            if channel in canais:
+                reply = resposta_modelo("channel", time.time(), relogio.tick(),
+                                       status="erro", description="Canal já cadastrado")
+                registrador.requisicao("- Tentativa de cadastro com canal existente: %s", channel)
+            else:
+                canais.adicionar({
+                    "channel": channel,
+                    "timestamp": timestamp
+                })
+                
+                reply = resposta_modelo("channel", time.time(), relogio.tick(), status="sucesso")
+                registrador.requisicao("Canal: %s", channel)
+                replicar_para_outros_servidores({"service": "channel", "data": data})
+
+        case "publish":
+            user = data.get("user")
+            channel = data.get("channel")
+            message = data.get("message")
+            timestamp = data.get("timestamp")
+            if channel not in canais:
+                reply = resposta_modelo("publish", time.time(), relogio.tick(),
+                                       status="erro", message="Canal nao existe")
+            else:
+                publicacao = {"user": user, "channel": channel, "message": message, "timestamp": timestamp}
+                publicador.publicar(channel, "channel", relogio.get(), publicacao)
+                salvar_publicacao(publicacao)
+                
+                reply = resposta_modelo("publish", time.time(), relogio.tick(), status="OK")
+                registrador.requisicao("Publicado: %s", channel)
+                replicar_para_outros_servidores({"service": "publish", "data": data})
+
+        case "message":
+            src = data.get("src")
+            dst = data.get("dst")
+            message = data.get("message")
+            timestamp = data.get("timestamp")
+            if dst not in usuarios:
+                reply = resposta_modelo("message", time.time(), relogio.tick(),
+                                       status="erro", message="Usuario nao existe")
+            else:
+                mensagem_privada = {"src": src, "dst": dst, "message": message, "timestamp": timestamp}
+                publicador.publicar(dst, "user", relogio.get(), mensagem_privada)
+                salvar_mensagem_privada(mensagem_privada)
+                
+                reply = resposta_modelo("message", time.time(), relogio.tick(), status="OK")
+                registrador.requisicao("Mensagem: %s -> %s", src, dst)
+                replicar_para_outros_servidores({"service": "message", "data": data})
+
+    return reply
+
+def sem_durabilidade(reply):
+    """Marca a resposta de escrita com "durable": False.
+
+    No volume compartilhado, uma réplica que não é a escritora guarda a
+    escrita só em memória; ela chega ao disco quando o escritor aplica a
+    replicação, então não há fsync para a resposta esperar.
+    """
+    resposta = msgpack.unpackb(reply, raw=False)
+    resposta.setdefault("data", {})["durable"] = False
+    return empacotar(resposta)
+
+def parametros_listagem(data):
+    """Argumentos de resposta_listagem() para uma listagem.
+
+    Aceita "since_version" com a "replica" que deu essa versão (só o que foi
+    cadastrado depois dela; vindo de outra réplica, a lista completa), ou uma
+    página em ordem alfabética com "limit" e "cursor" (o "next_cursor" da
+    página anterior) ou "offset".
+    """
+    limite = data.get("limit")
+    if limite is not None:
+        limite = min(int(limite), LISTAGEM_LIMITE_MAX)
+        if limite <= 0:
+            raise ValueError("limite invalido")
+    cursor = data.get("cursor")
+    if data.get("since_version") is not None:
+        if limite is not None or cursor is not None:
+            raise ValueError("since_version nao combina com limit ou cursor")
+        desde = int(data["since_version"])
+        if desde < 0:
+            raise ValueError("versao invalida")
+        # A versão é uma posição na ordem de chegada da réplica que a deu
+        if data.get("replica") != NOME_SERVIDOR:
+            desde = 0
+        return {"desde_versao": desde}
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError("cursor invalido")
+    inicio = int(data.get("offset") or 0)
+    if inicio < 0:
+        raise ValueError("posicao invalida")
+    return {"depois": cursor, "inicio": inicio, "limite": limite}
+
+def parametros_historico(data):
+    """Início ("since" ou "cursor") e limite de uma consulta de histórico"""
+    cursor = data.get("cursor")
+    if cursor is not None:
+        timestamp, seq = str(cursor).rsplit(":", 1)
+        cursor = (float(timestamp), int(seq))
+    desde = data.get("since")
+    if desde is not None:
+        desde = float(desde)
+    limite = min(int(data.get("limit") or HISTORICO_LIMITE), LISTAGEM_LIMITE_MAX)
+    if limite <= 0:
+        raise ValueError("limite invalido")
+    return desde, cursor, limite
+
+def processar_leitura(service, data, formato_json):
+    """Executa um serviço somente de leitura (em qualquer trabalhador)"""
+    match service:
+        case "users" | "listar" | "channels":
+            campo = "channels" if service == "channels" else "users"
+            colecao = canais if service == "channels" else usuarios
+            try:
+                consulta = parametros_listagem(data)
+            except (TypeError, ValueError) as e:
+                return {
+                    "service": campo,
+                    "data": {
+                        "status": "erro",
+                        "timestamp": time.time(),
+                        "description": f"Parametros de listagem invalidos: {e}",
+                        "clock": relogio.tick()
+                    }
+                }
+            registrador.requisicao("Listando %s: %d %s", campo, len(colecao), consulta)
             
-            if data and "clock" in data:
-                relogio.update(data["clock"])
+            # Resposta montada a partir da lista já serializada (ou só da parte pedida)
+            reply = resposta_listagem(campo, campo, colecao, time.time(), relogio.tick(), formato_json,
+                                      NOME_SERVIDOR, **consulta)
+
+        case "history" | "inbox":
+            # Histórico de um canal ou mensagens privadas recebidas por um usuário
+            campo = "channel" if service == "history" else "user"
+            indice = publicacoes if service == "history" else mensagens
+            chave = data.get(campo)
+            try:
+                desde, cursor, limite = parametros_historico(data)
+            except (TypeError, ValueError) as e:
+                return {
+                    "service": service,
+                    "data": {
+                        "status": "erro",
+                        "timestamp": time.time(),
+                        "description": f"Parametros de consulta invalidos: {e}",
+                        "clock": relogio.tick()
+                    }
+                }
             
-            contador_mensagens += 1
+            registros, proximo = indice.consultar(chave, desde, cursor, limite)
+            registrador.requisicao("Consulta %s de %s: %d mensagens", service, chave, len(registros))
             
-            match service:
-                case "login":
-                    user = data.get("user")
-                    timestamp = data.get("timestamp")
-                    
-                    # Verificar se o usuário já existe
-                    usuario_existe = any(u.get("user") == user for u in usuarios)
-                    
-                    if usuario_existe:
-                        reply = {
-                            "service": "login",
-                            "data": {
-                                "status": "erro",
-                                "timestamp": time.time(),
-                                "description": "Usuário já cadastrado",
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] - Tentativa de login com usuário existente: {user}", flush=True)
-                    else:
-                        # Adicionar novo usuário
-                        usuarios.append({
-                            "user": user,
-                            "timestamp": timestamp
-                        })
-                        salvar_usuarios(usuarios)  # Persistir em disco
-                        
-                        reply = {
-                            "service": "login",
-                            "data": {
-                                "status": "sucesso",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] Login: {user}", flush=True)
-                        replicar_para_outros_servidores({"service": "login", "data": data})
+            reply = {
+                "service": service,
+                "data": {
+                    "timestamp": time.time(),
+                    campo: chave,
+                    "messages": registros,
+                    "next_cursor": f"{proximo[0]!r}:{proximo[1]}" if proximo else None,
+                    "clock": relogio.tick()
+                }
+            }
 
-                case "users" | "listar":
-                    lista_usuarios = [u.get("user") for u in usuarios]
-                    print(f"[S] Listando usuarios: {len(usuarios)}", flush=True)
-                    
-                    reply = {
-                        "service": "users",
-                        "data": {
-                            "timestamp": time.time(),
-                            "users": lista_usuarios,
-                            "clock": relogio.tick()
-                        }
-                    }
+        case _ :
+            reply = resposta_modelo(service if service else "unknown", time.time(), relogio.tick(),
+                                   formato_json, status="erro", description="Serviço não encontrado")
+
+    return reply
+
+def campo_invalido(service, data):
+    """Descrição do problema dos dados da requisição, ou None se estão ok
+    (completa o timestamp que faltar)"""
+    if not isinstance(data, dict):
+        return "Dados invalidos"
+    if not isinstance(service, str):
+        return None
+    for campo in CAMPOS_OBRIGATORIOS.get(service, ()):
+        valor = data.get(campo)
+        if not isinstance(valor, str) or not valor:
+            return f"Campo {campo} obrigatorio"
+    if service in SERVICOS_COM_TIMESTAMP:
+        timestamp = data.get("timestamp")
+        if timestamp is None:
+            data["timestamp"] = time.time()
+        elif isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+            return "Campo timestamp invalido"
+    return None
+
+def processar_requisicao(request_data, escritas, anotar):
+    """Decodifica, atende e codifica a resposta de uma requisição de cliente"""
+    global contador_mensagens
+    inicio = time.perf_counter()
+    
+    # Formato pelo primeiro byte; a resposta sai no mesmo formato
+    try:
+        request, formato_json = decodificar(request_data)
+    except ValueError as e:
+        registrador.requisicao("Erro ao parsear %d bytes: %s", len(request_data), e)
+        request, formato_json = {}, False
+    if not isinstance(request, dict):
+        request = {}
+    
+    service = request.get("service", request.get("opcao"))
+    data = request.get("data", request.get("dados")) or {}
+    invalido = campo_invalido(service, data)
+    if invalido is not None:
+        registrador.requisicao("- Requisicao %s recusada: %s", service, invalido)
+        reply = resposta_modelo(service if isinstance(service, str) else None, time.time(),
+                                relogio.tick(), formato_json, status="erro", description=invalido)
+        anotar(("outro", "json" if formato_json else "msgpack", None))
+        return reply, None
+    
+    if REQUISICOES:
+        escrever(f"[{time.time()}] {service}", LOG_ARQUIVO)
+    
+    if "clock" in data:
+        relogio.update(data["clock"])
+    
+    contador_mensagens += 1
+    
+    if service in SERVICOS_ESCRITA:
+        # Escritas são serializadas pela thread dona do estado
+        escritas.send(empacotar({"service": service, "data": data}))
+        partes = escritas.recv_multipart()
+        # Resposta já em MessagePack: só é convertida para clientes JSON
+        reply = para_formato(partes[0], formato_json)
+        # Modo durável: ticket do fsync que a resposta deve esperar
+        ticket = partes[1] if len(partes) > 1 else None
+    else:
+        reply = processar_leitura(service, data, formato_json)
+        ticket = None
+    
+    reply = codificar(reply, formato_json)
+    servico = service if service in SERVICOS_ESCRITA or service in SERVICOS_LEITURA else "outro"
+    anotar((servico, "json" if formato_json else "msgpack", time.perf_counter() - inicio))
+    return reply, ticket
+
+def trabalhador():
+    """Atende as requisições repassadas pelo balanceador interno"""
+    trabalhador_socket = context.socket(zmq.REQ)
+    trabalhador_socket.connect("inproc://trabalhadores")
+    escritas = context.socket(zmq.REQ)
+    escritas.connect("inproc://escritas")
+    anotar = requisicoes_amostras.anotador()
+    
+    trabalhador_socket.send(b"READY")
+    while True:
+        frames = trabalhador_socket.recv_multipart()
+        envelope, request_data = frames[:-1], frames[-1]
+        ticket = None
+        try:
+            reply, ticket = processar_requisicao(request_data, escritas, anotar)
+        except Exception as e:
+            registrador.erro("Erro ao processar requisicao: %s", e)
+            erros_metrica.inc("requisicao")
+            reply = resposta_modelo("unknown", time.time(), relogio.tick(),
+                                   status="erro", description="Erro interno")
+        if ticket is not None:
+            # Resposta só sai depois do fsync; o trabalhador já fica livre
+            trabalhador_socket.send_multipart([SINAL_ADIADA, ticket] + envelope + [reply])
+        else:
+            trabalhador_socket.send_multipart(envelope + [reply])
+
+def dono_do_estado():
+    """Única thread que altera o estado: escritas dos trabalhadores,
+    replicações recebidas e requisições de sincronização/eleição"""
+    poller = zmq.Poller()
+    poller.register(escritas_socket, zmq.POLLIN)
+    poller.register(sync_socket, zmq.POLLIN)
+    poller.register(replication_socket, zmq.POLLIN)
+    # Acks de replicação só saem depois do fsync das operações que confirmam;
+    # senão o remetente as descarta e uma queda aqui as perderia
+    acks_adiados = []  # [(ticket, resposta)]
+    commits_replicacao = context.socket(zmq.PULL)
+    commits_replicacao.bind("inproc://commits_replicacao")
+    poller.register(commits_replicacao, zmq.POLLIN)
+    
+    while True:
+        try:
+            socks = dict(poller.poll())
             
-                case "channel":
-                    channel = data.get("channel")
-                    timestamp = data.get("timestamp")
+            if escritas_socket in socks:
+                frames = escritas_socket.recv_multipart()
+                request = None
+                try:
+                    request = msgpack.unpackb(frames[-1], raw=False)
+                    reply = processar_escrita(request.get("service"), request.get("data"))
+                    partes = [codificar(reply)]
+                    if not usuarios.gravar:
+                        partes = [sem_durabilidade(partes[0])]
+                    elif commit is not None:
+                        partes.append(str(commit.registrar()).encode())
+                except Exception as e:
+                    # O trabalhador espera a resposta no REQ: sem ela ficaria preso
+                    registrador.erro("Erro na escrita: %s", e)
+                    erros_metrica.inc("escrita")
+                    partes = [resposta_modelo(request.get("service") if isinstance(request, dict) else None,
+                                              time.time(), relogio.tick(),
+                                              status="erro", description="Erro interno")]
+                escritas_socket.send_multipart(frames[:-1] + partes)
+            
+            if sync_socket in socks:
+                try:
+                    frames = sync_socket.recv_multipart()
+                    request = msgpack.unpackb(frames[-1], raw=False)
+                    service = request.get("service")
+                    data = request.get("data", {})
                     
-                    canal_existe = any(c.get("channel") == channel for c in canais)
+                    if "clock" in data:
+                        relogio.update(data["clock"])
                     
-                    if canal_existe:
+                    if service == "clock":
                         reply = {
-                            "service": "channel",
+                            "service": "clock",
                             "data": {
-                                "status": "erro",
+                                "time": time.time() + ajuste_relogio,
                                 "timestamp": time.time(),
-                                "description": "Canal já cadastrado",
                                 "clock": relogio.tick()
                             }
                         }
-                        print(f"[S] - Tentativa de cadastro com canal existente: {channel}", flush=True)
-                    else:
-                        canais.append({
-                            "channel": channel,
-                            "timestamp": timestamp
-                        })
-                        salvar_canais(canais)
-                        
+                    elif service == "election":
                         reply = {
-                            "service": "channel",
+                            "service": "election",
                             "data": {
-                                "status": "sucesso",
+                                "election": "OK",
                                 "timestamp": time.time(),
                                 "clock": relogio.tick()
                             }
                         }
-                        print(f"[S] Canal: {channel}", flush=True)
-                        replicar_para_outros_servidores({"service": "channel", "data": data})
-
-                case "channels":
-                    lista_canais = [c.get("channel") for c in canais]
-                    print(f"[S] Listando canais: {len(canais)}", flush=True)
-                    
-                    reply = {
-                        "service": "channels",
-                        "data": {
-                            "timestamp": time.time(),
-                            "channels": lista_canais,
-                            "clock": relogio.tick()
-                        }
-                    }
-
-                case "publish":
-                    user = data.get("user")
-                    channel = data.get("channel")
-                    message = data.get("message")
-                    timestamp = data.get("timestamp")
-                    canal_existe = any(c.get("channel") == channel for c in canais)
-                    
-                    if not canal_existe:
+                        threading.Thread(target=iniciar_eleicao, daemon=True).start()
+                    elif service == "stats":
+                        # Replicação pendente por destino e recebida por origem
                         reply = {
-                            "service": "publish",
+                            "service": "stats",
                             "data": {
-                                "status": "erro",
-                                "message": f"Canal nao existe",
+                                "name": NOME_SERVIDOR,
+                                "replicacao": replicador.estatisticas(),
+                                "recebidas": {
+                                    "aplicadas": receptor_replicacao.aplicadas,
+                                    "duplicadas": receptor_replicacao.duplicadas,
+                                    "perdidas": receptor_replicacao.perdidas,
+                                    "falhas": receptor_replicacao.falhas,
+                                    "posicoes": receptor_replicacao.posicoes(),
+                                },
                                 "timestamp": time.time(),
                                 "clock": relogio.tick()
                             }
                         }
                     else:
-                        pub_msg = {
-                            "type": "channel",
-                            "topic": channel,
-                            "user": user,
-                            "channel": channel,
-                            "message": message,
-                            "timestamp": timestamp,
-                            "clock": relogio.get()
-                        }
-                        pub_socket.send(msgpack.packb(pub_msg))
-                        salvar_publicacao({"user": user, "channel": channel, "message": message, "timestamp": timestamp})
-                        
-                        reply = {
-                            "service": "publish",
-                            "data": {
-                                "status": "OK",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] Publicado: {channel}", flush=True)
-                        replicar_para_outros_servidores({"service": "publish", "data": data})
-
-                case "message":
-                    src = data.get("src")
-                    dst = data.get("dst")
-                    message = data.get("message")
-                    timestamp = data.get("timestamp")
-                    usuario_existe = any(u.get("user") == dst for u in usuarios)
+                        reply = resposta_modelo(service, time.time(), relogio.tick(),
+                                               status="erro", message="Servico nao reconhecido")
                     
-                    if not usuario_existe:
-                        reply = {
-                            "service": "message",
-                            "data": {
-                                "status": "erro",
-                                "message": f"Usuario nao existe",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
+                    sync_socket.send_multipart(frames[:-1] + [codificar(reply)])
+                except:
+                    erros_metrica.inc("sincronizacao")
+        
+            if replication_socket in socks:
+                try:
+                    frames = replication_socket.recv_multipart()
+                    lote = msgpack.unpackb(frames[-1], raw=False)
+                    ack = receptor_replicacao.receber(lote, aplicar_replicacao)
+                    ack["clock"] = relogio.tick()
+                    resposta = [frames[0], b"", msgpack.packb(ack)]
+                    if commit is None:
+                        replication_socket.send_multipart(resposta)
                     else:
-                        pub_msg = {
-                            "type": "user",
-                            "topic": dst,
-                            "src": src,
-                            "dst": dst,
-                            "message": message,
-                            "timestamp": timestamp,
-                            "clock": relogio.get()
-                        }
-                        pub_socket.send(msgpack.packb(pub_msg))
-                        salvar_mensagem_privada({"src": src, "dst": dst, "message": message, "timestamp": timestamp})
-                        
-                        reply = {
-                            "service": "message",
-                            "data": {
-                                "status": "OK",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] Mensagem: {src} -> {dst}", flush=True)
-                        replicar_para_outros_servidores({"service": "message", "data": data})
+                        acks_adiados.append((commit.registrar(), resposta))
+                except:
+                    erros_metrica.inc("replicacao")
             
-                case _ :
-                    reply = {
-                        "service": service if service else "unknown",
-                        "data": {
-                            "status": "erro",
-                            "timestamp": time.time(),
-                            "description": "Serviço não encontrado",
-                            "clock": relogio.tick()
-                        }
-                    }
+            if commits_replicacao in socks:
+                while True:
+                    try:
+                        commits_replicacao.recv(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+            
+            if acks_adiados:
+                # Confere a cada volta, como as respostas adiadas dos clientes
+                duravel_ate = commit.duravel
+                prontos = [resposta for ticket, resposta in acks_adiados if ticket <= duravel_ate]
+                if prontos:
+                    acks_adiados = [(ticket, resposta) for ticket, resposta in acks_adiados
+                                    if ticket > duravel_ate]
+                    for resposta in prontos:
+                        replication_socket.send_multipart(resposta)
+        
+        except:
+            erros_metrica.inc("dono_do_estado")
+            time.sleep(0.1)
 
-            # Responder no mesmo formato que recebeu
-            if formato_json:
-                socket.send(json.dumps(reply).encode('utf-8'))
-            else:
-                socket.send(msgpack.packb(reply))
+# Balanceador interno: o broker entrega as requisições a este DEALER e cada
+# uma é repassada a um trabalhador livre (que avisou READY)
+def conectar_broker():
+    broker_socket = context.socket(zmq.DEALER)
+    broker_socket.setsockopt(zmq.LINGER, 0)
+    # O broker identifica o servidor pelo nome para rotear as escritas por chave
+    broker_socket.setsockopt(zmq.ROUTING_ID, NOME_SERVIDOR.encode("utf-8"))
+    broker_socket.connect(f"tcp://{BROKER_HOST}:{BROKER_PORTA_SERVIDORES}")
+    if BROKER_MODO != "proxy":
+        # Zera os créditos que o broker tinha deste servidor antes de anunciar os livres
+        broker_socket.send_multipart([b"", SINAL_REANUNCIAR])
+    return broker_socket
+
+broker_socket = conectar_broker()
+
+trabalhadores_socket = context.socket(zmq.ROUTER)
+trabalhadores_socket.bind("inproc://trabalhadores")
+
+# Avisos do commit em grupo (modo durável)
+commits_socket = context.socket(zmq.PULL)
+commits_socket.bind("inproc://commits")
+
+threading.Thread(target=dono_do_estado, daemon=True).start()
+for _ in range(TRABALHADORES):
+    threading.Thread(target=trabalhador, daemon=True).start()
+
+balanceado = BROKER_MODO != "proxy"
+
+# No modo proxy só lê do broker enquanto houver trabalhador livre; no modo
+# balanceado o broker só envia requisições para trabalhadores anunciados
+poller_todos = zmq.Poller()
+poller_todos.register(trabalhadores_socket, zmq.POLLIN)
+poller_todos.register(broker_socket, zmq.POLLIN)
+poller_todos.register(commits_socket, zmq.POLLIN)
+poller_trabalhadores = zmq.Poller()
+poller_trabalhadores.register(trabalhadores_socket, zmq.POLLIN)
+poller_trabalhadores.register(commits_socket, zmq.POLLIN)
+livres = deque()
+pendentes = deque()  # requisições recebidas do broker à espera de trabalhador
+adiadas = []  # [(ticket, resposta)] de escritas à espera do fsync
+
+proximo_heartbeat = time.time() + HEARTBEAT_BROKER_INTERVALO
+ultimo_contato_broker = time.time()
+
+if servir_metricas(METRICAS_PORTA, "" if ESCUTA == "*" else ESCUTA):
+    registrador.info("Metricas porta %d", METRICAS_PORTA)
+registrador.info("%s pronto (%d trabalhadores, broker %s)", NOME_SERVIDOR, TRABALHADORES, BROKER_MODO)
+
+while True:
+    try:
+        if balanceado:
+            espera = max(0, proximo_heartbeat - time.time()) * 1000
+            socks = dict(poller_todos.poll(espera))
+        else:
+            socks = dict((poller_todos if livres else poller_trabalhadores).poll())
         
-        if sync_socket in socks:
-            try:
-                request_data = sync_socket.recv()
-                request = msgpack.unpackb(request_data, raw=False)
-                service = request.get("service")
-                data = request.get("data", {})
-                
-                if "clock" in data:
-                    relogio.update(data["clock"])
-                
-                if service == "clock":
-                    reply = {
-                        "service": "clock",
-                        "data": {
-                            "time": time.time() + ajuste_relogio,
-                            "timestamp": time.time(),
-                            "clock": relogio.tick()
-                        }
-                    }
-                elif service == "election":
-                    reply = {
-                        "service": "election",
-                        "data": {
-                            "election": "OK",
-                            "timestamp": time.time(),
-                            "clock": relogio.tick()
-                        }
-                    }
-                    threading.Thread(target=iniciar_eleicao, daemon=True).start()
-                else:
-                    reply = {
-                        "service": service,
-                        "data": {
-                            "status": "erro",
-                            "message": "Servico nao reconhecido",
-                            "timestamp": time.time(),
-                            "clock": relogio.tick()
-                        }
-                    }
-                
-                sync_socket.send(msgpack.packb(reply))
-            except:
-                pass
+        if trabalhadores_socket in socks:
+            # [trabalhador, b"", READY] ou [trabalhador, b"", cliente..., b"", resposta]
+            frames = trabalhadores_socket.recv_multipart()
+            livres.append(frames[0])
+            if frames[2] == SINAL_ADIADA:
+                # [trabalhador, b"", ADIADA, ticket, cliente..., b"", resposta]
+                if balanceado:
+                    broker_socket.send_multipart([b"", SINAL_PRONTO])
+                adiadas.append((int(frames[3]), frames[4:]))
+            elif frames[2:] != [b"READY"]:
+                # No modo balanceado a resposta também devolve o crédito ao broker
+                broker_socket.send_multipart(frames[2:])
+            elif balanceado:
+                broker_socket.send_multipart([b"", SINAL_PRONTO])
         
-        if replication_socket in socks:
-            try:
-                request_data = replication_socket.recv()
-                request = msgpack.unpackb(request_data, raw=False)
-                
-                if request.get("replicated"):
-                    service = request.get("service")
-                    data = request.get("data", {})
-                    
-                    if "clock" in data:
-                        relogio.update(data["clock"])
-                    
-                    if service == "login":
-                        user = data.get("user")
-                        if not any(u.get("user") == user for u in usuarios):
-                            usuarios.append({"user": user, "timestamp": data.get("timestamp")})
-                            salvar_usuarios(usuarios)
-                            print(f"[S] Replicado usuario: {user}", flush=True)
-                    
-                    elif service == "channel":
-                        channel = data.get("channel")
-                        if not any(c.get("channel") == channel for c in canais):
-                            canais.append({
-                                "channel": channel,
-                                "timestamp": data.get("timestamp")
-                            })
-                            salvar_canais(canais)
-                            print(f"[S] Replicado canal: {channel}", flush=True)
-                    
-                    elif service == "publish":
-                        salvar_publicacao({
-                            "user": data.get("user"),
-                            "channel": data.get("channel"),
-                            "message": data.get("message"),
-                            "timestamp": data.get("timestamp")
-                        })
-                    
-                    elif service == "message":
-                        salvar_mensagem_privada({
-                            "src": data.get("src"),
-                            "dst": data.get("dst"),
-                            "message": data.get("message"),
-                            "timestamp": data.get("timestamp")
-                        })
-                    
-                    ack = {"status": "OK", "clock": relogio.tick()}
-                    replication_socket.send(msgpack.packb(ack))
-                else:
-                    ack = {"status": "ignored"}
-                    replication_socket.send(msgpack.packb(ack))
-            except:
-                pass
+        if commits_socket in socks:
+            while True:
+                try:
+                    commits_socket.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+        
+        if adiadas:
+            # Confere a cada volta: o aviso do fsync pode chegar antes da resposta do trabalhador
+            duravel_ate = commit.duravel
+            prontas = [resposta for ticket, resposta in adiadas if ticket <= duravel_ate]
+            if prontas:
+                adiadas = [(ticket, resposta) for ticket, resposta in adiadas if ticket > duravel_ate]
+                for resposta in prontas:
+                    if balanceado:
+                        # O crédito já foi devolvido quando o trabalhador ficou livre
+                        broker_socket.send_multipart([b"", SINAL_ADIADA] + resposta)
+                    else:
+                        broker_socket.send_multipart(resposta)
+        
+        if broker_socket in socks and (livres or balanceado):
+            frames = broker_socket.recv_multipart()
+            ultimo_contato_broker = time.time()
+            if frames[0] != b"":
+                pendentes.append(frames)
+            elif frames[1:] == [SINAL_REANUNCIAR]:
+                # Broker reiniciado que ainda não conhece este servidor
+                broker_socket.send_multipart([b"", SINAL_REANUNCIAR])
+                for _ in livres:
+                    broker_socket.send_multipart([b"", SINAL_PRONTO])
+            # frames == [b"", SINAL_HEARTBEAT]: apenas sinal de vida do broker
+        
+        while pendentes and livres:
+            trabalhadores_socket.send_multipart([livres.popleft(), b""] + pendentes.popleft())
+        
+        if balanceado and time.time() >= proximo_heartbeat:
+            broker_socket.send_multipart([b"", SINAL_HEARTBEAT])
+            proximo_heartbeat = time.time() + HEARTBEAT_BROKER_INTERVALO
+            
+            if time.time() - ultimo_contato_broker > HEARTBEAT_BROKER_INTERVALO * HEARTBEAT_BROKER_VIVACIDADE:
+                # Broker reiniciado ou inacessível: reconecta e anuncia de novo os trabalhadores livres
+                registrador.aviso("Broker sem resposta, reconectando")
+                poller_todos.unregister(broker_socket)
+                broker_socket.close()
+                broker_socket = conectar_broker()
+                poller_todos.register(broker_socket, zmq.POLLIN)
+                for _ in livres:
+                    broker_socket.send_multipart([b"", SINAL_PRONTO])
+                ultimo_contato_broker = time.time()
     
     except KeyboardInterrupt:
         break
@@ -1,39 +1,74 @@
+import sys
+from configuracao import configurar
+if __name__ == "__main__":
+    # Antes dos outros imports do projeto, que leem as opções ao carregar
+    configurar(sys.argv[1:])
 import zmq
 import msgpack
 import time
 import threading
 from datetime import datetime
-
-# Classe do relógio lógico
-class RelogioLogico:
-    def __init__(self):
-        self.clock = 0
-    
-    def tick(self):
-        self.clock += 1
-        return self.clock
-    
-    def update(self, clock_recebido):
-        self.clock = max(self.clock, clock_recebido)
-        return self.clock
-    
-    def get(self):
-        return self.clock
+from relogio import RelogioLogico
+from topicos import Publicador
+from membros import TOPICO
+from metricas import Contador, Medidor, Histograma, servir as servir_metricas
+from configuracao import obter, REFERENCIA_PORTA, REFERENCIA_PORTA_EVENTOS
 
 relogio = RelogioLogico()
 
 # Estrutura para armazenar servidores
-# {nome: {"rank": rank, "last_heartbeat": timestamp}}
+# {nome: {"rank": rank, "address": endereço anunciado, "last_heartbeat": timestamp}}
+# O endereço ({host, sync, replication, publication}) é o que os outros
+# servidores usam para conectar; vários servidores podem dividir um host
 servidores = {}
 proximo_rank = 1
 lock = threading.Lock()
 
-# Timeout para heartbeat (em segundos)
-HEARTBEAT_TIMEOUT = 30
+# Sem heartbeat nesse tempo (em segundos) o servidor sai da lista; os
+# servidores enviam um a cada SERVIDOR_HEARTBEAT_INTERVALO (padrão 2 s)
+HEARTBEAT_TIMEOUT = float(obter("REFERENCIA_HEARTBEAT_TIMEOUT", 6))
+
+# Época de membros: cresce a cada entrada ou saída. Começa no instante de
+# início (em µs) para continuar crescendo se o servidor de referência reiniciar
+epoca = time.time_ns() // 1000
+
+# Métricas no formato do Prometheus em GET /metrics nessa porta (0 desliga)
+METRICAS_PORTA = int(obter("REFERENCIA_METRICAS_PORTA", 9104))
+SERVICOS = {"rank", "list", "heartbeat"}
+
+requisicoes_metrica = Contador("referencia_requisicoes_total", "Requisicoes atendidas", ("servico",))
+latencia_metrica = Histograma("referencia_requisicao_segundos", "Tempo de atendimento", ("servico",))
+mudancas_metrica = Contador("referencia_mudancas_total", "Entradas e saidas publicadas", ("tipo",))
+removidos_metrica = Contador("referencia_removidos_total", "Servidores removidos sem heartbeat")
+readmitidos_metrica = Contador("referencia_readmitidos_total", "Servidores vivos readmitidos com o rank")
+erros_metrica = Contador("referencia_erros_total", "Requisicoes que deram erro")
+Medidor("referencia_membros", "Servidores registrados", funcao=lambda: len(servidores))
+Medidor("referencia_epoca", "Epoca de membros", funcao=lambda: epoca)
+
+# Eventos "join"/"leave" para as cópias locais da lista nos servidores (membros.py)
+context = zmq.Context()
+eventos_socket = context.socket(zmq.PUB)
+eventos_socket.bind(f"tcp://*:{REFERENCIA_PORTA_EVENTOS}")
+eventos = Publicador([eventos_socket], "referencia")
+
+def mudar_membros(tipo, nome_servidor, info):
+    """Avança a época e publica a mudança (chamado com o lock)"""
+    global epoca
+    epoca += 1
+    rank = info["rank"]
+    eventos.publicar(TOPICO, tipo, relogio.tick(), {
+        "name": nome_servidor,
+        "rank": rank,
+        "address": info.get("address"),
+        "epoch": epoca,
+        "timestamp": time.time()
+    })
+    mudancas_metrica.inc(tipo)
+    print(f"[REF] {tipo} {nome_servidor} rank {rank} (epoca {epoca})", flush=True)
 
 def limpar_servidores_inativos():
     while True:
-        time.sleep(10)
+        time.sleep(1)
         tempo_atual = time.time()
         with lock:
             servidores_inativos = []
@@ -41,95 +76,138 @@ def limpar_servidores_inativos():
                 if tempo_atual - info["last_heartbeat"] > HEARTBEAT_TIMEOUT:
                     servidores_inativos.append(nome)
             for nome in servidores_inativos:
-                del servidores[nome]
+                removidos_metrica.inc()
+                mudar_membros("leave", nome, servidores.pop(nome))
 
 threading.Thread(target=limpar_servidores_inativos, daemon=True).start()
 
-def atribuir_rank(nome_servidor):
+def atribuir_rank(nome_servidor, endereco=None):
     global proximo_rank
     with lock:
         if nome_servidor not in servidores:
             rank = proximo_rank
             proximo_rank += 1
-            servidores[nome_servidor] = {"rank": rank, "last_heartbeat": time.time()}
-            print(f"[REF] Servidor {nome_servidor} rank {rank}", flush=True)
+            servidores[nome_servidor] = {"rank": rank, "address": endereco, "last_heartbeat": time.time()}
+            mudar_membros("join", nome_servidor, servidores[nome_servidor])
         else:
-            rank = servidores[nome_servidor]["rank"]
-            servidores[nome_servidor]["last_heartbeat"] = time.time()
+            info = servidores[nome_servidor]
+            rank = info["rank"]
+            info["last_heartbeat"] = time.time()
+            if endereco != info.get("address"):
+                # Reiniciado com outro endereço: o "join" atualiza as cópias
+                info["address"] = endereco
+                mudar_membros("join", nome_servidor, info)
     return rank
 
-context = zmq.Context()
-socket = context.socket(zmq.REP)
-socket.bind("tcp://*:5560")
-
-print("[REF] Porta 5560", flush=True)
+def readmitir(nome_servidor, rank, endereco=None):
+    """Servidor vivo fora da lista (heartbeats atrasados ou servidor de
+    referência reiniciado) volta com o rank que tinha, se ainda estiver livre"""
+    global proximo_rank
+    with lock:
+        if nome_servidor in servidores:
+            return servidores[nome_servidor]["rank"]
+        if rank is None or any(info["rank"] == rank for info in servidores.values()):
+            rank = proximo_rank
+        proximo_rank = max(proximo_rank, rank + 1)
+        readmitidos_metrica.inc()
+        servidores[nome_servidor] = {"rank": rank, "address": endereco, "last_heartbeat": time.time()}
+        mudar_membros("join", nome_servidor, servidores[nome_servidor])
+    return rank
 
-while True:
-    try:
-        request_data = socket.recv()
-        request = msgpack.unpackb(request_data, raw=False)
-        
-        service = request.get("service")
-        data = request.get("data", {})
-        
-        if "clock" in data:
-            relogio.update(data["clock"])
-        
-        if service == "rank":
-            # Atribuir rank ao servidor
-            nome_servidor = data.get("user")
-            rank = atribuir_rank(nome_servidor)
-            
-            reply = {
-                "service": "rank",
-                "data": {
-                    "rank": rank,
-                    "timestamp": time.time(),
-                    "clock": relogio.tick()
-                }
-            }
+def tratar(request):
+    service = request.get("service")
+    data = request.get("data", {})
+    
+    if "clock" in data:
+        relogio.update(data["clock"])
+    
+    if service == "rank":
+        # Atribuir rank ao servidor
+        nome_servidor = data.get("user")
+        rank = atribuir_rank(nome_servidor, data.get("address"))
         
-        elif service == "list":
-            with lock:
-                lista_servidores = [{"name": nome, "rank": info["rank"]} for nome, info in servidores.items()]
-            reply = {
-                "service": "list",
-                "data": {
-                    "list": lista_servidores,
-                    "timestamp": time.time(),
-                    "clock": relogio.tick()
-                }
+        return {
+            "service": "rank",
+            "data": {
+                "rank": rank,
+                "timestamp": time.time(),
+                "clock": relogio.tick()
             }
-        
-        elif service == "heartbeat":
-            nome_servidor = data.get("user")
-            with lock:
-                if nome_servidor in servidores:
-                    servidores[nome_servidor]["last_heartbeat"] = time.time()
-                    status = "OK"
-                else:
-                    status = "unknown"
-            reply = {
-                "service": "heartbeat",
-                "data": {
-                    "status": status,
-                    "timestamp": time.time(),
-                    "clock": relogio.tick()
-                }
+        }
+    
+    if service == "list":
+        with lock:
+            lista_servidores = [{"name": nome, "rank": info["rank"], "address": info.get("address")}
+                                for nome, info in servidores.items()]
+            epoca_lista = epoca
+        return {
+            "service": "list",
+            "data": {
+                "list": lista_servidores,
+                "epoch": epoca_lista,
+                "timestamp": time.time(),
+                "clock": relogio.tick()
             }
-        
-        else:
-            reply = {
-                "service": service,
-                "data": {
-                    "status": "erro",
-                    "message": "Servico nao reconhecido",
-                    "timestamp": time.time(),
-                    "clock": relogio.tick()
-                }
+        }
+    
+    if service == "heartbeat":
+        nome_servidor = data.get("user")
+        rank = None
+        with lock:
+            if nome_servidor in servidores:
+                servidores[nome_servidor]["last_heartbeat"] = time.time()
+                rank = servidores[nome_servidor]["rank"]
+                status = "OK"
+        if rank is None:
+            if data.get("rank") is not None:
+                rank = readmitir(nome_servidor, data["rank"], data.get("address"))
+                status = "OK"
+            else:
+                status = "unknown"
+        return {
+            "service": "heartbeat",
+            "data": {
+                "status": status,
+                "rank": rank,
+                "epoch": epoca,
+                "timestamp": time.time(),
+                "clock": relogio.tick()
             }
-        
-        socket.send(msgpack.packb(reply))
-    except:
-        pass
+        }
+    
+    return {
+        "service": service,
+        "data": {
+            "status": "erro",
+            "message": "Servico nao reconhecido",
+            "timestamp": time.time(),
+            "clock": relogio.tick()
+        }
+    }
 
+# ROUTER: cada resposta volta com o envelope da requisição (identidade do
+# cliente e, de DEALER ou REQ_CORRELATE, o id da chamada), então clientes
+# REQ e DEALER são atendidos intercalados e uma requisição com erro ou um
+# cliente que desistiu não trava o socket para os outros
+socket = context.socket(zmq.ROUTER)
+socket.bind(f"tcp://*:{REFERENCIA_PORTA}")
+
+print(f"[REF] Porta {REFERENCIA_PORTA}, eventos de membros {REFERENCIA_PORTA_EVENTOS}", flush=True)
+if servir_metricas(METRICAS_PORTA):
+    print(f"[REF] Metricas porta {METRICAS_PORTA}", flush=True)
+
+while True:
+    try:
+        frames = socket.recv_multipart()
+        if len(frames) < 2:
+            continue
+        inicio = time.perf_counter()
+        request = msgpack.unpackb(frames[-1], raw=False)
+        reply = tratar(request)
+        socket.send_multipart(frames[:-1] + [msgpack.packb(reply)])
+        servico = reply["service"] if reply["service"] in SERVICOS else "outro"
+        requisicoes_metrica.inc(servico)
+        latencia_metrica.observar(time.perf_counter() - inicio, servico)
+    except Exception as e:
+        erros_metrica.inc()
+        print(f"[REF] Erro: {e}", flush=True)
@@ -1,41 +1,76 @@
+import sys
+from configuracao import configurar
+if __name__ == "__main__":
+    # Antes dos outros imports do projeto, que leem as opções ao carregar
+    configurar(sys.argv[1:])
 import zmq
-from time import sleep
-import msgpack
-import os
+from topicos import enderecos_assinatura, ler_cabecalho, ler_corpo
+from configuracao import obter
 
-usuario = os.environ.get("SUBSCRIBER_USER", "sub_default")
-canais_inscritos = os.environ.get("SUBSCRIBER_CHANNELS", "").split(",")
+usuario = obter("SUBSCRIBER_USER", "sub_default")
+canais_inscritos = obter("SUBSCRIBER_CHANNELS", "").split(",")
 canais_inscritos = [c.strip() for c in canais_inscritos if c.strip()]
 
+# Mensagens lidas de uma vez antes de escrever a saída
+DRENAR_MAX = int(obter("SUBSCRIBER_DRENAR_MAX", 1000))
+
+# Só os shards do proxy que atendem o usuário e os canais inscritos
+topicos = {usuario, *canais_inscritos}
+
 context = zmq.Context()
 sub = context.socket(zmq.SUB)
-sub.connect("tcp://proxy:5558")
+for endereco in enderecos_assinatura(topicos):
+    sub.connect(endereco)
 
-sub.setsockopt_string(zmq.SUBSCRIBE, usuario)
-for canal in canais_inscritos:
-    sub.setsockopt_string(zmq.SUBSCRIBE, canal)
+for topico in topicos:
+    sub.setsockopt_string(zmq.SUBSCRIBE, topico)
 
 print(f"[SUB {usuario}] Iniciado", flush=True)
 
-while True:
-    try:
-        topic = sub.recv_string()
-        mensagem_data = sub.recv()
-        mensagem = msgpack.unpackb(mensagem_data, raw=False)
-        
-        msg_type = mensagem.get("type")
-        if msg_type == "user":
-            src = mensagem.get("src")
-            message = mensagem.get("message")
-            print(f"[SUB {usuario}] De {src}: {message}", flush=True)
-        elif msg_type == "channel":
-            user = mensagem.get("user")
-            channel = mensagem.get("channel")
-            message = mensagem.get("message")
-            print(f"[SUB {usuario}] #{channel} {user}: {message}", flush=True)
-    except:
-        pass
-    sleep(0.1)
-
-sub.close()
-context.close()
+ultimas = {}  # {(origem, tópico): última seq recebida}
+
+def formatar(frames):
+    """Linhas de saída da mensagem, ou None se não for para exibir"""
+    topic, tipo, clock, origem, seq = ler_cabecalho(frames)
+    if topic not in topicos:
+        return None  # a inscrição do ZeroMQ é por prefixo ("ana" recebe "anabel")
+    linhas = []
+    anterior = ultimas.get((origem, topic))
+    if anterior is not None and seq > anterior + 1:
+        linhas.append(f"[SUB {usuario}] {seq - anterior - 1} mensagens perdidas em {topic} ({origem})")
+    ultimas[(origem, topic)] = seq
+
+    if tipo == "user":
+        mensagem = ler_corpo(frames)
+        linhas.append(f"[SUB {usuario}] De {mensagem.get('src')}: {mensagem.get('message')}")
+    elif tipo == "channel":
+        mensagem = ler_corpo(frames)
+        linhas.append(f"[SUB {usuario}] #{mensagem.get('channel')} {mensagem.get('user')}: {mensagem.get('message')}")
+    return "\n".join(linhas) or None
+
+try:
+    while True:
+        # Espera a primeira mensagem e drena o que já chegou sem pausa
+        lote = [sub.recv_multipart()]
+        while len(lote) < DRENAR_MAX:
+            try:
+                lote.append(sub.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+
+        saida = []
+        for frames in lote:
+            try:
+                linha = formatar(frames)
+            except Exception:
+                continue
+            if linha:
+                saida.append(linha)
+        if saida:
+            sys.stdout.write("\n".join(saida) + "\n")
+            sys.stdout.flush()
+except KeyboardInterrupt:
+    pass
+finally:
+    sub.close()
+    context.term()
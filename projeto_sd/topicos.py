@@ -0,0 +1,104 @@
+import zlib
+import threading
+import zmq
+import msgpack
+from configuracao import obter
+
+# Mensagens do pub/sub em três frames: [tópico, cabeçalho, corpo].
+# O proxy filtra pelo primeiro frame; o cabeçalho [tipo, relógio, origem, seq]
+# é pequeno e basta para descartar ou ordenar, e o corpo (MessagePack) só é
+# decodificado por quem vai usar o conteúdo
+QUADROS = 3
+
+# Mapa de shards do proxy, o mesmo em servidores, assinantes, relay e
+# proxies: "host:porta_xsub:porta_xpub" separados por vírgula. Cada tópico
+# passa por um único shard, escolhido por crc32 do nome
+PROXY_SHARDS = obter("PROXY_SHARDS", "proxy:5557:5558")
+
+
+def carregar_shards(texto):
+    """[(host, porta_xsub, porta_xpub)] a partir do texto do mapa"""
+    shards = []
+    for item in texto.split(","):
+        item = item.strip()
+        if item:
+            host, xsub, xpub = item.rsplit(":", 2)
+            shards.append((host, int(xsub), int(xpub)))
+    return shards
+
+
+SHARDS = carregar_shards(PROXY_SHARDS)
+
+
+def shard_do_topico(topico, total=None):
+    """Índice do shard responsável pelo tópico (str ou bytes)"""
+    total = len(SHARDS) if total is None else total
+    if total == 1:
+        return 0
+    if isinstance(topico, str):
+        topico = topico.encode("utf-8")
+    return zlib.crc32(topico) % total
+
+
+def conectar_publicacao(contexto):
+    """Um PUB por shard, conectado ao XSUB do proxy (na ordem do mapa)"""
+    sockets = []
+    for host, porta_xsub, _ in SHARDS:
+        sock = contexto.socket(zmq.PUB)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(f"tcp://{host}:{porta_xsub}")
+        sockets.append(sock)
+    return sockets
+
+
+def enderecos_assinatura(topicos):
+    """Endereços XPUB dos shards que atendem os tópicos"""
+    return sorted({f"tcp://{SHARDS[i][0]}:{SHARDS[i][2]}"
+                   for i in {shard_do_topico(t) for t in topicos}})
+
+
+class Publicador:
+    """PUBs (um por shard) que numeram as mensagens por tópico.
+
+    A seq começa em 1 para cada (origem, tópico), então um assinante que só
+    recebe alguns tópicos ainda consegue perceber mensagens perdidas. Cada
+    tópico sai pelo socket do seu shard; com um socket só, tudo sai por ele.
+    Pode ser usado de várias threads; o envio nunca bloqueia.
+    """
+
+    def __init__(self, sockets, origem):
+        self.sockets = sockets
+        self.origem = origem
+        self.seqs = {}  # {tópico: última seq enviada}
+        self.descartadas = 0
+        self.lock = threading.Lock()
+
+    def publicar(self, topico, tipo, clock, corpo):
+        """Envia corpo (dict) no tópico; retorna False se o PUB descartou"""
+        quadro_topico = str(topico).encode("utf-8")
+        quadro_corpo = msgpack.packb(corpo)
+        socket = self.sockets[shard_do_topico(quadro_topico, len(self.sockets))]
+        with self.lock:
+            seq = self.seqs[topico] = self.seqs.get(topico, 0) + 1
+            cabecalho = msgpack.packb([tipo, clock, self.origem, seq])
+            try:
+                socket.send_multipart([quadro_topico, cabecalho, quadro_corpo], zmq.NOBLOCK)
+            except zmq.Again:
+                self.descartadas += 1
+                return False
+        return True
+
+
+def ler_cabecalho(frames):
+    """(tópico, tipo, relógio, origem, seq) sem decodificar o corpo.
+
+    Levanta ValueError se os frames não estão no formato de três partes.
+    """
+    if len(frames) != QUADROS:
+        raise ValueError(f"esperados {QUADROS} frames, recebidos {len(frames)}")
+    tipo, clock, origem, seq = msgpack.unpackb(frames[1], raw=False)
+    return frames[0].decode("utf-8"), tipo, clock, origem, seq
+
+
+def ler_corpo(frames):
+    return msgpack.unpackb(frames[2], raw=False)